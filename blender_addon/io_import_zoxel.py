@@ -20,6 +20,10 @@ import bpy
 import collections
 import os
 import json
+import zlib
+import array
+import struct
+import sys
 
 from bpy.props import (
     BoolProperty,
@@ -32,7 +36,7 @@ from bpy.props import (
 bl_info = {
     "name": "Zoxel importer",
     "author": "Lennart Riecken",
-    "version": (0, 0, 1),
+    "version": (0, 0, 2),
     "blender": (2, 76, 0),
     "location": "File > Import-Export",
     "description": "Import Zoxel files",
@@ -76,14 +80,44 @@ class ImportZOXEL(bpy.types.Operator):
         file = os.path.join(directory, filename)
         print("Loading: " + file)
 
-        json_string_data = open(file).read()
-        data = json.loads(json_string_data)
+        with open(file, "rb") as f:
+            raw = f.read()
+        if raw[:4] == b"ZOXB":
+            for framedata in self.readBinary(raw):
+                self.importFrame(framedata, filename)
+            return
+        data = json.loads(raw.decode("utf-8"))
         i = 1
         while "frame" + str(i) in data.keys():
             framedata = data["frame" + str(i)]
             self.importFrame(framedata, filename)
             i = i + 1
 
+    # Read a version 2 (binary) Zoxel file, returning a list of (x, y, z, color)
+    # tuples for each frame
+    def readBinary(self, raw):
+        magic, version, width, height, depth, frames, size, colors = struct.unpack_from("<4sHHHHHBI", raw)
+        pos = struct.calcsize("<4sHHHHHBI")
+        pos += 2 + struct.unpack_from("<H", raw, pos)[0]
+        palette = struct.unpack_from("<%dI" % colors, raw, pos)
+        pos += colors * 4
+        typecode = {1: "B", 2: "H", 4: "I"}[size]
+        result = []
+        for i in range(frames):
+            offset, length = struct.unpack_from("<II", raw, pos + i * 8)
+            indices = array.array(typecode)
+            indices.frombytes(zlib.decompress(raw[offset:offset + length]))
+            if sys.byteorder == "big":
+                indices.byteswap()
+            frame = []
+            for n, v in enumerate(indices):
+                if v:
+                    xy, z = divmod(n, depth)
+                    x, y = divmod(xy, height)
+                    frame.append((x, y, z, palette[v]))
+            result.append(frame)
+        return result
+
     def hasVoxel(self, frame, x, y, z):
         for data in frame:
             if data[0] == x and data[1] == y and data[2] == z:
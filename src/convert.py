@@ -0,0 +1,240 @@
+# convert.py
+# Convert voxel files between formats without the GUI.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Usage: zoxel.py convert -t EXT [-o DIR] [-f FORMAT] [-j JOBS] PATH...
+#
+# Runs the file handler plugins against a VoxelData of their own. Each
+# worker process of the pool loads the plugins once and converts one file
+# at a time, reporting the time taken or the error for each file.
+
+import os
+import sys
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+from collections import Counter
+from importlib import import_module
+from plugin_api import PluginManager
+from voxel import VoxelData
+import loaders
+
+log = logging.getLogger("zoxel.convert")
+
+# The file handlers registered in this process
+_handlers = []
+
+
+# The API plugins see when we run without GUI. All instances share the
+# voxel data of the file being converted.
+class HeadlessAPI(object):
+
+    voxels = None
+
+    def __init__(self):
+        self._config = {}
+
+    def register_tool(self, tool, activate=False):
+        pass
+
+    def register_file_handler(self, handler):
+        _handlers.append(handler)
+
+    def get_palette_color(self):
+        return 0xffffffff
+
+    def set_palette_color(self, color):
+        pass
+
+    def get_voxel_data(self):
+        return HeadlessAPI.voxels
+
+    def get_voxel_mesh(self):
+        vert, col, norm, _, _ = HeadlessAPI.voxels.get_vertices()
+        return (vert, col, norm)
+
+    def set_config(self, name, value):
+        self._config[name] = value
+
+    def get_config(self, name):
+        return self._config.get(name)
+
+    def warning(self, message):
+        log.warning(message)
+
+    # Nobody to ask, so we take the default answer
+    def question(self, title, message):
+        return False
+
+
+# Load the file handler plugins, which are the plugins named io_*. Tools
+# need the GUI.
+def load_plugins():
+    if _handlers:
+        return
+    PluginManager.api_class = HeadlessAPI
+    from plugins import __all__ as plugins
+    for p in plugins:
+        if p.startswith("io_"):
+            import_module('plugins.' + p)
+
+
+# Return the extension of a filename, lower case and without the dot
+def _extension(filename):
+    return os.path.splitext(filename)[1][1:].lower()
+
+
+# Return the first handler with the given method for files with the
+# extension. If description is given the handler must match it. Loaders
+# are found from the contents of files instead, see loaders.py.
+def find_handler(method, extension, description=None):
+    for handler in _handlers:
+        if not hasattr(handler, method):
+            continue
+        if description is not None and handler.description.lower() != description.lower():
+            continue
+        if handler.filetype.lower() == "*." + extension:
+            return handler
+    return None
+
+
+# Convert one file, returns (source, target, seconds, error)
+def convert_file(job):
+    source, target, description = job
+    start = time.time()
+    try:
+        load_plugins()
+        saver = find_handler("save", _extension(target), description)
+        if saver is None:
+            raise Exception("No handler can save this file type")
+        HeadlessAPI.voxels = VoxelData()
+        HeadlessAPI.voxels.disable_undo()
+        loaders.load_file(_handlers, source)
+        directory = os.path.dirname(target)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another worker may have just created it
+                if not os.path.isdir(directory):
+                    raise
+        saver.save(target)
+        error = None
+    except Exception as Ex:
+        log.debug(traceback.format_exc())
+        error = str(Ex) or Ex.__class__.__name__
+    finally:
+        HeadlessAPI.voxels = None
+    return source, target, time.time() - start, error
+
+
+# Return the (source, target) pairs for the given paths. Directories are
+# searched for files we can load, keeping their layout in the output
+# directory.
+def collect(paths, extension, output):
+    load_plugins()
+    loadable = set(h.filetype.lower()[2:] for h in _handlers if hasattr(h, "load"))
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if _extension(name) in loadable:
+                        source = os.path.join(root, name)
+                        relative = os.path.relpath(source, path)
+                        jobs.append((source, _target(relative, extension, output or path)))
+        else:
+            jobs.append((path, _target(path, extension, output)))
+    return jobs
+
+
+# Split the (source, target) pairs into those we can convert and the
+# (source, target, error) of those which would overwrite their source or
+# the target of another source
+def _check(pairs):
+    targets = Counter(_key(target) for _, target in pairs)
+    jobs = []
+    rejected = []
+    for source, target in pairs:
+        if _key(source) == _key(target):
+            rejected.append((source, target, "The target is the source file"))
+        elif targets[_key(target)] > 1:
+            rejected.append((source, target, "Other files convert to %s too" % target))
+        else:
+            jobs.append((source, target))
+    return jobs, rejected
+
+
+# A path for comparing with other paths
+def _key(path):
+    return os.path.normcase(os.path.realpath(path))
+
+
+def _target(path, extension, output):
+    target = os.path.splitext(path)[0] + "." + extension
+    if output is None:
+        return target
+    if os.path.isabs(target):
+        target = os.path.basename(target)
+    return os.path.join(output, target)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog="zoxel.py convert", description="Convert voxel files between formats.")
+    parser.add_argument("paths", nargs="+", metavar="PATH", help="files or directories to convert")
+    parser.add_argument("-t", "--to", required=True, metavar="EXT", help="extension of the format to convert to")
+    parser.add_argument("-o", "--output", metavar="DIR", help="directory for the converted files")
+    parser.add_argument("-f", "--format", metavar="FORMAT",
+                        help='description of the file handler to save with, e.g. "Zoxel Files (version 1)"')
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    options = parser.parse_args(args)
+
+    extension = options.to.lstrip(".").lower()
+    load_plugins()
+    if find_handler("save", extension, options.format) is None:
+        parser.error("no file handler can save .%s files%s" %
+                     (extension, " as " + options.format if options.format else ""))
+    pairs = collect(options.paths, extension, options.output)
+    jobs, rejected = _check(pairs)
+    jobs = [(source, target, options.format) for source, target in jobs]
+
+    start = time.time()
+    failed = 0
+    for source, target, error in rejected:
+        failed += 1
+        sys.stderr.write("%8.3fs  %s FAILED: %s\n" % (0, source, error))
+    if options.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(options.jobs, len(jobs)), load_plugins)
+        results = pool.imap_unordered(convert_file, jobs)
+    else:
+        pool = None
+        results = (convert_file(job) for job in jobs)
+    try:
+        for source, target, seconds, error in results:
+            if error is None:
+                sys.stdout.write("%8.3fs  %s -> %s\n" % (seconds, source, target))
+            else:
+                failed += 1
+                sys.stderr.write("%8.3fs  %s FAILED: %s\n" % (seconds, source, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    sys.stdout.write("Converted %d of %d files in %.3fs\n" % (len(pairs) - failed, len(pairs), time.time() - start))
+    return 1 if failed else 0
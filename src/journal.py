@@ -0,0 +1,410 @@
+# journal.py
+# A crash-safe on-disk journal of editing operations.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The journal is an append-only file of binary entries. A CHECKPOINT entry
+# holds the complete model, it starts a new file which replaces the journal
+# once it is on disk. It is followed by one entry per undo record added
+# (ADD), per undo and redo, and per structural operation (ACTION). SAVED marks
+# the point the model was last saved. Replaying the entries after the last
+# checkpoint recovers the work since then.
+#
+# A SNAPSHOT entry is written by autosave. It holds the model like a
+# checkpoint, but frames unchanged since the previous checkpoint or snapshot
+# refer to that frame by index instead of repeating its data. Recovery
+# starts from the last snapshot, so the entries before it need not be
+# replayed. Once the snapshots add up to more than the checkpoint, a new
+# checkpoint starts the file over. The undo history from before a snapshot
+# can't be recovered, so undoing or redoing one of its records is written
+# with the record, or causes a new snapshot for structural operations.
+#
+# Entries are queued by the GUI thread and encoded and written by a
+# background thread, which syncs the file to disk at most every
+# FLUSH_INTERVAL seconds. Each entry carries a CRC so a torn write at the end
+# of the file is detected and ignored when reading.
+
+import os
+import sys
+import time
+import zlib
+import array
+import struct
+import pickle
+import logging
+import threading
+from Queue import Queue, Empty
+from undo import Undo
+
+log = logging.getLogger("zoxel.journal")
+
+# File header
+_MAGIC = "ZXJ1"
+
+# Entry header: type, payload length, payload CRC32
+_ENTRY = struct.Struct("<BII")
+
+# Frame number preceding most payloads
+_FRAME = struct.Struct("<H")
+
+
+class Journal(object):
+
+    # Entry types
+    CHECKPOINT = 1
+    ADD = 2
+    UNDO = 3
+    REDO = 4
+    ACTION = 5
+    SAVED = 6
+    SNAPSHOT = 7
+
+    # Seconds between syncs to disk
+    FLUSH_INTERVAL = 0.2
+
+    @property
+    def filename(self):
+        return self._filename
+
+    # Start a new, empty journal in the given file
+    def __init__(self, filename):
+        self._filename = filename
+        # The journal of a previous session stays intact until our first
+        # checkpoint replaces it
+        self._file = open(filename, "ab")
+        self._queue = Queue()
+        # Entries written since the last checkpoint or snapshot
+        self._pending = 0
+        # Whether we took a snapshot since the last checkpoint, the undo
+        # records added since and if we need another snapshot
+        self._snapshot = False
+        self._recent = set()
+        self._stale = False
+        # Frames of the last checkpoint or snapshot, their encoded data by id
+        # and the model size, and the bytes written since the last checkpoint
+        self._frames = []
+        self._blocks = {}
+        self._size = None
+        self._checkpoint_size = 0
+        self._written = 0
+        self._thread = threading.Thread(target=self._run, name="zoxel-journal")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # True if there are changes since the last checkpoint or snapshot
+    @property
+    def pending(self):
+        return self._pending > 0
+
+    # True if the model must be snapshot to be recoverable
+    @property
+    def stale(self):
+        return self._stale
+
+    def add(self, frame, item):
+        self._pending += 1
+        if self._snapshot:
+            self._recent.add(item)
+        self._queue.put((self.ADD, frame, item))
+
+    def undo(self, frame, item=None):
+        self._history(self.UNDO, frame, item)
+
+    def redo(self, frame, item=None):
+        self._history(self.REDO, frame, item)
+
+    def _history(self, kind, frame, item):
+        self._pending += 1
+        if not self._snapshot or item is None or item in self._recent:
+            self._queue.put((kind, frame, None))
+        elif item.operation == Undo.SNAPSHOT:
+            self._stale = True
+        else:
+            # Replay won't have this record in its history
+            self._queue.put((kind, frame, item))
+
+    # A structural operation: the name and arguments of a VoxelData method
+    def action(self, frame, name, args):
+        self._pending += 1
+        self._queue.put((self.ACTION, frame, (name, args)))
+
+    def saved(self):
+        self._queue.put((self.SAVED, 0, None))
+
+    # Record the complete model. Everything before is no longer needed, so
+    # the file is started over.
+    def checkpoint(self, voxels):
+        self._pending = 0
+        self._snapshot = False
+        self._recent = set()
+        self._stale = False
+        self._queue.put((self.CHECKPOINT, 0, voxels.get_checkpoint()))
+
+    # Record the complete model, writing only the frames changed since the
+    # last checkpoint or snapshot
+    def snapshot(self, voxels):
+        self._pending = 0
+        self._snapshot = True
+        self._recent = set()
+        self._stale = False
+        self._queue.put((self.SNAPSHOT, 0, voxels.get_checkpoint()))
+
+    # Stop writing. With remove set the journal file is deleted, as there is
+    # nothing left to recover.
+    def close(self, remove=False):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if remove:
+            try:
+                os.remove(self._filename)
+            except OSError:
+                pass
+
+    def _run(self):
+        dirty = False
+        synced = time.time()
+        while True:
+            timeout = None
+            if dirty:
+                timeout = max(0, synced + self.FLUSH_INTERVAL - time.time())
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except Empty:
+                entry = False
+            # Write everything else that is waiting before we sync
+            while entry:
+                self._write(*entry)
+                try:
+                    entry = self._queue.get_nowait()
+                except Empty:
+                    break
+            if entry is None:
+                self._sync()
+                return
+            dirty = True
+            # Make what we have durable, even while more keeps coming
+            if time.time() - synced >= self.FLUSH_INTERVAL:
+                self._sync()
+                dirty = False
+                synced = time.time()
+
+    def _write(self, kind, frame, value):
+        if kind == self.SNAPSHOT and self._written > self._checkpoint_size:
+            kind = self.CHECKPOINT
+        if kind in (self.CHECKPOINT, self.SNAPSHOT):
+            payload = self._encode(value, kind == self.SNAPSHOT)
+        elif value is not None:
+            payload = _FRAME.pack(frame) + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        else:
+            payload = _FRAME.pack(frame)
+        entry = _ENTRY.pack(kind, len(payload), zlib.crc32(payload) & 0xffffffff)
+        try:
+            if kind == self.CHECKPOINT:
+                self._replace(entry, payload)
+            else:
+                self._file.write(entry)
+                self._file.write(payload)
+        except (IOError, OSError) as e:
+            log.warning("Could not write journal: %s", e)
+            # The next snapshot can't refer to frames we failed to write
+            self._frames = []
+        if kind == self.CHECKPOINT:
+            self._checkpoint_size = len(payload)
+            self._written = 0
+        else:
+            self._written += _ENTRY.size + len(payload)
+
+    # Start the file over with a checkpoint entry. The new file is written
+    # and synced next to the journal before it replaces it, so there is
+    # always a complete journal on disk.
+    def _replace(self, entry, payload):
+        temp = self._filename + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(_MAGIC)
+            f.write(entry)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        try:
+            try:
+                os.rename(temp, self._filename)
+            except OSError:
+                # Windows can't rename over an existing file
+                os.remove(self._filename)
+                os.rename(temp, self._filename)
+        finally:
+            self._file = open(self._filename, "ab")
+
+    # Encode a model for a checkpoint or snapshot. Frames we encoded before
+    # are not encoded again, in a snapshot they refer to the frame of the
+    # previous checkpoint or snapshot instead.
+    def _encode(self, data, snapshot):
+        width, height, depth, current, changed, frames = data
+        if (width, height, depth) != self._size:
+            self._size = (width, height, depth)
+            self._frames = []
+            self._blocks = {}
+        previous = dict((id(frame), i) for i, frame in enumerate(self._frames))
+        blocks = {}
+        items = []
+        for frame in frames:
+            key = id(frame)
+            if key not in blocks:
+                # Keep the frame with its data, so its id stays unique
+                blocks[key] = self._blocks.get(key) or (frame, _encode_frame(frame))
+            if snapshot and key in previous:
+                items.append(previous[key])
+            else:
+                items.append(blocks[key][1])
+        self._frames = list(frames)
+        self._blocks = blocks
+        return zlib.compress(pickle.dumps((width, height, depth, current, changed, items), pickle.HIGHEST_PROTOCOL))
+
+    def _sync(self):
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except (IOError, OSError) as e:
+            log.warning("Could not write journal: %s", e)
+
+
+def _encode_frame(frame):
+    # Lazy frames are kept as they are, or decoded here off the GUI thread
+    if hasattr(frame, "load"):
+        if frame.packed is not None:
+            return frame.packed
+        frame = frame.load()
+    values = array.array("I")
+    for plane in frame:
+        for column in plane:
+            values.extend(column)
+    return values.tostring()
+
+
+# Return the model of a checkpoint, or of a snapshot taken after the given
+# model, with the frames still encoded
+def _decode_model(payload, previous=None):
+    width, height, depth, current, changed, items = pickle.loads(zlib.decompress(payload))
+    blocks = []
+    for item in items:
+        if isinstance(item, int):
+            if previous is None or (width, height, depth) != previous[:3]:
+                raise ValueError("Snapshot without checkpoint")
+            item = previous[5][item]
+        blocks.append(item)
+    return width, height, depth, current, changed, blocks
+
+
+def _decode_checkpoint(model):
+    width, height, depth, current, changed, blocks = model
+    frames = []
+    for block in blocks:
+        if isinstance(block, tuple):
+            # A frame of a loaded file, see LazyFrame.packed
+            block, typecode, palette = block
+            values = array.array(typecode)
+            values.fromstring(zlib.decompress(block))
+            if sys.byteorder == "big":
+                values.byteswap()
+            values = [palette[v] for v in values]
+        else:
+            values = array.array("I")
+            values.fromstring(block)
+            values = values.tolist()
+        frames.append([[values[(x * height + y) * depth:(x * height + y + 1) * depth] for y in xrange(height)]
+                       for x in xrange(width)])
+    return width, height, depth, current, changed, frames
+
+
+# Return the model of the last checkpoint or snapshot in the given journal
+# file, with its frames still encoded, and the (type, payload) entries after
+# it. Reading stops at the first incomplete or corrupt entry. Returns None
+# if there is nothing to read.
+def read(filename):
+    model = None
+    entries = []
+    try:
+        with open(filename, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                return None
+            while True:
+                header = f.read(_ENTRY.size)
+                if len(header) < _ENTRY.size:
+                    break
+                kind, length, crc = _ENTRY.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                if kind == Journal.CHECKPOINT:
+                    model = _decode_model(payload)
+                    entries = []
+                elif kind == Journal.SNAPSHOT:
+                    model = _decode_model(payload, model)
+                    entries = []
+                else:
+                    entries.append((kind, payload))
+    except (IOError, EOFError, ValueError, zlib.error, pickle.UnpicklingError):
+        return None
+    if model is None:
+        return None
+    return model, entries
+
+
+# True if the journal file holds unsaved changes which can be recovered
+def recoverable(filename):
+    data = read(filename)
+    if data is None:
+        return False
+    model, entries = data
+    changed = model[4]
+    for kind, _ in entries:
+        changed = kind != Journal.SAVED
+    return changed
+
+
+# Rebuild the model in voxels from a journal file, replaying its undo
+# history which is cleared afterwards. Returns False if there was nothing to
+# recover.
+def replay(filename, voxels):
+    data = read(filename)
+    if data is None:
+        return False
+    model, entries = data
+    voxels.journal = None
+    voxels.restore_checkpoint(_decode_checkpoint(model))
+    for kind, payload in entries:
+        if kind == Journal.SAVED:
+            continue
+        frame = _FRAME.unpack_from(payload)[0]
+        if frame != voxels.get_frame_number():
+            voxels.select_frame(frame)
+        if kind == Journal.ADD:
+            voxels.replay_item(pickle.loads(payload[_FRAME.size:]))
+        elif kind in (Journal.UNDO, Journal.REDO) and len(payload) > _FRAME.size:
+            # A record from before the snapshot we started from
+            voxels.apply_item(pickle.loads(payload[_FRAME.size:]), kind == Journal.UNDO)
+        elif kind == Journal.UNDO:
+            voxels.undo()
+        elif kind == Journal.REDO:
+            voxels.redo()
+        elif kind == Journal.ACTION:
+            name, args = pickle.loads(payload[_FRAME.size:])
+            getattr(voxels, name)(*args)
+    # The recovered history can't be journaled again, the next journal only
+    # knows the model it starts from
+    voxels.clear_undo()
+    voxels.changed = True
+    return True
@@ -0,0 +1,92 @@
+# loaders.py
+# Find the file handler for a file from its contents and load streams.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# File handlers which can load may declare:
+#   magic               a tuple of the byte strings their files can start with
+#   load_stream(f)      load from a file-like object, only calling f.read()
+# Handlers without load_stream are given the filename.
+
+import os
+
+# Bytes we read from the start of a file to detect its format
+MAGIC_SIZE = 16
+
+
+# A stream which returns the header we already read from a stream, then the
+# rest of that stream
+class _Prefixed(object):
+
+    def __init__(self, header, stream):
+        self._header = header
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._header:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            data = self._header + self._stream.read()
+            self._header = ""
+            return data
+        data = self._header[:size]
+        self._header = self._header[size:]
+        if len(data) < size:
+            data += self._stream.read(size - len(data))
+        return data
+
+
+# Return the handler that can load a file starting with header. Handlers
+# whose magic matches win over those which only match the extension of the
+# filename, if given. Returns None if none matches.
+def find_loader(handlers, header, filename=None):
+    handlers = [h for h in handlers if hasattr(h, "load")]
+    extension = os.path.splitext(filename or "")[1].lower()
+    sniffed = [h for h in handlers if any(header.startswith(m) for m in getattr(h, "magic", ()))]
+    named = [h for h in handlers if extension and h.filetype[1:].lower() == extension]
+    for handler in sniffed:
+        if handler in named:
+            return handler
+    if sniffed:
+        return sniffed[0]
+    if named:
+        return named[0]
+    return None
+
+
+# Read the header of a stream. Returns the header and a stream to read the
+# whole file from, including the header.
+def sniff(stream):
+    header = stream.read(MAGIC_SIZE)
+    try:
+        stream.seek(-len(header), os.SEEK_CUR)
+        return header, stream
+    except (AttributeError, IOError):
+        return header, _Prefixed(header, stream)
+
+
+# Load a file, using the handler detected from its contents unless one is
+# given. Returns the handler used.
+def load_file(handlers, filename, handler=None):
+    with open(filename, "rb") as stream:
+        if handler is None:
+            header, stream = sniff(stream)
+            handler = find_loader(handlers, header, filename)
+            if handler is None:
+                raise Exception("Unknown file format")
+        if hasattr(handler, "load_stream"):
+            handler.load_stream(stream)
+        else:
+            handler.load(filename)
+    return handler
@@ -30,6 +30,12 @@ import sys
 import copy
 from constants import ZOXEL_TAG
 import platform
+import threading
+import journal
+import loaders
+
+# Milliseconds between autosaves
+AUTOSAVE_INTERVAL = 30000
 
 
 class MainWindow(QtGui.QMainWindow):
@@ -58,6 +64,8 @@ class MainWindow(QtGui.QMainWindow):
         self.user_plugins_path = os.path.join(appdata, "Zoxel", "plugins")
         if not os.path.isdir(self.user_plugins_path):
             os.makedirs(self.user_plugins_path, 16877)
+        # Journal of our changes, to recover them after a crash
+        self.journal_path = os.path.join(appdata, "Zoxel", "journal.bin")
         QtCore.QCoreApplication.setOrganizationName("Zoxel")
         QtCore.QCoreApplication.setApplicationName("Zoxel")
         QtCore.QSettings.setDefaultFormat(QtCore.QSettings.IniFormat)
@@ -68,6 +76,12 @@ class MainWindow(QtGui.QMainWindow):
         self._timer = QtCore.QTimer(self)
         self.connect(self._timer, QtCore.SIGNAL("timeout()"), self.on_animation_tick)
         self._anim_speed = 200
+        # Our autosave timer, snapshots the model to the journal
+        self._autosave_timer = QtCore.QTimer(self)
+        self.connect(self._autosave_timer, QtCore.SIGNAL("timeout()"), self.autosave)
+        self._autosave_timer.start(AUTOSAVE_INTERVAL)
+        # Whether the undo group of a drag is open
+        self._drag_group = False
         # Load our state if possible
         self.load_state()
         # Create our GL Widget
@@ -83,7 +97,10 @@ class MainWindow(QtGui.QMainWindow):
         height = self.get_setting("default_model_height")
         depth = self.get_setting("default_model_depth")
         if width:
+            # Not something the user should be able to undo
+            self.display.voxels.disable_undo()
             self.resize_voxels(width, height, depth)
+            self.display.voxels.enable_undo()
             # Resize is detected as a change, discard changes
             self.display.voxels.saved()
         # Create our palette widget
@@ -104,6 +121,21 @@ class MainWindow(QtGui.QMainWindow):
             self.ui.action_voxel_edges.setChecked(value)
         else:
             self.ui.action_voxel_edges.setChecked(self.display.voxel_edges)
+        value = self.get_setting("display_statistics")
+        if value is not None:
+            self.display.statistics = value
+            self.ui.action_statistics.setChecked(value)
+        value = self.get_setting("instanced_rendering")
+        if value:
+            self.display.render_mode = GLWidget.RENDER_INSTANCED
+            self.ui.action_instanced_rendering.setChecked(True)
+        # Undo history limits, the budget is given in megabytes
+        budget = self.get_setting("undo_budget")
+        if budget is None:
+            budget = 256
+        self.display.voxels.set_undo_limits(budget * 1024 * 1024 if budget else None,
+                                            self.get_setting("undo_depth") or None,
+                                            bool(self.get_setting("undo_spill")))
         value = self.get_setting("occlusion")
         if value is None:
             value = True
@@ -159,6 +191,23 @@ class MainWindow(QtGui.QMainWindow):
         self.display.voxel_edges = self.ui.action_voxel_edges.isChecked()
         self.set_setting("voxel_edges", self.display.voxel_edges)
 
+    @QtCore.Slot()
+    def on_action_statistics_triggered(self):
+        self.display.statistics = self.ui.action_statistics.isChecked()
+        self.set_setting("display_statistics", self.display.statistics)
+
+    @QtCore.Slot()
+    def on_action_instanced_rendering_triggered(self):
+        if self.ui.action_instanced_rendering.isChecked():
+            self.display.render_mode = GLWidget.RENDER_INSTANCED
+            if self.display.render_mode != GLWidget.RENDER_INSTANCED:
+                QtGui.QMessageBox.warning(self, "Instanced Rendering",
+                                          "Your OpenGL driver does not support instanced rendering.")
+                self.ui.action_instanced_rendering.setChecked(False)
+        else:
+            self.display.render_mode = GLWidget.RENDER_ARRAYS
+        self.set_setting("instanced_rendering", self.display.render_mode == GLWidget.RENDER_INSTANCED)
+
     @QtCore.Slot()
     def on_action_zoom_in_triggered(self):
         self.display.zoom_in()
@@ -177,6 +226,7 @@ class MainWindow(QtGui.QMainWindow):
         self._filetype = None
         self.display.clear()
         self.display.voxels.saved()
+        self.checkpoint()
         self.update_caption()
         self.refresh_actions()
 
@@ -203,14 +253,20 @@ class MainWindow(QtGui.QMainWindow):
     @QtCore.Slot()
     def on_action_undo_triggered(self):
         # Undo
+        self.end_drag_group()
         self.display.voxels.undo()
         self.display.refresh()
+        # Frames may have been added or removed
+        self.refresh_actions()
 
     @QtCore.Slot()
     def on_action_redo_triggered(self):
         # Redo
+        self.end_drag_group()
         self.display.voxels.redo()
         self.display.refresh()
+        # Frames may have been added or removed
+        self.refresh_actions()
 
     @QtCore.Slot()
     def on_action_resize_triggered(self):
@@ -497,28 +553,43 @@ class MainWindow(QtGui.QMainWindow):
         if not tool:
             return
         data = self.display.target
-        tool.on_mouse_click(data)
+        with self.display.stats.timer("tool"):
+            tool.on_mouse_click(data)
 
     def on_tool_drag_start(self):
+        # Everything a drag changes is undone in one step
+        self.end_drag_group()
+        self.display.voxels.begin_undo_group()
+        self._drag_group = True
         tool = self.get_active_tool()
         if not tool:
             return
         data = self.display.target
-        tool.on_drag_start(data)
+        with self.display.stats.timer("tool"):
+            tool.on_drag_start(data)
 
     def on_tool_drag(self):
         tool = self.get_active_tool()
         if not tool:
             return
         data = self.display.target
-        tool.on_drag(data)
+        with self.display.stats.timer("tool"):
+            tool.on_drag(data)
 
     def on_tool_drag_end(self):
         tool = self.get_active_tool()
-        if not tool:
-            return
-        data = self.display.target
-        tool.on_drag_end(data)
+        if tool:
+            data = self.display.target
+            with self.display.stats.timer("tool"):
+                tool.on_drag_end(data)
+        self.end_drag_group()
+
+    # Close the undo group of a drag, if open. A drag cut short, by a dialog
+    # or losing the focus, never reports its end.
+    def end_drag_group(self):
+        if self._drag_group:
+            self._drag_group = False
+            self.display.voxels.end_undo_group()
 
     # Confirm if user wants to save before doing something drastic.
     # returns True if we should continue
@@ -560,8 +631,89 @@ class MainWindow(QtGui.QMainWindow):
             if not self.confirm_save():
                 event.ignore()
                 return
+        # Nothing to recover after a clean exit
+        if self.display.voxels.journal is not None:
+            self.display.voxels.journal.close(True)
+            self.display.voxels.journal = None
         event.accept()
 
+    # Offer to recover the changes of a previous session which didn't exit
+    # cleanly, then start journaling this one
+    def recover(self):
+        voxels = self.display.voxels
+        if journal.recoverable(self.journal_path):
+            responce = QtGui.QMessageBox.question(self, "Recover changes?",
+                                                  "Zoxel did not exit properly last time. "
+                                                  "Do you want to recover your unsaved changes?",
+                                                  buttons=(QtGui.QMessageBox.Yes | QtGui.QMessageBox.No),
+                                                  defaultButton=QtGui.QMessageBox.Yes)
+            if responce == QtGui.QMessageBox.Yes:
+                try:
+                    journal.replay(self.journal_path, voxels)
+                except Exception as Ex:
+                    QtGui.QMessageBox.warning(self, "Recovery Failed", str(Ex))
+                    voxels.clear()
+                self.display.build_grids()
+                self.display.reset_camera()
+                self.display.refresh()
+                self.update_caption()
+                self.refresh_actions()
+        try:
+            voxels.journal = journal.Journal(self.journal_path)
+        except IOError as Ex:
+            QtGui.QMessageBox.warning(self, "Journal Failed", str(Ex))
+            return
+        self.checkpoint()
+
+    # Write the complete model to our journal, the history before it can no
+    # longer be recovered
+    def checkpoint(self):
+        if self.display.voxels.journal is not None:
+            self.display.voxels.journal.checkpoint(self.display.voxels)
+
+    # Write the frames changed since the last autosave to our journal, so
+    # recovery doesn't need to replay the changes before
+    def autosave(self):
+        voxels = self.display.voxels
+        if voxels.journal is not None and voxels.journal.pending:
+            voxels.journal.snapshot(voxels)
+
+    # Run function on a worker thread, showing a progress dialog which keeps
+    # the window responsive but blocks editing. The animation and autosave
+    # timers, which use the model, are stopped meanwhile. function must not
+    # use the GUI. Exceptions are raised here.
+    def run_in_background(self, message, function, *args):
+        result = []
+
+        def run():
+            try:
+                function(*args)
+            except Exception as Ex:
+                result.append(Ex)
+        timers = [timer for timer in (self._timer, self._autosave_timer) if timer.isActive()]
+        for timer in timers:
+            timer.stop()
+        try:
+            thread = threading.Thread(target=run, name="zoxel-worker")
+            thread.start()
+            # Quick jobs don't need the dialog
+            thread.join(0.1)
+            if thread.is_alive():
+                progress = QtGui.QProgressDialog(message, None, 0, 0, self)
+                progress.setWindowTitle("Zoxel")
+                progress.setWindowModality(QtCore.Qt.WindowModal)
+                progress.setMinimumDuration(0)
+                progress.show()
+                while thread.is_alive():
+                    QtGui.QApplication.processEvents(QtCore.QEventLoop.AllEvents, 50)
+                    thread.join(0.05)
+                progress.close()
+        finally:
+            for timer in timers:
+                timer.start()
+        if result:
+            raise result[0]
+
     # Save our state
     def save_state(self):
         try:
@@ -638,9 +790,12 @@ class MainWindow(QtGui.QMainWindow):
                 if filetype == ourtype:
                     handler = exporter
 
-        # Call the save handler
+        # Call the save handler, on a worker thread if it doesn't use the GUI
         try:
-            handler.save(filename)
+            if getattr(handler, "threadsafe", False):
+                self.run_in_background("Saving %s ..." % os.path.basename(filename), handler.save, filename)
+            else:
+                handler.save(filename)
             saved = True
         except Exception as Ex:
             QtGui.QMessageBox.warning(self, "Save Failed", str(Ex))
@@ -684,34 +839,39 @@ class MainWindow(QtGui.QMainWindow):
                                                                dir=directory, selectedFilter="All Files (*)")
         if not filename:
             return
-        if filetype == "All Files (*)":
-            filetype = None
-            for importer in handlers:
-                if filename.endswith(importer.filetype[1:]):
-                    filetype = "%s (%s)" % (importer.description, importer.filetype)
-                    break
-        if filetype is None:
-            return
 
         # Remember the location
         directory = os.path.dirname(filename)
         self.set_setting("default_directory", directory)
 
-        # Find the handler
-        for importer in handlers:
-            ourtype = "%s (%s)" % (importer.description, importer.filetype)
-            if filetype == ourtype:
-                handler = importer
-                self._last_file_handler = handler
+        # Find the handler, from the contents of the file unless the user
+        # picked a type
+        if filetype == "All Files (*)":
+            try:
+                with open(filename, "rb") as f:
+                    handler = loaders.find_loader(handlers, f.read(loaders.MAGIC_SIZE), filename)
+            except IOError as Ex:
+                QtGui.QMessageBox.warning(self, "Could not load file", str(Ex))
+                return
+            if handler is None:
+                QtGui.QMessageBox.warning(self, "Could not load file", "Unknown file format.")
+                return
+        else:
+            for importer in handlers:
+                if filetype == "%s (%s)" % (importer.description, importer.filetype):
+                    handler = importer
+        if handler is None:
+            return
+        self._last_file_handler = handler
 
         # Load the file
         self.display.clear()
         self.display.voxels.disable_undo()
         self._filename = None
         try:
-            handler.load(filename)
+            loaders.load_file(handlers, filename, handler)
             self._filename = filename
-            self._filetype = filetype
+            self._filetype = "%s (%s)" % (handler.description, handler.filetype)
         except Exception as Ex:
             self.display.voxels.enable_undo()
             QtGui.QMessageBox.warning(self, "Could not load file", str(Ex))
@@ -719,6 +879,7 @@ class MainWindow(QtGui.QMainWindow):
         self.display.build_grids()
         # self.display.voxels.resize()
         self.display.voxels.saved()
+        self.checkpoint()
         self.display.reset_camera()
         self.update_caption()
         self.refresh_actions()
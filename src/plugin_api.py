@@ -19,6 +19,8 @@ from PySide import QtGui
 
 class PluginManager(object):
     plugins = []
+    # The API class passed to plugins, PluginAPI unless we run without GUI
+    api_class = None
 
 
 class PluginAPI(object):
@@ -69,6 +71,12 @@ class PluginAPI(object):
     def warning(self, message):
         QtGui.QMessageBox.warning(self.mainwindow, "Warning", message)
 
+    # Ask the user a yes or no question, returns True for yes
+    def question(self, title, message):
+        ret = QtGui.QMessageBox.question(self.mainwindow, title, message,
+                                         QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+        return ret == QtGui.QMessageBox.Yes
+
 # Plugin registration
 # Plugins call this function to register with the system.  A plugin
 # should pass the class which will be instaniated by the application,
@@ -78,7 +86,7 @@ class PluginAPI(object):
 def register_plugin(plugin_class, name, version):
     # Create an instance of the API to send to the plugin
     # Plugins access the main app via this API instance
-    api = PluginAPI()
+    api = (PluginManager.api_class or PluginAPI)()
     plugin = plugin_class(api)
     PluginManager.plugins.append(plugin)
     return api
@@ -0,0 +1,196 @@
+# io_gltf.py
+# Export meshes to binary glTF 2.0 (.glb)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import sys
+import json
+import array
+import struct
+from plugin_api import register_plugin
+from constants import ZOXEL_TAG
+from quads import quads, NORMALS
+
+# https://registry.khronos.org/glTF/specs/2.0/glTF-2.0.html
+
+# Component types and buffer view targets
+_UNSIGNED_SHORT = 5123
+_UNSIGNED_INT = 5125
+_FLOAT = 5126
+_ARRAY_BUFFER = 34962
+_ELEMENT_ARRAY_BUFFER = 34963
+
+# glTF vertex colors are linear, ours are sRGB
+_LINEAR = [int(round(65535 * (c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4)))
+           for c in (i / 255.0 for i in xrange(256))]
+
+
+# Array contents in little endian byte order
+def _to_le(values):
+    if sys.byteorder == "big":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+class GltfFile(object):
+
+    # Description of file type
+    description = "glTF Binary Files"
+
+    # File type filter
+    filetype = "*.glb"
+
+    # Saves without the GUI, so can run on a worker thread
+    threadsafe = True
+
+    # Merge neighbouring faces of the same color into larger quads
+    greedy = False
+
+    # Seconds each animation frame is shown
+    FRAME_TIME = 0.2
+
+    def __init__(self, api):
+        self.api = api
+        # Register our exporter
+        self.api.register_file_handler(self)
+
+    # Called when we need to save. Should raise an exception if there is a
+    # problem saving.
+    def save(self, filename):
+        # grab the voxel data
+        voxels = self.api.get_voxel_data()
+        frames = voxels.get_frame_count()
+
+        self._chunks = []
+        self._length = 0
+        gltf = {"asset": {"version": "2.0", "generator": "Zoxel Version " + ZOXEL_TAG},
+                "scene": 0, "scenes": [{"nodes": range(frames)}], "nodes": [], "meshes": [],
+                "materials": [{"pbrMetallicRoughness": {"metallicFactor": 0.0, "roughnessFactor": 1.0}}],
+                "accessors": [], "bufferViews": []}
+
+        # One mesh per frame
+        for i in xrange(frames):
+            node = {"name": "frame%d" % (i + 1)}
+            if i > 0:
+                # Only the first frame is visible unless animated
+                node["scale"] = [0.0, 0.0, 0.0]
+            primitive = self._mesh(gltf, voxels, voxels.get_frame(i))
+            if primitive is not None:
+                node["mesh"] = len(gltf["meshes"])
+                gltf["meshes"].append({"name": node["name"], "primitives": [primitive]})
+            gltf["nodes"].append(node)
+
+        # Show one frame after the other by scaling the others to nothing
+        if frames > 1:
+            times = self._accessor(gltf, array.array("f", [i * self.FRAME_TIME for i in xrange(frames)]),
+                                   "SCALAR", None, True)
+            samplers = []
+            channels = []
+            for i in xrange(frames):
+                scales = array.array("f")
+                for j in xrange(frames):
+                    scales.extend([float(i == j)] * 3)
+                channels.append({"sampler": len(samplers), "target": {"node": i, "path": "scale"}})
+                samplers.append({"input": times, "interpolation": "STEP",
+                                 "output": self._accessor(gltf, scales, "VEC3", None)})
+            gltf["animations"] = [{"name": "frames", "channels": channels, "samplers": samplers}]
+
+        if not gltf["meshes"]:
+            del gltf["meshes"]
+        if self._length:
+            gltf["buffers"] = [{"byteLength": self._length}]
+        else:
+            del gltf["accessors"]
+            del gltf["bufferViews"]
+        content = json.dumps(gltf, separators=(",", ":"))
+        content += " " * (-len(content) % 4)
+        binary = "".join(self._chunks)
+
+        data = [struct.pack("<II", len(content), 0x4e4f534a), content]
+        if binary:
+            data += [struct.pack("<II", len(binary), 0x004e4942), binary]
+        header = struct.pack("<4sII", "glTF", 2, 12 + sum(len(d) for d in data))
+
+        # Write the file in one go
+        with open(filename, "wb") as f:
+            f.write(header + "".join(data))
+        del self._chunks
+
+    # Add the buffers of the mesh of a frame, returns its primitive or None
+    # if the frame is empty
+    def _mesh(self, gltf, voxels, frame):
+        index = {}
+        positions = array.array("f")
+        normals = array.array("f")
+        colors = array.array("H")
+        indices = array.array("I")
+        for color, direction, corners in quads(frame, voxels.width, voxels.height, voxels.depth, self.greedy):
+            quad = []
+            for point in corners:
+                # Faces only share vertices with the same normal and color
+                key = (point, direction, color)
+                i = index.get(key)
+                if i is None:
+                    i = index[key] = len(index)
+                    positions.extend(voxels.voxel_to_world(*point))
+                    normals.extend(NORMALS[direction])
+                    colors.extend((_LINEAR[(color & 0xff000000) >> 24], _LINEAR[(color & 0xff0000) >> 16],
+                                   _LINEAR[(color & 0xff00) >> 8], 0xffff))
+                quad.append(i)
+            indices.extend((quad[0], quad[1], quad[2], quad[0], quad[2], quad[3]))
+        if not indices:
+            return None
+        if len(index) < 0xffff:
+            indices = array.array("H", indices)
+        return {"attributes": {"POSITION": self._accessor(gltf, positions, "VEC3", _ARRAY_BUFFER, True),
+                               "NORMAL": self._accessor(gltf, normals, "VEC3", _ARRAY_BUFFER),
+                               "COLOR_0": self._accessor(gltf, colors, "VEC4", _ARRAY_BUFFER)},
+                "indices": self._accessor(gltf, indices, "SCALAR", _ELEMENT_ARRAY_BUFFER),
+                "material": 0}
+
+    # Append an array to our buffer with its own buffer view, returns the
+    # index of its new accessor
+    def _accessor(self, gltf, values, kind, target, bounds=False):
+        components = {"SCALAR": 1, "VEC3": 3, "VEC4": 4}[kind]
+        data = _to_le(values)
+        view = {"buffer": 0, "byteOffset": self._length, "byteLength": len(data)}
+        if target is not None:
+            view["target"] = target
+        accessor = {"bufferView": len(gltf["bufferViews"]), "count": len(values) // components, "type": kind,
+                    "componentType": {"f": _FLOAT, "H": _UNSIGNED_SHORT, "I": _UNSIGNED_INT}[values.typecode]}
+        if values.typecode == "H" and target == _ARRAY_BUFFER:
+            accessor["normalized"] = True
+        if bounds:
+            accessor["min"] = [min(values[k::components]) for k in xrange(components)]
+            accessor["max"] = [max(values[k::components]) for k in xrange(components)]
+        # Keep everything aligned to 4 bytes
+        data += "\0" * (-len(data) % 4)
+        self._chunks.append(data)
+        self._length += len(data)
+        gltf["bufferViews"].append(view)
+        gltf["accessors"].append(accessor)
+        return len(gltf["accessors"]) - 1
+
+
+# Exports merged faces for smaller files
+class GltfMergedFile(GltfFile):
+
+    # Description of file type
+    description = "glTF Binary Files (merged faces)"
+
+    greedy = True
+
+
+register_plugin(GltfFile, "glTF exporter", "1.0")
+register_plugin(GltfMergedFile, "glTF merged faces exporter", "1.0")
@@ -13,10 +13,17 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import sys
+import array
+import struct
 from plugin_api import register_plugin
+from quantize import median_cut
 
 # http://voxel.codeplex.com/wikipage?title=VOX%20Format&referringTitle=MagicaVoxel%20Editor
 
+# Chunk content and children size
+_UINT32X2 = struct.Struct("<2I")
+
 
 class MagicaFile(object):
 
@@ -26,6 +33,12 @@ class MagicaFile(object):
     # File type filter
     filetype = "*.vox"
 
+    # Saves without the GUI, so can run on a worker thread
+    threadsafe = True
+
+    # Files start with
+    magic = ("VOX ",)
+
     def __init__(self, api):
         self.api = api
         # Register our exporter
@@ -68,129 +81,256 @@ class MagicaFile(object):
                                 0xffeeeeee, 0xffdddddd, 0xffbbbbbb, 0xffaaaaaa, 0xff888888, 0xff777777, 0xff555555,
                                 0xff444444, 0xff222222, 0xff111111]
 
-    # Helper function to read/write uint32
-    def uint32(self, f, value=None):
-        if value is not None:
-            # Write
-            data = bytearray()
-            data.append((value & 0xff))
-            data.append((value & 0xff00) >> 8)
-            data.append((value & 0xff0000) >> 16)
-            data.append((value & 0xff000000) >> 24)
-            f.write(data)
-        else:
-            # Read
-            x = bytearray(f.read(4))
-            if len(x) == 4:
-                return x[0] | x[1] << 8 | x[2] << 16 | x[3] << 24
-            return 0
+    # MagicaVoxel models can't be larger than this along any axis
+    MAX_SIZE = 256
+
+    # Number of palette entries we can use, index 0 is empty
+    MAX_COLORS = 255
 
     def save(self, filename):
         # grab the voxel data
         voxels = self.api.get_voxel_data()
+        data = voxels.get_frame(voxels.get_frame_number())
+        # MagicaVoxel's z axis is up, our y axis
+        width, depth, height = voxels.width, voxels.depth, voxels.height
+
+        # Palette entries in order of first use, reduced to the palette size if needed
+        histogram = {}
+        palette = []
+        for z in xrange(height):
+            for y in xrange(depth):
+                for x in xrange(width):
+                    vox = data[x][z][y]
+                    if vox:
+                        if vox not in histogram:
+                            histogram[vox] = 0
+                            palette.append(vox)
+                        histogram[vox] += 1
+        if len(palette) > self.MAX_COLORS:
+            palette, mapping = median_cut(histogram, self.MAX_COLORS)
+        else:
+            mapping = dict((vox, i) for i, vox in enumerate(palette))
+        paletteChunk = array.array("I", [(c & 0xff000000) >> 24 | (c & 0x00ff0000) >> 8 |
+                                         (c & 0x0000ff00) << 8 | 0xff000000 for c in palette])
+        paletteChunk.extend([0xffffffff] * (256 - len(paletteChunk)))
+
+        # Split large models into tiles of at most MAX_SIZE voxels along each axis
+        size = self.MAX_SIZE
+        chunks = []
+        tiles = []
+        for tz in xrange(0, height, size):
+            for ty in xrange(0, depth, size):
+                for tx in xrange(0, width, size):
+                    sx = min(size, width - tx)
+                    sy = min(size, depth - ty)
+                    sz = min(size, height - tz)
+                    voxelChunk = array.array("I")
+                    for z in xrange(sz):
+                        for y in xrange(sy):
+                            for x in xrange(sx):
+                                vox = data[tx + x][tz + z][ty + y]
+                                if vox != 0:
+                                    voxelChunk.append((mapping[vox] + 1) << 24 | z << 16 | y << 8 | x)
+                    chunks.append(_chunk("SIZE", _to_le(array.array("I", [sx, sy, sz]))))
+                    chunks.append(_chunk("XYZI", _to_le(array.array("I", [len(voxelChunk)])) + _to_le(voxelChunk)))
+                    # Tiles are placed by the position of their center
+                    tiles.append((tx + sx // 2 - width // 2, ty + sy // 2 - depth // 2, tz + sz // 2 - height // 2))
+        if len(tiles) > 1:
+            chunks += _scene(tiles)
+        chunks.append(_chunk("RGBA", _to_le(paletteChunk)))
 
-        data = [0x20584f56, 150, 0x4e49414d, 0]
-        sizeChunk = [0x455a4953, 12, 0, voxels.width, voxels.depth, voxels.height]
-
-        voxelChunk = []
-        paletteChunk = [0x41424752, 1024, 0]
-        helpPalette = {}
-        for z in xrange(voxels.height):
-            for y in xrange(voxels.depth):
-                for x in xrange(voxels.width):
-                    vox = voxels.get(x, z, y)
-                    if vox != 0:
-                        if vox not in helpPalette:
-                            r = (vox & 0xff000000) >> 24
-                            g = (vox & 0x00ff0000) >> 16
-                            b = (vox & 0x0000ff00) >> 8
-                            paletteChunk.append(r | g << 8 | b << 16 | 0xff << 24)
-                            helpPalette[vox] = len(paletteChunk) - 3
-                        voxelChunk.append(((helpPalette[vox]) << 24) | (z << 16) | (y << 8) | x)
-        while len(paletteChunk) < 259:
-            paletteChunk.append(0xffffffff)
-        data.append(1076 + 4 * len(voxelChunk))
-        data += sizeChunk
-        data += [0x495a5958, 4 * len(voxelChunk) + 4, 0, len(voxelChunk)]
-        data += voxelChunk
-        data += paletteChunk
-
-        # Open our file
-        f = open(filename, "wb")
-        for i in data:
-            self.uint32(f, i)
-
-        # Tidy up
-        f.close()
+        children = "".join(chunks)
+        header = "VOX " + _to_le(array.array("I", [150])) + _chunk("MAIN", "", len(children))
+
+        # Write the file in one go
+        with open(filename, "wb") as f:
+            f.write(header + children)
 
     def load(self, filename):
+        with open(filename, "rb") as f:
+            self.load_stream(f)
+
+    def load_stream(self, f):
         # grab the voxel data
         voxels = self.api.get_voxel_data()
 
-        # Open our file
-        f = open(filename, "rb")
+        # Read our file
+        data = f.read()
 
-        meta = f.read(4)
-        if meta != "VOX ":
+        if data[:4] != "VOX ":
             raise Exception("Expected Magica Voxel header not found")
 
-        version = self.uint32(f)
-
-        mainChunkId = f.read(4)
-        if mainChunkId != "MAIN":
+        if data[8:12] != "MAIN":
             raise Exception("Didn't found main Chunk as expected")
 
-        mainChunkSize = self.uint32(f)
-        mainChunkChildSize = self.uint32(f)
+        mainChunkSize, mainChunkChildSize = _UINT32X2.unpack_from(data, 12)
 
         chunkPointer = 20 + mainChunkSize
-        sizeBegin = voxelBegin = paletteBegin = paletteLength = -1
+        models = []
+        nodes = {}
+        palette = self.default_palette
 
-        while chunkPointer < 20 + mainChunkSize + mainChunkChildSize:
-            f.seek(chunkPointer)
-            chunkId = f.read(4)
-            chunkSize = self.uint32(f)
-            chunkChildSize = self.uint32(f)
+        while chunkPointer + 12 <= min(20 + mainChunkSize + mainChunkChildSize, len(data)):
+            chunkId = data[chunkPointer:chunkPointer + 4]
+            chunkSize, chunkChildSize = _UINT32X2.unpack_from(data, chunkPointer + 4)
+            begin = chunkPointer + 12
             if chunkId == "SIZE":
-                sizeBegin = chunkPointer + 12
-            elif chunkId == "XYZI":
-                voxelBegin = chunkPointer + 12
+                models.append([struct.unpack_from("<3I", data, begin), None])
+            elif chunkId == "XYZI" and models:
+                # One byte each for x, y, z and the palette index
+                voxelCount = struct.unpack_from("<I", data, begin)[0]
+                models[-1][1] = bytearray(data[begin + 4:begin + 4 + voxelCount * 4])
             elif chunkId == "RGBA":
-                paletteBegin = chunkPointer + 12
-                paletteLength = chunkSize
+                palette = _from_le(data[begin:begin + chunkSize // 4 * 4])
+            elif chunkId in ("nTRN", "nGRP", "nSHP"):
+                node = _Reader(data, begin)
+                nodes[node.int32()] = (chunkId, node)
             chunkPointer += 12 + chunkSize + chunkChildSize
-        if sizeBegin == -1 or voxelBegin == -1:
+        models = [model for model in models if model[1] is not None]
+        if not models:
             raise Exception("missing chunks")
 
-        # read size chunk
-        f.seek(sizeBegin)
-        x = self.uint32(f)
-        y = self.uint32(f)
-        z = self.uint32(f)
-        voxels.resize(x, z, y)
+        # Our colors for each palette index, index i refers to palette entry i - 1
+        colors = []
+        for i in xrange(256):
+            c = palette[i - 1] if i - 1 < len(palette) else 0xffffffff
+            colors.append((c & 0x000000ff) << 24 | (c & 0x0000ff00) << 8 | (c & 0x00ff0000) >> 8 | 0xff)
 
-        # read palette chunk
-        palette = []
-        if paletteBegin == -1 or paletteLength == -1:
-            palette = self.default_palette
+        if nodes:
+            # A scene, merge all its models into one
+            instances = []
+            try:
+                self._walk(nodes, 0, (0, 0, 0), instances)
+            except (struct.error, KeyError, ValueError) as Ex:
+                raise Exception("Invalid scene graph in MagicaVoxel file (%s)" % Ex)
+            instances = [(models[m], offset) for m, offset in instances if m < len(models)]
+            if not instances:
+                raise Exception("Empty scene in MagicaVoxel file")
+            # Position of each model's first voxel, models are placed by their center
+            placed = []
+            for (msize, records), (ox, oy, oz) in instances:
+                placed.append((msize, records, (ox - msize[0] // 2, oy - msize[1] // 2, oz - msize[2] // 2)))
+            low = [min(p[2][k] for p in placed) for k in xrange(3)]
+            high = [max(p[2][k] + p[0][k] for p in placed) for k in xrange(3)]
+            x, y, z = [high[k] - low[k] for k in xrange(3)]
+            frame = [[[0] * y for _ in xrange(z)] for _ in xrange(x)]
+            for msize, records, position in placed:
+                self._fill(frame, records, colors, msize, [position[k] - low[k] for k in xrange(3)])
+            voxels.set_frames([frame], x, z, y)
         else:
-            f.seek(paletteBegin)
-            for i in xrange(0, paletteLength / 4):
-                palette.append(self.uint32(f))
-
-        # read voxel chunk
-        f.seek(voxelBegin)
-        voxelCount = self.uint32(f)
-        for i in xrange(0, voxelCount):
-            vox = self.uint32(f)
-            ix = (vox & 0x000000ff) >> 0
-            iy = (vox & 0x0000ff00) >> 8
-            iz = (vox & 0x00ff0000) >> 16
-            ip = (vox & 0xff000000) >> 24
-            b = (palette[ip - 1] & 0x00ff0000) >> 16
-            g = (palette[ip - 1] & 0x0000ff00) >> 8
-            r = (palette[ip - 1] & 0x000000ff) >> 0
-            voxels.set(ix, iz, iy, (r << 24) | (g << 16) | (b << 8) | 0xff)
-        f.close()
+            # Several models without a scene are an animation
+            x, y, z = [max(model[0][k] for model in models) for k in xrange(3)]
+            frames = []
+            for msize, records in models:
+                frame = [[[0] * y for _ in xrange(z)] for _ in xrange(x)]
+                self._fill(frame, records, colors, msize, (0, 0, 0))
+                frames.append(frame)
+            voxels.set_frames(frames, x, z, y)
+
+    # Set the voxels of a model in our frame, offset by the given position
+    def _fill(self, frame, records, colors, size, position):
+        mx, my, mz = size
+        px, py, pz = position
+        for ix, iy, iz, ip in zip(records[0::4], records[1::4], records[2::4], records[3::4]):
+            if ix < mx and iy < my and iz < mz:
+                frame[px + ix][pz + iz][py + iy] = colors[ip]
+
+    # Collect (model, translation) pairs of the scene graph below the given
+    # node. Rotations are not supported.
+    def _walk(self, nodes, node_id, offset, instances, depth=0):
+        if depth > 64:
+            raise ValueError("scene graph too deep")
+        kind, node = nodes[node_id]
+        node.seek()
+        node.int32()
+        node.dict()
+        if kind == "nTRN":
+            child = node.int32()
+            node.int32()
+            node.int32()
+            frames = node.int32()
+            translation = node.dict().get("_t") if frames else None
+            if translation:
+                tx, ty, tz = [int(v) for v in translation.split()]
+                offset = (offset[0] + tx, offset[1] + ty, offset[2] + tz)
+            self._walk(nodes, child, offset, instances, depth + 1)
+        elif kind == "nGRP":
+            for _ in xrange(node.int32()):
+                self._walk(nodes, node.int32(), offset, instances, depth + 1)
+        elif kind == "nSHP":
+            for _ in xrange(node.int32()):
+                instances.append((node.int32(), offset))
+                node.dict()
+
+
+# Reads the values of a scene graph chunk
+class _Reader(object):
+
+    def __init__(self, data, begin):
+        self._data = data
+        self._begin = begin
+        self._pos = begin
+
+    def seek(self):
+        self._pos = self._begin
+
+    def int32(self):
+        value = struct.unpack_from("<i", self._data, self._pos)[0]
+        self._pos += 4
+        return value
+
+    def string(self):
+        length = self.int32()
+        value = self._data[self._pos:self._pos + length]
+        self._pos += length
+        return value
+
+    def dict(self):
+        return dict((self.string(), self.string()) for _ in xrange(self.int32()))
+
+
+# Return a chunk with the given content and children size
+def _chunk(chunk_id, content, children=0):
+    return chunk_id + _UINT32X2.pack(len(content), children) + content
+
+
+# Return a string in the format of scene graph chunks
+def _string(value):
+    return struct.pack("<i", len(value)) + value
+
+
+def _dict(values):
+    return struct.pack("<i", len(values)) + "".join(_string(k) + _string(v) for k, v in values)
+
+
+# Return the chunks of a scene placing the model with each index at the
+# given translation: a root transform and group, then a transform and shape
+# for every model
+def _scene(translations):
+    chunks = [_chunk("nTRN", struct.pack("<i", 0) + _dict([]) + struct.pack("<4i", 1, -1, -1, 1) + _dict([])),
+              _chunk("nGRP", struct.pack("<i", 1) + _dict([]) + struct.pack("<i", len(translations)) +
+                     struct.pack("<%di" % len(translations), *[2 + i * 2 for i in xrange(len(translations))]))]
+    for i, (x, y, z) in enumerate(translations):
+        chunks.append(_chunk("nTRN", struct.pack("<i", 2 + i * 2) + _dict([]) +
+                             struct.pack("<4i", 3 + i * 2, -1, 0, 1) + _dict([("_t", "%d %d %d" % (x, y, z))])))
+        chunks.append(_chunk("nSHP", struct.pack("<i", 3 + i * 2) + _dict([]) + struct.pack("<2i", 1, i) +
+                             _dict([])))
+    return chunks
+
+
+# Array contents in little endian byte order
+def _to_le(values):
+    if sys.byteorder == "big":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _from_le(data):
+    values = array.array("I")
+    values.fromstring(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
 
 register_plugin(MagicaFile, "Magica Voxel (.vox) file format IO", "1.0")
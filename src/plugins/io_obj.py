@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 from plugin_api import register_plugin
+from quads import quads
 
 
 class ObjFile(object):
@@ -26,6 +27,15 @@ class ObjFile(object):
     # File type filter
     filetype = "*.obj"
 
+    # Saves without the GUI, so can run on a worker thread
+    threadsafe = True
+
+    # Merge neighbouring faces of the same color into larger quads
+    greedy = False
+
+    # Lines we collect before writing them out
+    BUFFER_LINES = 1 << 14
+
     def __init__(self, api):
         self.api = api
         # Register our exporter
@@ -35,65 +45,69 @@ class ObjFile(object):
     # problem saving.
     def save(self, filename):
         # grab the voxel data
-        vertices, colors, _ = self.api.get_voxel_mesh()
-
-        # Open our file
-        f = open(filename, "wt")
+        voxels = self.api.get_voxel_data()
+        frame = voxels.get_frame(voxels.get_frame_number())
 
         # Use materials
-        mat_pathname, mat_filename = os.path.split(filename)
-        name, ext = os.path.splitext(mat_filename)
+        name, ext = os.path.splitext(filename)
         if not ext:
             filename = filename + '.obj'
-        mat_filename = os.path.join(mat_pathname, name) + ".mtl"
-        f.write("mtllib %s\r\n" % mat_filename)
-
-        # Export vertices
-        i = 0
-        while i < len(vertices):
-            f.write("v %f %f %f\r\n" % (vertices[i], vertices[i + 1], vertices[i + 2]))
-            i += 3
-
-        # Build a list of unique colors we use so we can assign materials
-        mats = {}
-        i = 0
-        while i < len(colors):
-            r = colors[i]
-            g = colors[i + 1]
-            b = colors[i + 2]
-            color = r << 24 | g << 16 | b << 8
-            if color not in mats:
-                mats[color] = "material_%i" % len(mats)
-            i += 3
-
-        # Export faces
-        faces = (len(vertices) // (3 * 3)) // 2
-        for i in xrange(faces):
-            n = 1 + (i * 6)
-            r = colors[(i * 18)]
-            g = colors[(i * 18) + 1]
-            b = colors[(i * 18) + 2]
-            color = r << 24 | g << 16 | b << 8
-            f.write("usemtl %s\r\n" % mats[color])
-            f.write("f %i %i %i\r\n" % (n, n + 2, n + 1))
-            f.write("f %i %i %i\r\n" % (n + 5, n + 4, n + 3))
-
-        # Tidy up
-        f.close()
+        mat_filename = name + ".mtl"
+
+        # Quads grouped by material, with shared vertices
+        points = {}
+        materials = {}
+        for color, _, corners in quads(frame, voxels.width, voxels.height, voxels.depth, self.greedy):
+            quad = []
+            for point in corners:
+                index = points.get(point)
+                if index is None:
+                    index = points[point] = len(points) + 1
+                quad.append(index)
+            faces = materials.get(color)
+            if faces is None:
+                faces = materials[color] = []
+            faces.append(quad)
+        order = sorted(points, key=points.get)
+        colors = sorted(materials, key=lambda color: materials[color][0][0])
+
+        with open(filename, "wt") as f:
+            lines = ["mtllib %s\n" % os.path.basename(mat_filename)]
+            for point in order:
+                lines.append("v %f %f %f\n" % voxels.voxel_to_world(*point))
+                if len(lines) >= self.BUFFER_LINES:
+                    f.write("".join(lines))
+                    lines = []
+            for i, color in enumerate(colors):
+                lines.append("usemtl material_%i\n" % i)
+                for quad in materials[color]:
+                    lines.append("f %i %i %i %i\n" % tuple(quad))
+                    if len(lines) >= self.BUFFER_LINES:
+                        f.write("".join(lines))
+                        lines = []
+            f.write("".join(lines))
 
         # Create our material file
-        f = open(mat_filename, "wt")
-        for color, material in mats.items():
-            f.write("newmtl %s\r\n" % material)
-            r = (color & 0xff000000) >> 24
-            g = (color & 0xff0000) >> 16
-            b = (color & 0xff00) >> 8
-            r = r / 255.0
-            g = g / 255.0
-            b = b / 255.0
-            f.write("Ka %f %f %f\r\n" % (r, g, b))
-            f.write("Kd %f %f %f\r\n" % (r, g, b))
-        f.close()
+        with open(mat_filename, "wt") as f:
+            lines = []
+            for i, color in enumerate(colors):
+                r = ((color & 0xff000000) >> 24) / 255.0
+                g = ((color & 0xff0000) >> 16) / 255.0
+                b = ((color & 0xff00) >> 8) / 255.0
+                lines.append("newmtl material_%i\n" % i)
+                lines.append("Ka %f %f %f\n" % (r, g, b))
+                lines.append("Kd %f %f %f\n" % (r, g, b))
+            f.write("".join(lines))
+
+
+# Exports merged faces for smaller files
+class ObjMergedFile(ObjFile):
+
+    # Description of file type
+    description = "OBJ Files (merged faces)"
+
+    greedy = True
 
 
 register_plugin(ObjFile, "OBJ exporter", "1.0")
+register_plugin(ObjMergedFile, "OBJ merged faces exporter", "1.0")
@@ -0,0 +1,88 @@
+# io_ply.py
+# Export meshes to binary PLY
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import struct
+from plugin_api import register_plugin
+from constants import ZOXEL_TAG
+from quads import quads
+
+# Vertex position and color, face vertex count and indices
+_VERTEX = struct.Struct("<3f3B")
+_FACE = struct.Struct("<B4i")
+
+
+class PlyFile(object):
+
+    # Description of file type
+    description = "PLY Files"
+
+    # File type filter
+    filetype = "*.ply"
+
+    # Saves without the GUI, so can run on a worker thread
+    threadsafe = True
+
+    # Merge neighbouring faces of the same color into larger quads
+    greedy = True
+
+    def __init__(self, api):
+        self.api = api
+        # Register our exporter
+        self.api.register_file_handler(self)
+
+    # Called when we need to save. Should raise an exception if there is a
+    # problem saving.
+    def save(self, filename):
+        # grab the voxel data
+        voxels = self.api.get_voxel_data()
+        frame = voxels.get_frame(voxels.get_frame_number())
+
+        # Faces only share vertices with the same color
+        index = {}
+        vertices = []
+        faces = []
+        for color, _, corners in quads(frame, voxels.width, voxels.height, voxels.depth, self.greedy):
+            quad = []
+            for point in corners:
+                key = (point, color)
+                i = index.get(key)
+                if i is None:
+                    i = index[key] = len(vertices)
+                    x, y, z = voxels.voxel_to_world(*point)
+                    vertices.append(_VERTEX.pack(x, y, z, (color & 0xff000000) >> 24, (color & 0xff0000) >> 16,
+                                                 (color & 0xff00) >> 8))
+                quad.append(i)
+            faces.append(_FACE.pack(4, *quad))
+
+        header = ("ply\n"
+                  "format binary_little_endian 1.0\n"
+                  "comment Zoxel Version %s\n"
+                  "element vertex %d\n"
+                  "property float x\n"
+                  "property float y\n"
+                  "property float z\n"
+                  "property uchar red\n"
+                  "property uchar green\n"
+                  "property uchar blue\n"
+                  "element face %d\n"
+                  "property list uchar int vertex_indices\n"
+                  "end_header\n") % (ZOXEL_TAG, len(vertices), len(faces))
+
+        # Write the file in one go
+        with open(filename, "wb") as f:
+            f.write(header + "".join(vertices) + "".join(faces))
+
+
+register_plugin(PlyFile, "PLY exporter", "1.0")
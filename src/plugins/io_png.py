@@ -14,9 +14,37 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import re
+import array
+from collections import Counter
 from plugin_api import register_plugin
+from quantize import median_cut
 from PySide import QtGui
 
+# Largest image we load along any axis
+MAX_SIZE = 127
+
+
+# Return the pixels of an image as 32 bit ARGB values, row by row, and the
+# number of values per row
+def _pixels(img):
+    img = img.convertToFormat(QtGui.QImage.Format_ARGB32)
+    values = array.array("I")
+    values.fromstring(str(bytearray(img.constBits())[:img.byteCount()]))
+    return values, img.bytesPerLine() // 4
+
+
+# Our color for each of the given ARGB pixel values, transparent pixels are
+# empty
+def _colors(pixels):
+    return dict((p, (p & 0xffffff) << 8 | p >> 24 if p >> 24 else 0) for p in pixels)
+
+
+# Sort key for file names with numbers, slice2.png before slice10.png
+def _natural(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
 
 class PngFile(object):
 
@@ -26,6 +54,9 @@ class PngFile(object):
     # File type filter
     filetype = "*.png"
 
+    # Files start with
+    magic = ("\x89PNG\r\n\x1a\n",)
+
     def __init__(self, api):
         self.api = api
         # Register our exporter
@@ -36,30 +67,139 @@ class PngFile(object):
     # Called when we need to load a file. Should raise an exception if there
     # is a problem.
     def load(self, filename):
+        with open(filename, "rb") as f:
+            self.load_stream(f)
+
+    def load_stream(self, f):
 
         # load the png
-        try:
-            png = QtGui.QPixmap(filename)
-        except Exception as Ex:
-            raise Exception("This is not a valid png file: %s" % Ex)
-
-        width = png.width()
-        height = png.height()
-        if width > 127 or height > 127:
+        img = QtGui.QImage.fromData(f.read(), "PNG")
+        if img.isNull():
+            raise Exception("This is not a valid png file")
+
+        width = img.width()
+        height = img.height()
+        if width > MAX_SIZE or height > MAX_SIZE:
             raise Exception("The image file is too large. Maximum width and height are 127 pixels.")
         depth = 1
-        img = png.toImage()
 
         # grab the voxel data
         voxels = self.api.get_voxel_data()
 
-        voxels.resize(width, height, depth)
+        # Build the frame from the raw pixels
+        values, stride = _pixels(img)
+        colors = _colors(set(values))
+        frame = [[[0] * depth for _ in xrange(height)] for _ in xrange(width)]
+        for y in xrange(height):
+            row = values[y * stride:y * stride + width]
+            for x in xrange(width):
+                frame[x][height - y - 1][0] = colors[row[x]]
+        voxels.set_frames([frame], width, height, depth)
+
+
+# Loads a stack of images as the horizontal slices of a model, bottom first.
+# The slices are the numbered files next to the one chosen (slice1.png,
+# slice2.png, ...), the pages of a multi-page image or the square tiles of a
+# sprite sheet.
+class PngStackFile(object):
+
+    # Description of file type
+    description = "PNG Slice Stacks"
+
+    # File type filter
+    filetype = "*.png"
+
+    # Colors we offer to reduce the model to
+    MAX_COLORS = 256
+
+    def __init__(self, api):
+        self.api = api
+        # Register our importer
+        self.api.register_file_handler(self)
+
+    def load(self, filename):
+        images = self._slices(filename)
+        width, depth, height = images[0].width(), images[0].height(), len(images)
+        for img in images:
+            if img.width() != width or img.height() != depth:
+                raise Exception("All slices must have the same size.")
+        if width > MAX_SIZE or height > MAX_SIZE or depth > MAX_SIZE:
+            raise Exception("Model to large - max 127x127x127")
+
+        # grab the voxel data
+        voxels = self.api.get_voxel_data()
+
+        # Our color for each pixel value, optionally reduced
+        slices = [_pixels(img) for img in images]
+        pixels = set()
+        for values, _ in slices:
+            pixels.update(values)
+        colors = _colors(pixels)
+        used = len(set(colors.itervalues()) - set([0]))
+        if used > self.MAX_COLORS and self.api.question(
+                "Reduce colors?", "The slices use %d colors. Should they be reduced to %d colors?"
+                % (used, self.MAX_COLORS)):
+            colors = self._quantize(slices, colors)
+
+        # Each slice is a layer of the model, the top of an image is at the back
+        frame = [[[0] * depth for _ in xrange(height)] for _ in xrange(width)]
+        for y, (values, stride) in enumerate(slices):
+            for z in xrange(depth):
+                row = values[z * stride:z * stride + width]
+                for x in xrange(width):
+                    color = colors[row[x]]
+                    if color:
+                        frame[x][y][depth - z - 1] = color
+        voxels.set_frames([frame], width, height, depth)
+
+    # Return the images of the slices, bottom first
+    def _slices(self, filename):
+        # Numbered files
+        directory, name = os.path.split(filename)
+        match = re.match(r"(.*?)\d+(\.\w+)$", name)
+        if match:
+            pattern = re.compile(re.escape(match.group(1)) + r"\d+" + re.escape(match.group(2)) + "$")
+            names = sorted((n for n in os.listdir(directory or ".") if pattern.match(n)), key=_natural)
+            if len(names) > 1:
+                return [self._image(os.path.join(directory, name)) for name in names]
+
+        # Pages of the image
+        reader = QtGui.QImageReader(filename)
+        images = []
+        for _ in xrange(max(reader.imageCount(), 1)):
+            img = reader.read()
+            if img.isNull():
+                break
+            images.append(img)
+        if not images:
+            raise Exception("This is not a valid image file: %s" % reader.errorString())
+        if len(images) > 1:
+            return images
+
+        # Square tiles of a sprite sheet, along its longer side
+        img = images[0]
+        width, height = img.width(), img.height()
+        if height > width and height % width == 0:
+            return [img.copy(0, y, width, width) for y in xrange(0, height, width)]
+        if width > height and width % height == 0:
+            return [img.copy(x, 0, height, height) for x in xrange(0, width, height)]
+        return images
+
+    def _image(self, filename):
+        img = QtGui.QImage(filename)
+        if img.isNull():
+            raise Exception("This is not a valid image file: %s" % filename)
+        return img
 
-        for x in range(width):
-            for y in range(height):
-                color = img.pixel(x, y)
-                color = color << 8
-                voxels.set(x, height - y - 1, 0, color)
+    # Return colors with the colors of the slices reduced to MAX_COLORS
+    def _quantize(self, slices, colors):
+        histogram = Counter()
+        for values, _ in slices:
+            histogram.update(colors[p] for p in values)
+        del histogram[0]
+        palette, mapping = median_cut(histogram, self.MAX_COLORS)
+        return dict((p, palette[mapping[c]] if c else 0) for p, c in colors.iteritems())
 
 
 register_plugin(PngFile, "Png file format Importer", "1.0")
+register_plugin(PngStackFile, "Png slice stack Importer", "1.0")
@@ -14,12 +14,37 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import sys
+import array
+import struct
+from itertools import groupby
 from plugin_api import register_plugin
-from PySide.QtGui import QMessageBox
-from struct import unpack
 
 # http://www.minddesk.com/wiki/index.php?title=Qubicle_Constructor_1:Data_Exchange_With_Qubicle_Binary
 
+# Markers of compressed data
+_CODEFLAG = 2
+_NEXTSLICEFLAG = 6
+
+# Shortest run of equal voxels we write as a code
+_MIN_RUN = 3
+
+
+# Array contents in little endian byte order
+def _to_le(values):
+    if sys.byteorder == "big":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _from_le(data):
+    values = array.array("I")
+    values.fromstring(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
 
 class QubicleFile(object):
 
@@ -29,85 +54,61 @@ class QubicleFile(object):
     # File type filter
     filetype = "*.qb"
 
+    # Saves without the GUI, so can run on a worker thread
+    threadsafe = True
+
+    # Files start with the version, 1.1.0.0
+    magic = ("\x01\x01\x00\x00",)
+
+    # Largest model we load along any axis
+    MAX_SIZE = 127
+
     def __init__(self, api):
         self.api = api
         # Register our exporter
         self.api.register_file_handler(self)
 
-    # Helper function to read/write uint32
-    def uint32(self, f, value=None):
-        if value is not None:
-            # Write
-            data = bytearray()
-            data.append((value & 0xff))
-            data.append((value & 0xff00) >> 8)
-            data.append((value & 0xff0000) >> 16)
-            data.append((value & 0xff000000) >> 24)
-            f.write(data)
-        else:
-            # Read
-            x = bytearray(f.read(4))
-            if len(x) == 4:
-                return x[0] | x[1] << 8 | x[2] << 16 | x[3] << 24
-            return 0
-
-    def int32(self, f):
-        return unpack('i', f.read(4))[0]
-
     # Called when we need to save. Should raise an exception if there is a
     # problem saving.
     def save(self, filename):
         # grab the voxel data
         voxels = self.api.get_voxel_data()
-
-        # Open our file
-        f = open(filename, "wb")
-
-        # Version
-        self.uint32(f, 0x00000101)
-        # Color format RGBA
-        self.uint32(f, 0)
-        # Right handed z-coords
-        self.uint32(f, 1)
-        # Uncompressed
-        self.uint32(f, 0)
-        # Visability mask
-        self.uint32(f, 0)
-        # Matrix count
-        self.uint32(f, 1)
-
-        # Model name length
+        frame = voxels.get_frame(voxels.get_frame_number())
+        width, height, depth = voxels.width, voxels.height, voxels.depth
+
+        # Our colors in the file's RGBA format, empty voxels are 0
+        colors = {0: 0}
+        for plane in frame:
+            for column in plane:
+                for vox in column:
+                    if vox not in colors:
+                        r = (vox & 0xff000000) >> 24
+                        g = (vox & 0xff0000) >> 16
+                        b = (vox & 0xff00) >> 8
+                        colors[vox] = r | g << 8 | b << 16 | 0xff << 24
+
+        # Version, RGBA, right handed z-coords, compressed, visibility mask,
+        # one matrix
+        data = array.array("I", [0x00000101, 0, 1, 1, 0, 1])
         name = "Model"
-        f.write(str(chr(len(name))))
-        # Model name
-        f.write(name)
-
-        # X, Y, Z dimensions
-        self.uint32(f, voxels.width)
-        self.uint32(f, voxels.height)
-        self.uint32(f, voxels.depth)
-
-        # Matrix position
-        self.uint32(f, 0)
-        self.uint32(f, 0)
-        self.uint32(f, 0)
-
-        # Data
-        for z in xrange(voxels.depth - 1, -1, -1):
-            for y in xrange(voxels.height):
-                for x in xrange(voxels.width - 1, -1, -1):
-                    vox = voxels.get(x, y, z)
-                    alpha = 0xff
-                    if not vox:
-                        alpha = 0x00
-                    r = (vox & 0xff000000) >> 24
-                    g = (vox & 0xff0000) >> 16
-                    b = (vox & 0xff00) >> 8
-                    vox = r | g << 8 | b << 16 | alpha << 24
-                    self.uint32(f, vox)
-
-        # Tidy up
-        f.close()
+        header = _to_le(data) + chr(len(name)) + name
+        # X, Y, Z dimensions and matrix position
+        data = array.array("I", [width, height, depth, 0, 0, 0])
+
+        # Run length encode each slice, x and z are mirrored
+        for z in xrange(depth - 1, -1, -1):
+            values = [colors[frame[x][y][z]] for y in xrange(height) for x in xrange(width - 1, -1, -1)]
+            for vox, run in groupby(values):
+                count = len(list(run))
+                if count >= _MIN_RUN:
+                    data.extend((_CODEFLAG, count, vox))
+                else:
+                    data.extend([vox] * count)
+            data.append(_NEXTSLICEFLAG)
+
+        # Write the file in one go
+        with open(filename, "wb") as f:
+            f.write(header + _to_le(data))
 
     # sets alpha to ff and converts brga to rgba if format
     def formatVox(self, vox, format):
@@ -120,108 +121,127 @@ class QubicleFile(object):
 
     # Load a Qubicle Constructor binary file
     def load(self, filename):
+        with open(filename, "rb") as f:
+            self.load_stream(f)
+
+    def load_stream(self, f):
         # grab the voxel data
         voxels = self.api.get_voxel_data()
 
-        # Open our file
-        f = open(filename, "rb")
-
-        # Version
-        version = self.uint32(f)
-        # Color format 0 for RGBA and 1 for BRGA
-        format = self.uint32(f)
-        # Left handed coords
-        coords = self.uint32(f)
-        # Uncompressed
-        compression = self.uint32(f)
-        # Visability mask
-        mask = self.uint32(f)
-        # Matrix count
-        matrix_count = self.uint32(f)
-
-        # Warn about multiple matrices
-        if matrix_count > 1:
-            self.api.warning("Qubicle files with more than 1 matrix are not yet properly supported. "
-                             "All matrices will be (badly) merged.")
-
-        max_width = 0
-        max_height = 0
-        max_depth = 0
-
-        for i in xrange(matrix_count):
-
-            # Name length
-            namelen = int(ord(f.read(1)))
-            name = f.read(namelen)
-
-            # X, Y, Z dimensions
-            width = self.uint32(f)
-            height = self.uint32(f)
-            depth = self.uint32(f)
-
-            # Don't allow huge models
-            if width > 127 or height > 127 or depth > 127:
-                raise Exception("Model to large - max 127x127x127")
-
-            if width > max_width:
-                max_width = width
-            if height > max_height:
-                max_height = height
-            if depth > max_depth:
-                max_depth = depth
-
-            voxels.resize(max_width, max_height, max_depth)
-
-            # Matrix position - FIXME not yet supported
-            dx = self.int32(f)
-            dy = self.int32(f)
-            dz = self.int32(f)
-
-            # Data
-            if compression:
-                for z in xrange(depth):
-                    index = 0
-                    while True:
-                        data = self.uint32(f)
-                        if data == 6:
-                            break
-                        elif data == 2:
-                            count = self.uint32(f)
-                            vox = self.uint32(f)
-                            if (vox & 0xff000000) >> 24:
-                                vox = self.formatVox(vox, format)
-                                for j in xrange(count):
-                                    x = index % width
-                                    y = index / width
-                                    index += 1
-                                    voxels.set((width - x - 1), y, depth - z - 1 if coords == 1 else z, vox)
-                            else:
-                                index += count
-                        else:
-                            x = index % width
-                            y = index / width
-                            index += 1
-                            if (data & 0xff000000) >> 24:
-                                voxels.set((width - x - 1), y, depth - z - 1 if coords == 1 else z,
-                                           self.formatVox(data, format))
-            else:
-                for z in xrange(depth):
-                    for y in xrange(height):
-                        for x in xrange(width):
-                            vox = self.uint32(f)
-                            if (vox & 0xff000000) >> 24:
-                                voxels.set((width - x - 1), y, depth - z - 1 if coords == 1 else z,
-                                           self.formatVox(vox, format))
+        # Read our file
+        data = f.read()
+
+        try:
+            # Version, color format 0 for RGBA and 1 for BGRA, 1 for right
+            # handed coords, compression, visibility mask and matrix count
+            version, format, coords, compression, mask, matrix_count = struct.unpack_from("<6I", data)
+            pos = 24
+            matrices = []
+            for i in xrange(matrix_count):
+                # Name
+                namelen = ord(data[pos])
+                pos += 1 + namelen
+                # X, Y, Z dimensions and matrix position
+                width, height, depth, dx, dy, dz = struct.unpack_from("<3I3i", data, pos)
+                pos += 24
+                if width > self.MAX_SIZE or height > self.MAX_SIZE or depth > self.MAX_SIZE:
+                    raise Exception("Model to large - max 127x127x127")
+                if compression:
+                    values, pos = self._decompress(data, pos, width * height, depth)
+                else:
+                    count = width * height * depth
+                    values = _from_le(data[pos:pos + count * 4])
+                    if len(values) < count:
+                        raise Exception("Unexpected end of file")
+                    pos += count * 4
+                matrices.append(((width, height, depth), (dx, dy, dz), values))
+        except (struct.error, IndexError):
+            raise Exception("Unexpected end of file")
+
+        # Our color for each file color, empty if the alpha is 0
+        colors = {}
+        for values in (m[2] for m in matrices):
+            for vox in set(values):
+                if vox not in colors:
+                    colors[vox] = self.formatVox(vox, format) if vox & 0xff000000 else 0
+
+        if len(matrices) == 1:
+            size, (dx, dy, dz), values = matrices[0]
+            width, height, depth = size
+            frame = [[[0] * depth for _ in xrange(height)] for _ in xrange(width)]
+            self._place(frame, size, (0, 0, 0), values, colors, coords)
             # restore attachment point
-            if matrix_count == 1 and dx <= 0 and dy <= 0 and dz <= 0 and (dx < 0 or dy < 0 or dz < 0):
-                r = QMessageBox.question(None, "Restore attachment point?",
-                                         ("It looks like your are opening a voxel model exported by Trove.\nShould we"
-                                          " try to restore the attachment point out of the .qb's metadata for you?"),
-                                         QMessageBox.No, QMessageBox.Yes)
-                if r == QMessageBox.Yes:
-                    voxels.set(max_width + dx - 1, -dy, max_depth + dz - 1 if coords == 1 else -dz, 0xff00ffff)
-
-        f.close()
+            if dx <= 0 and dy <= 0 and dz <= 0 and (dx < 0 or dy < 0 or dz < 0):
+                if self.api.question("Restore attachment point?",
+                                     "It looks like your are opening a voxel model exported by Trove.\nShould we"
+                                     " try to restore the attachment point out of the .qb's metadata for you?"):
+                    x, y, z = width + dx - 1, -dy, depth + dz - 1 if coords == 1 else -dz
+                    if 0 <= x < width and 0 <= y < height and 0 <= z < depth:
+                        frame[x][y][z] = 0xff00ffff
+            voxels.set_frames([frame], width, height, depth)
+            return
+
+        # Several matrices, place them at their positions in a common space
+        low = [min(m[1][k] for m in matrices) for k in xrange(3)]
+        high = [max(m[1][k] + m[0][k] for m in matrices) for k in xrange(3)]
+        width, height, depth = [high[k] - low[k] for k in xrange(3)]
+        if width > self.MAX_SIZE or height > self.MAX_SIZE or depth > self.MAX_SIZE:
+            raise Exception("Model to large - max 127x127x127")
+        separate = self.api.question("Load matrices as frames?",
+                                     "This file contains %d matrices. Should each matrix be loaded as a separate "
+                                     "frame?\nOtherwise all matrices are merged into one frame." % len(matrices))
+        frames = []
+        for size, position, values in matrices:
+            if separate or not frames:
+                frames.append([[[0] * depth for _ in xrange(height)] for _ in xrange(width)])
+            offset = [position[k] - low[k] for k in xrange(3)]
+            # Our x axis and possibly z axis are mirrored
+            offset[0] = width - offset[0] - size[0]
+            if coords == 1:
+                offset[2] = depth - offset[2] - size[2]
+            self._place(frames[-1], size, offset, values, colors, coords)
+        voxels.set_frames(frames, width, height, depth)
+
+    # Expand the run length encoded slices starting at pos, returns the voxel
+    # values and the position after the data
+    def _decompress(self, data, pos, slice_size, depth):
+        words = _from_le(data[pos:pos + (len(data) - pos) // 4 * 4])
+        values = array.array("I")
+        i = 0
+        for z in xrange(depth):
+            start = len(values)
+            # Copy literal voxels up to the next marker in one go
+            while True:
+                end = i
+                vox = words[end]
+                while vox != _CODEFLAG and vox != _NEXTSLICEFLAG:
+                    end += 1
+                    vox = words[end]
+                values.extend(words[i:end])
+                i = end + 1
+                if vox == _NEXTSLICEFLAG:
+                    break
+                values.extend(array.array("I", [words[i + 1]]) * words[i])
+                i += 2
+            # Make sure each slice has the expected size
+            if len(values) - start != slice_size:
+                del values[start + slice_size:]
+                values.extend([0] * (start + slice_size - len(values)))
+        return values, pos + i * 4
+
+    # Write the voxel values of a matrix, ordered x, y, z as in the file, to
+    # our frame with its mirrored corner at offset
+    def _place(self, frame, size, offset, values, colors, coords):
+        width, height, depth = size
+        ox, oy, oz = offset
+        for z in xrange(depth):
+            tz = oz + (depth - z - 1 if coords == 1 else z)
+            for y in xrange(height):
+                row = values[(z * height + y) * width:(z * height + y + 1) * width]
+                for x in xrange(width):
+                    vox = colors[row[x]]
+                    if vox:
+                        frame[ox + width - x - 1][oy + y][tz] = vox
 
 
 register_plugin(QubicleFile, "Qubicle Constructor file format IO", "1.0")
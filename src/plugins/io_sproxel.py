@@ -25,6 +25,9 @@ class SproxelFile(object):
     # File type filter
     filetype = "*.csv"
 
+    # Saves without the GUI, so can run on a worker thread
+    threadsafe = True
+
     def __init__(self, api):
         self.api = api
         # Register our exporter
@@ -35,63 +38,63 @@ class SproxelFile(object):
     def save(self, filename):
         # grab the voxel data
         voxels = self.api.get_voxel_data()
+        frame = voxels.get_frame(voxels.get_frame_number())
+        width, height, depth = voxels.width, voxels.height, voxels.depth
 
-        # Open our file
-        f = open(filename, "wt")
+        # Text of each color we use
+        text = {0: "#00000000"}
+        for plane in frame:
+            for column in plane:
+                for voxel in set(column).difference(text):
+                    text[voxel] = "#%08X" % ((voxel & 0xffffff00) | 0xff)
+        text = text.__getitem__
 
         # First Sproxel line is model dimenstions
-        f.write("%i,%i,%i\n" % (voxels.width, voxels.height, voxels.depth))
+        lines = ["%i,%i,%i\n" % (width, height, depth)]
 
         # Then we save from the top of the model
-        for y in xrange(voxels.height - 1, -1, -1):
-            for z in xrange(voxels.depth - 1, -1, -1):
-                line = []
-                for x in xrange(voxels.width):
-                    voxel = voxels.get(x, y, z)
-                    if voxel == 0:
-                        line.append("#00000000")
-                    else:
-                        voxel = (voxel & 0xffffff00) | 0xff
-                        voxel = "%x" % voxel
-                        line.append("#" + voxel.upper().rjust(8, "0"))
-                f.write(",".join(line) + "\n")
-            f.write("\n")
-
-        # Tidy up
-        f.close()
+        for y in xrange(height - 1, -1, -1):
+            columns = [plane[y] for plane in frame]
+            for z in xrange(depth - 1, -1, -1):
+                lines.append(",".join([text(column[z]) for column in columns]) + "\n")
+            lines.append("\n")
+
+        with open(filename, "wt") as f:
+            f.writelines(lines)
 
     # Load a Sproxel file
     def load(self, filename):
+        with open(filename, "rb") as f:
+            self.load_stream(f)
+
+    def load_stream(self, f):
         # grab the voxel data
         voxels = self.api.get_voxel_data()
 
-        # Open our file
-        f = open(filename, "rt")
-        size = f.readline().strip()
-        x, y, z = size.split(",")
-        x = int(x)
-        y = int(y)
-        z = int(z)
-        voxels.resize(x, y, z)
-        # Parse the file
-        for fy in xrange(y - 1, -1, -1):
-            for fz in xrange(z - 1, -1, -1):
-                line = f.readline().strip().split(",")
-                for fx in xrange(0, x):
-                    if line[fx] == "#00000000":
-                        continue
-                    color = line[fx][1:]
-                    r = color[:2]
-                    g = color[2:4]
-                    b = color[4:6]
-                    r = int(r, 16)
-                    g = int(g, 16)
-                    b = int(b, 16)
-                    a = 0xff
-                    v = r << 24 | g << 16 | b << 8 | a
-                    voxels.set(fx, fy, fz, v)
-
-            f.readline()  # discard empty line
-        f.close()
+        lines = f.read().splitlines()
+        x, y, z = [int(v) for v in lines[0].strip().split(",")]
+
+        # Colors of the cells in file order, rows of x within z within y,
+        # both from the top
+        colors = {"#00000000": 0}
+        cells = []
+        row = 1
+        for fy in xrange(y):
+            for fz in xrange(z):
+                line = lines[row].strip().split(",")[:x] if row < len(lines) else []
+                line.extend(["#00000000"] * (x - len(line)))
+                row += 1
+                try:
+                    cells.extend(map(colors.__getitem__, line))
+                except KeyError:
+                    for color in set(line).difference(colors):
+                        colors[color] = int(color[1:7], 16) << 8 | 0xff
+                    cells.extend(map(colors.__getitem__, line))
+            row += 1  # discard empty line
+
+        # Each of our columns is every x-th cell of a y plane, z reversed
+        plane = x * z
+        frame = [[cells[(y - fy - 1) * plane + fx:(y - fy) * plane:x][::-1] for fy in xrange(y)] for fx in xrange(x)]
+        voxels.set_frames([frame], x, y, z)
 
 register_plugin(SproxelFile, "Sproxel file format IO", "1.0")
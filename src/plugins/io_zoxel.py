@@ -14,9 +14,60 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import re
+import sys
 import json
+import zlib
+import array
+import struct
+from functools import partial
 from plugin_api import register_plugin
 from constants import ZOXEL_TAG
+from voxel import LazyFrame
+
+# Version 2 files are binary, all numbers little endian:
+#   header      magic, version, width, height, depth, frame count, bytes per
+#               palette index (1, 2 or 4) and palette size
+#   creator     length and UTF-8 text
+#   palette     one 32 bit RGBA color per entry, index 0 is empty
+#   frame index file offset and length of each frame block
+#   frames      zlib compressed palette indices of all voxels of a frame,
+#               ordered x, then y, then z
+# Files of earlier versions are JSON.
+_MAGIC = "ZOXB"
+_HEADER = struct.Struct("<4sHHHHHBI")
+_LENGTH = struct.Struct("<H")
+_FRAME = struct.Struct("<II")
+
+
+# Array contents in little endian byte order
+def _to_le(values):
+    if sys.byteorder == "big":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _from_le(typecode, data):
+    values = array.array(typecode)
+    values.fromstring(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+# Return the voxel data of a frame block of a version 2 file
+def _decode_frame(block, typecode, palette, width, height, depth):
+    try:
+        indices = _from_le(typecode, zlib.decompress(block))
+    except zlib.error as Ex:
+        raise Exception("Corrupt frame in Zoxel file (%s)" % Ex)
+    column = depth
+    plane = height * depth
+    if len(indices) != width * plane:
+        raise Exception("Corrupt frame in Zoxel file")
+    flat = [palette[v] for v in indices]
+    return [[flat[y:y + column] for y in xrange(x, x + plane, column)] for x in xrange(0, width * plane, plane)]
 
 
 class ZoxelFile(object):
@@ -27,103 +78,313 @@ class ZoxelFile(object):
     # File type filter
     filetype = "*.zox"
 
+    # Saves without the GUI, so can run on a worker thread
+    threadsafe = True
+
+    # Files start with, binary or JSON
+    magic = (_MAGIC, "{")
+
     def __init__(self, api):
         self.api = api
         # Register our exporter
         self.api.register_file_handler(self)
         # File version format we support
-        self._file_version = 1
+        self._file_version = 2
 
     # Called when we need to save. Should raise an exception if there is a
     # problem saving.
     def save(self, filename):
         # grab the voxel data
         voxels = self.api.get_voxel_data()
+        frames = voxels.get_frame_count()
 
-        # File version
-        version = self._file_version
+        # Flatten the frames and build our palette
+        palette = {0: 0}
+        blocks = []
+        for i in xrange(frames):
+            flat = [v for plane in voxels.get_frame(i) for column in plane for v in column]
+            for v in set(flat):
+                if v not in palette:
+                    palette[v] = len(palette)
+            blocks.append(flat)
+        if len(palette) <= 0x100:
+            typecode, size = "B", 1
+        elif len(palette) <= 0x10000:
+            typecode, size = "H", 2
+        else:
+            typecode, size = "I", 4
+        index = palette.get
+        blocks = [zlib.compress(_to_le(array.array(typecode, [index(v) for v in flat])), 6) for flat in blocks]
+        colors = array.array("I", [0] * len(palette))
+        for color, i in palette.iteritems():
+            colors[i] = color
 
-        # Build data structure
-        data = {'version': version, 'frames': voxels.get_frame_count(), "creator": "Zoxel Version " + ZOXEL_TAG}
+        creator = ("Zoxel Version " + ZOXEL_TAG).encode("utf-8")
+        header = [_HEADER.pack(_MAGIC, self._file_version, voxels.width, voxels.height, voxels.depth, frames,
+                               size, len(colors)),
+                  _LENGTH.pack(len(creator)), creator, _to_le(colors)]
+        offset = sum(len(h) for h in header) + _FRAME.size * frames
+        for block in blocks:
+            header.append(_FRAME.pack(offset, len(block)))
+            offset += len(block)
 
-        for f in xrange(voxels.get_frame_count()):
-            frame = []
-            voxels.select_frame(f)
-            for y in range(voxels.height):
-                for z in range(voxels.depth):
-                    for x in range(voxels.width):
-                        v = voxels.get(x, y, z)
-                        if v:
-                            frame.append((x, y, z, v))
+        # Write our file
+        with open(filename, "wb") as f:
+            for data in header:
+                f.write(data)
+            for block in blocks:
+                f.write(block)
 
-            data['frame{0}'.format(f + 1)] = frame
+    # Called when we need to load a file. Should raise an exception if there
+    # is a problem.
+    def load(self, filename):
+        with open(filename, "rb") as f:
+            self.load_stream(f)
 
-        data['width'] = voxels.width
-        data['height'] = voxels.height
-        data['depth'] = voxels.depth
+    def load_stream(self, f):
+        header = f.read(len(_MAGIC))
+        if header == _MAGIC:
+            self._load_binary(header + f.read())
+        else:
+            self._load_json(f, header)
 
-        # Open our file
-        f = open(filename, "wt")
+    def _load_binary(self, data):
+        # grab the voxel data
+        voxels = self.api.get_voxel_data()
 
-        f.write(json.dumps(data))
+        try:
+            magic, version, width, height, depth, frames, size, colors = _HEADER.unpack_from(data)
+        except struct.error:
+            raise Exception("Doesn't look like a valid Zoxel file")
+        if version > self._file_version:
+            raise Exception("More recent version of Zoxel needed to open file.")
+        pos = _HEADER.size
+        pos += _LENGTH.size + _LENGTH.unpack_from(data, pos)[0]
+        palette = _from_le("I", data[pos:pos + colors * 4]).tolist()
+        pos += colors * 4
+        typecode = {1: "B", 2: "H", 4: "I"}[size]
 
-        # Tidy up
-        f.close()
+        # Only the first frame is decoded now, the others when first needed
+        result = []
+        for i in xrange(frames):
+            offset, length = _FRAME.unpack_from(data, pos + i * _FRAME.size)
+            if offset + length > len(data):
+                raise Exception("Corrupt frame %d in Zoxel file" % (i + 1))
+            block = data[offset:offset + length]
+            decode = partial(_decode_frame, block, typecode, palette, width, height, depth)
+            result.append(decode() if i == 0 else LazyFrame(decode, (block, typecode, palette)))
+        voxels.set_frames(result, width, height, depth)
 
-    # Called when we need to load a file. Should raise an exception if there
-    # is a problem.
-    def load(self, filename):
+    # Version 1 files are JSON, which we read incrementally so only the
+    # voxels of one frame are held in a packed form at a time
+    def _load_json(self, f, header=""):
         # grab the voxel data
         voxels = self.api.get_voxel_data()
 
-        # Load the file data
-        f = open(filename, "rt")
+        data = {}
+        frames = {}
+        pending = {}
+        stream = _JsonStream(f, header)
         try:
-            data = json.loads(f.read())
-        except Exception as Ex:
+            for key, value in stream.members(lambda key: key.startswith("frame") and key != "frames"):
+                if key.startswith("frame") and key != "frames":
+                    # Pack the voxels, build the frame once we know the size
+                    coordinates = array.array("i")
+                    colors = array.array("I")
+                    for x, y, z, v in value:
+                        coordinates.extend((x, y, z))
+                        colors.append(v)
+                    pending[key] = (coordinates, colors)
+                    if "width" in data:
+                        frames[key] = self._build_frame(data, *pending.pop(key))
+                else:
+                    data[key] = value
+        except ValueError as Ex:
             raise Exception("Doesn't look like a valid Zoxel file (%s)" % Ex)
-        f.close()
 
         # Check we understand it
-        if data['version'] > self._file_version:
+        if data.get('version', 1) > 1:
             raise Exception("More recent version of Zoxel needed to open file.")
 
         # How many frames?
-        frames = data['frames']
-
-        # Load the data
-        frame = data['frame1']
+        count = data['frames']
 
         # Do we have model dimensions
-        if 'width' in data:
-            # Yes, so resize to them
-            voxels.resize(data['width'], data['height'], data['depth'])
-        else:
-            # Zoxel file with no dimension data, determine size
-            maxX = -127
-            maxY = -127
-            maxZ = -127
-            for x, y, z, v in frame:
-                if x > maxX:
-                    maxX = x
-                if y > maxY:
-                    maxY = y
-                if z > maxZ:
-                    maxZ = z
-            # Resize
-            voxels.resize(maxX + 1, maxY + 1, maxZ + 1)
-
-        # Read the voxel data
-        for f in xrange(frames):
-            frame = data['frame{0}'.format(f + 1)]
-            for x, y, z, v in frame:
-                voxels.set(x, y, z, v)
-            # Add another frame if required
-            if f < frames - 1:
-                voxels.add_frame(False)
-
-        # Select the first frame by default
-        if frames > 1:
-            voxels.select_frame(0)
+        if 'width' not in data:
+            # Zoxel file with no dimension data, determine size from the first frame
+            coordinates = pending['frame1'][0]
+            data['width'] = max(coordinates[0::3]) + 1 if coordinates else 1
+            data['height'] = max(coordinates[1::3]) + 1 if coordinates else 1
+            data['depth'] = max(coordinates[2::3]) + 1 if coordinates else 1
+        for key in pending.keys():
+            frames[key] = self._build_frame(data, *pending.pop(key))
+
+        result = []
+        for f in xrange(count):
+            frame = frames.get('frame{0}'.format(f + 1))
+            if frame is None:
+                frame = self._build_frame(data, [], [])
+            result.append(frame)
+        voxels.set_frames(result, data['width'], data['height'], data['depth'])
+
+    # Return a frame of the size given in data with the given voxels set
+    def _build_frame(self, data, coordinates, colors):
+        width = data['width']
+        height = data['height']
+        depth = data['depth']
+        frame = [[[0] * depth for _ in xrange(height)] for _ in xrange(width)]
+        for i, v in enumerate(colors):
+            x = coordinates[i * 3]
+            y = coordinates[i * 3 + 1]
+            z = coordinates[i * 3 + 2]
+            if 0 <= x < width and 0 <= y < height and 0 <= z < depth:
+                frame[x][y][z] = v
+        return frame
+
+
+# Reads the members of a JSON object from a file without loading it all.
+class _JsonStream(object):
+
+    # Bytes read from the file at a time
+    BLOCK_SIZE = 1 << 16
+
+    _SPACE = re.compile(r"\s*")
+
+    # Reads f, which continues the data in buffer
+    def __init__(self, f, buffer=""):
+        self._file = f
+        self._buffer = buffer
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    # Make sure there is unread data in our buffer, return False at the end
+    def _fill(self):
+        if self._pos < len(self._buffer):
+            return True
+        return self._read()
+
+    # Read another block, return False at the end of the file
+    def _read(self):
+        if self._eof:
+            return False
+        block = self._file.read(self.BLOCK_SIZE)
+        if not block:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + block
+        self._pos = 0
+        return True
+
+    # Return the next non-whitespace character without consuming it
+    def _peek(self):
+        while True:
+            self._pos = self._SPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._read():
+                break
+        if self._pos >= len(self._buffer):
+            raise ValueError("Unexpected end of file")
+        return self._buffer[self._pos]
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c not in chars:
+            raise ValueError("Expected '%s' but found '%s'" % (chars, c))
+        self._pos += 1
+        return c
+
+    # Decode a complete JSON value
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A number may continue in the next block
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            if not self._read():
+                continue
+
+    def _elements(self):
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    # Generate (key, value) pairs of the object. If streaming(key) is true
+    # and the value is an array, it is returned as a generator of its
+    # elements instead, which is only valid until the next member is read.
+    def members(self, streaming):
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if streaming(key) and self._peek() == "[":
+                self._pos += 1
+                elements = self._elements()
+                yield key, elements
+                # Skip anything the caller didn't consume
+                for _ in elements:
+                    pass
+            else:
+                yield key, self._value()
+            if self._expect(",}") == "}":
+                return
+
+
+# Saves the legacy JSON format (version 1) read by older versions of Zoxel,
+# one frame at a time
+class ZoxelJsonFile(object):
+
+    # Description of file type
+    description = "Zoxel Files (version 1)"
+
+    # File type filter
+    filetype = "*.zox"
+
+    # Saves without the GUI, so can run on a worker thread
+    threadsafe = True
+
+    def __init__(self, api):
+        self.api = api
+        # Register our exporter
+        self.api.register_file_handler(self)
+
+    def save(self, filename):
+        # grab the voxel data
+        voxels = self.api.get_voxel_data()
+        frames = voxels.get_frame_count()
+
+        with open(filename, "wt") as f:
+            f.write('{"version": 1, "frames": %d, "creator": %s, "width": %d, "height": %d, "depth": %d' %
+                    (frames, json.dumps("Zoxel Version " + ZOXEL_TAG), voxels.width, voxels.height, voxels.depth))
+            for i in xrange(frames):
+                data = voxels.get_frame(i)
+                f.write(', "frame%d": [' % (i + 1))
+                first = True
+                for y in xrange(voxels.height):
+                    row = []
+                    for z in xrange(voxels.depth):
+                        for x in xrange(voxels.width):
+                            v = data[x][y][z]
+                            if v:
+                                row.append("[%d, %d, %d, %d]" % (x, y, z, v))
+                    if row:
+                        if not first:
+                            f.write(", ")
+                        f.write(", ".join(row))
+                        first = False
+                f.write("]")
+            f.write("}")
 
 register_plugin(ZoxelFile, "Zoxel file format IO", "1.0")
+register_plugin(ZoxelJsonFile, "Zoxel version 1 file format export", "1.0")
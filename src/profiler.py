@@ -0,0 +1,130 @@
+# profiler.py
+# Lightweight timing statistics for the renderer and tools.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The Profiler class collects named timings (mesh building, picking, painting,
+# tool callbacks) and counters (vertices, drawn triangles, instances) reported
+# by the widget. Timings are kept as rolling averages over the last few samples
+# so they can be shown in a HUD and written to the log at a fixed interval.
+
+import logging
+from collections import deque
+from contextlib import contextmanager
+from timeit import default_timer
+
+log = logging.getLogger("zoxel.profiler")
+
+
+class Profiler(object):
+
+    # Number of samples used for rolling averages
+    SAMPLES = 30
+
+    # Seconds between two log summaries
+    LOG_INTERVAL = 1.0
+
+    # Names of the timings we know about, in display order
+    TIMINGS = (("mesh", "Mesh build"), ("paint", "Paint"), ("pick", "Pick"), ("tool", "Tool"))
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        self._enabled = value
+        self.reset()
+
+    def __init__(self):
+        self._enabled = False
+        self._counters = {}
+        self.reset()
+
+    # Forget the timings measured so far
+    def reset(self):
+        self._timings = {}
+        self._frames = deque()
+        self._last_log = default_timer()
+
+    # Record a duration (in seconds) for the given timing
+    def report(self, name, seconds):
+        if not self._enabled:
+            return
+        samples = self._timings.get(name)
+        if samples is None:
+            samples = self._timings[name] = deque(maxlen=self.SAMPLES)
+        samples.append(seconds)
+
+    # Record the current value of a counter
+    def count(self, name, value):
+        self._counters[name] = value
+
+    # Time the body of a with statement
+    @contextmanager
+    def timer(self, name):
+        if not self._enabled:
+            yield
+            return
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.report(name, default_timer() - start)
+
+    # Called once per painted frame to track the frame rate
+    def frame(self):
+        if not self._enabled:
+            return
+        now = default_timer()
+        self._frames.append(now)
+        while self._frames and now - self._frames[0] > 1.0:
+            self._frames.popleft()
+        if now - self._last_log >= self.LOG_INTERVAL:
+            self._last_log = now
+            log.info(" | ".join(self.summary()))
+
+    # Average duration of a timing in seconds, or None if never reported
+    def average(self, name):
+        samples = self._timings.get(name)
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+    # Latest value of a counter, or None
+    def counter(self, name):
+        return self._counters.get(name)
+
+    # Number of frames painted during the last second
+    @property
+    def fps(self):
+        return len(self._frames)
+
+    # Return our statistics as a list of human readable lines
+    def summary(self):
+        lines = ["FPS: %i" % self.fps]
+        vertices = self.counter("vertices")
+        if vertices is not None:
+            lines.append("Vertices: %i  Triangles: %i" % (vertices, vertices // 3))
+        drawn = self.counter("drawn")
+        if drawn is not None:
+            lines.append("Drawn triangles: %i" % (drawn // 3))
+        instances = self.counter("instances")
+        if instances is not None:
+            lines.append("Instances: %i" % instances)
+        for name, label in self.TIMINGS:
+            avg = self.average(name)
+            if avg is not None:
+                lines.append("%s: %.2f ms" % (label, avg * 1000.0))
+        return lines
@@ -0,0 +1,91 @@
+# quads.py
+# Quad meshes of the visible voxel faces for mesh exporters.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Face directions in voxel space, the axis of the normal and its sign, in
+# the order of the face IDs: front, top, left, right, back and bottom
+DIRECTIONS = ((2, -1), (1, 1), (0, -1), (0, 1), (2, 1), (1, -1))
+
+# Normal of each direction in world space, which mirrors the z axis
+NORMALS = ((0, 0, 1), (0, 1, 0), (-1, 0, 0), (1, 0, 0), (0, 0, -1), (0, -1, 0))
+
+
+# Generate (color, direction, corners) for the visible faces of a frame.
+# The four corners are given in voxel space, counter clockwise seen from
+# outside. With merge set neighbouring faces of the same color are merged
+# into larger quads. The alpha of the colors is cleared.
+def quads(frame, width, height, depth, merge=False):
+    size = (width, height, depth)
+    # Visible faces of each direction and plane, mapping the (u, v)
+    # coordinates within the plane to the voxel color
+    planes = {}
+    for x, plane in enumerate(frame):
+        for y, column in enumerate(plane):
+            for z, color in enumerate(column):
+                if not color:
+                    continue
+                voxel = (x, y, z)
+                for direction, (axis, sign) in enumerate(DIRECTIONS):
+                    neighbour = list(voxel)
+                    neighbour[axis] += sign
+                    nx, ny, nz = neighbour
+                    if 0 <= neighbour[axis] < size[axis] and frame[nx][ny][nz]:
+                        continue
+                    u, v = [voxel[k] for k in xrange(3) if k != axis]
+                    key = (direction, voxel[axis] + (sign > 0))
+                    cells = planes.get(key)
+                    if cells is None:
+                        cells = planes[key] = {}
+                    cells[(u, v)] = color & 0xffffff00
+
+    for (direction, level), cells in sorted(planes.iteritems()):
+        axis, sign = DIRECTIONS[direction]
+        # World space mirrors our z axis, which decides the corner order
+        # that is counter clockwise seen along each direction
+        flip = (axis == 1) == (sign < 0)
+        for (u0, v0), (u1, v1), color in _rectangles(cells, merge):
+            corners = [(u0, v0), (u1, v0), (u1, v1), (u0, v1)]
+            if flip:
+                corners.reverse()
+            points = []
+            for u, v in corners:
+                point = [u, v]
+                point.insert(axis, level)
+                points.append(tuple(point))
+            yield color, direction, points
+
+
+# Generate ((u0, v0), (u1, v1), color) rectangles covering the cells of a
+# plane, one per cell unless we merge them
+def _rectangles(cells, merge):
+    if not merge:
+        for (u, v), color in sorted(cells.iteritems()):
+            yield (u, v), (u + 1, v + 1), color
+        return
+    for (u, v) in sorted(cells, key=lambda cell: (cell[1], cell[0])):
+        color = cells.get((u, v))
+        if color is None:
+            continue
+        # Grow along u, then along v while the whole row matches
+        u1 = u + 1
+        while cells.get((u1, v)) == color:
+            u1 += 1
+        v1 = v + 1
+        while all(cells.get((k, v1)) == color for k in xrange(u, u1)):
+            v1 += 1
+        for j in xrange(v, v1):
+            for k in xrange(u, u1):
+                del cells[(k, j)]
+        yield (u, v), (u1, v1), color
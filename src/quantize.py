@@ -0,0 +1,87 @@
+# quantize.py
+# Color quantization for file formats with a limited palette.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+
+# Colors are 32 bit RGBA integers as stored in VoxelData.
+
+
+def _channels(color):
+    return (color >> 24) & 0xff, (color >> 16) & 0xff, (color >> 8) & 0xff
+
+
+# Return the range of the widest channel of a box and the channel
+def _widest(box):
+    best = (0, 0)
+    for channel in xrange(3):
+        values = [entry[channel] for entry in box]
+        extent = max(values) - min(values)
+        if extent > best[0]:
+            best = (extent, channel)
+    return best
+
+
+# Reduce the colors of the given histogram, a dictionary of color to the
+# number of voxels using it, to at most count colors with the median cut
+# algorithm. Returns the palette and a dictionary mapping each color of the
+# histogram to its index in the palette.
+def median_cut(histogram, count):
+    if len(histogram) <= count:
+        palette = sorted(histogram)
+        return palette, dict((color, i) for i, color in enumerate(palette))
+
+    # A box is a list of (r, g, b, color, weight). Boxes we can split are
+    # kept in a heap by their widest channel range, numbered to break ties.
+    heap = []
+    done = []
+    numbers = itertools.count()
+
+    def add(box):
+        extent, channel = _widest(box)
+        if extent > 0:
+            heapq.heappush(heap, (-extent, next(numbers), channel, box))
+        else:
+            done.append(box)
+
+    add([_channels(color) + (color, weight) for color, weight in histogram.iteritems()])
+    while heap and len(heap) + len(done) < count:
+        # Split the box with the widest channel range
+        _, _, channel, box = heapq.heappop(heap)
+        box.sort(key=lambda entry: entry[channel])
+        # Split at the weighted median, keeping both halves non-empty
+        half = sum(entry[4] for entry in box) / 2.0
+        total = 0
+        split = 1
+        for split, entry in enumerate(box[:-1], 1):
+            total += entry[4]
+            if total >= half:
+                break
+        add(box[:split])
+        add(box[split:])
+    boxes = done + [entry[3] for entry in sorted(heap, key=lambda entry: entry[1])]
+
+    palette = []
+    mapping = {}
+    for box in boxes:
+        weight = float(sum(entry[4] for entry in box))
+        r = int(round(sum(entry[0] * entry[4] for entry in box) / weight))
+        g = int(round(sum(entry[1] * entry[4] for entry in box) / weight))
+        b = int(round(sum(entry[2] * entry[4] for entry in box) / weight))
+        for entry in box:
+            mapping[entry[3]] = len(palette)
+        palette.append(r << 24 | g << 16 | b << 8 | 0xff)
+    return palette, mapping
@@ -0,0 +1,320 @@
+# renderer.py
+# Headless software renderer for voxel models.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Renders the current frame of a VoxelData instance into an image without
+# needing a window, an OpenGL context or Qt. The triangles produced by
+# VoxelData.get_vertices() are rasterised with a z-buffer, using the same
+# camera model and the same fixed function lighting the GLWidget uses, so
+# thumbnails look like the viewport. Intended to be called from scripts, e.g.
+#
+#   image = render(voxels, 128, 128, background=(255, 255, 255))
+#   image.save("thumbnail.png")
+
+import math
+import struct
+import zlib
+
+# Global ambient light of the fixed function pipeline
+_AMBIENT = 0.2
+
+# Darkening of the voxel edges, matches the border of gfx/texture.png
+_EDGE_SHADE = 0.86
+_EDGE_WIDTH = 3 / 256.0
+
+
+class Camera(object):
+
+    def __init__(self, rotate_x=0, rotate_y=0, rotate_z=0, translate_x=0, translate_y=0, translate_z=-30,
+                 fov=45.0, center=(0, 0, 0)):
+        # Same meaning as the GLWidget camera (degrees and world units)
+        self.rotate_x = rotate_x
+        self.rotate_y = rotate_y
+        self.rotate_z = rotate_z
+        self.translate_x = translate_x
+        self.translate_y = translate_y
+        self.translate_z = translate_z
+        # Vertical field of view in degrees
+        self.fov = fov
+        # World space point we rotate about
+        self.center = center
+
+    # Point the camera at the voxels of the model and move back far enough
+    # for all of them to be visible at the given aspect ratio.
+    def fit(self, voxels, aspect=1.0, margin=1.1):
+        x, y, z, width, height, depth = voxels.get_bounding_box()
+        if width <= 0:
+            # Empty model, frame the whole voxel space
+            x, y, z, width, height, depth = 0, 0, 0, voxels.width, voxels.height, voxels.depth
+        x1, y1, z1 = voxels.voxel_to_world(x, y, z)
+        x2, y2, z2 = voxels.voxel_to_world(x + width, y + height, z + depth)
+        self.center = ((x1 + x2) / 2.0, (y1 + y2) / 2.0, (z1 + z2) / 2.0)
+        radius = 0.5 * math.sqrt(width * width + height * height + depth * depth)
+        half_fov = math.radians(self.fov) / 2.0
+        if aspect < 1.0:
+            half_fov = math.atan(math.tan(half_fov) * aspect)
+        self.translate_x = 0
+        self.translate_y = 0
+        self.translate_z = -(radius * margin) / math.sin(half_fov)
+
+    # Return a function transforming world space points into eye space
+    def transform(self):
+        rx = math.radians(self.rotate_x)
+        ry = math.radians(self.rotate_y)
+        rz = math.radians(self.rotate_z)
+        cx, sx = math.cos(rx), math.sin(rx)
+        cy, sy = math.cos(ry), math.sin(ry)
+        cz, sz = math.cos(rz), math.sin(rz)
+        # Combined rotation matrix Rx * Ry * Rz (same order as glRotated calls)
+        m00 = cy * cz
+        m01 = -cy * sz
+        m02 = sy
+        m10 = sx * sy * cz + cx * sz
+        m11 = -sx * sy * sz + cx * cz
+        m12 = -sx * cy
+        m20 = -cx * sy * cz + sx * sz
+        m21 = cx * sy * sz + sx * cz
+        m22 = cx * cy
+        ox, oy, oz = self.center
+        tx, ty, tz = self.translate_x, self.translate_y, self.translate_z
+
+        def apply(x, y, z, translate=True):
+            if translate:
+                x -= ox
+                y -= oy
+                z -= oz
+            ex = m00 * x + m01 * y + m02 * z
+            ey = m10 * x + m11 * y + m12 * z
+            ez = m20 * x + m21 * y + m22 * z
+            if translate:
+                ex += tx
+                ey += ty
+                ez += tz
+            return ex, ey, ez
+        return apply
+
+
+class Image(object):
+
+    def __init__(self, width, height, background=(0, 0, 0)):
+        self.width = width
+        self.height = height
+        # Packed RGB rows, top row first
+        self.pixels = bytearray(struct.pack("BBB", *background) * (width * height))
+
+    def get_pixel(self, x, y):
+        i = (y * self.width + x) * 3
+        return self.pixels[i], self.pixels[i + 1], self.pixels[i + 2]
+
+    # Return a new image scaled down by an integer factor (box filter)
+    def downsample(self, factor):
+        if factor <= 1:
+            return self
+        width = self.width // factor
+        height = self.height // factor
+        result = Image(width, height)
+        src = self.pixels
+        dst = result.pixels
+        stride = self.width * 3
+        area = factor * factor
+        for y in xrange(height):
+            for x in xrange(width):
+                r = g = b = 0
+                for sy in xrange(y * factor, y * factor + factor):
+                    i = sy * stride + x * factor * 3
+                    for _ in xrange(factor):
+                        r += src[i]
+                        g += src[i + 1]
+                        b += src[i + 2]
+                        i += 3
+                o = (y * width + x) * 3
+                dst[o] = r // area
+                dst[o + 1] = g // area
+                dst[o + 2] = b // area
+        return result
+
+    # Encode as a PNG file
+    def to_png(self):
+        def chunk(tag, data):
+            return (struct.pack(">I", len(data)) + tag + data +
+                    struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+        stride = self.width * 3
+        raw = bytearray()
+        for y in xrange(self.height):
+            # Filter type 0 (none) for every scanline
+            raw.append(0)
+            raw += self.pixels[y * stride:(y + 1) * stride]
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+        return ("\x89PNG\r\n\x1a\n" + chunk("IHDR", header) + chunk("IDAT", zlib.compress(bytes(raw), 6)) +
+                chunk("IEND", ""))
+
+    # Save the image, as PNG or binary PPM depending on the file extension
+    def save(self, filename):
+        if filename.lower().endswith(".ppm"):
+            data = "P6\n%i %i\n255\n" % (self.width, self.height) + bytes(self.pixels)
+        else:
+            data = self.to_png()
+        f = open(filename, "wb")
+        f.write(data)
+        f.close()
+
+
+# Render the current frame of the voxel data to an Image.
+#   camera      a Camera, by default one looking at the model from the front
+#               left and fitted to its bounding box
+#   background  RGB tuple of the background color
+#   occlusion   override the ambient occlusion setting of the voxel data
+#   edges       darken the voxel edges like the viewport does
+#   supersample render at a multiple of the size and scale down (antialiasing)
+def render(voxels, width=256, height=256, camera=None, background=(192, 192, 192), occlusion=None,
+           edges=True, supersample=1):
+    supersample = max(1, int(supersample))
+    aspect = float(width) / height
+    if camera is None:
+        camera = Camera(rotate_x=30, rotate_y=-45)
+        camera.fit(voxels, aspect)
+
+    # Grab the mesh with the requested occlusion setting
+    old_occlusion = voxels.occlusion
+    if occlusion is not None:
+        voxels.occlusion = occlusion
+    try:
+        vertices, colors, normals, _, uvs = voxels.get_vertices()
+    finally:
+        voxels.occlusion = old_occlusion
+
+    image = Image(width * supersample, height * supersample, background)
+    _rasterise(image, camera, aspect, vertices, colors, normals, uvs if edges else None)
+    return image.downsample(supersample)
+
+
+def _rasterise(image, camera, aspect, vertices, colors, normals, uvs):
+    width = image.width
+    height = image.height
+    pixels = image.pixels
+    depth = [0.0] * (width * height)
+    transform = camera.transform()
+    near = 0.1
+    f = 1.0 / math.tan(math.radians(camera.fov) / 2.0)
+    fx = f / aspect * width / 2.0
+    fy = f * height / 2.0
+    hw = width / 2.0
+    hh = height / 2.0
+
+    for t in xrange(len(vertices) // 9):
+        vi = t * 9
+        # Flat normal of the triangle, in eye space
+        nx, ny, nz = transform(normals[vi], normals[vi + 1], normals[vi + 2], False)
+        pts = []
+        for k in xrange(3):
+            j = vi + k * 3
+            ex, ey, ez = transform(vertices[j], vertices[j + 1], vertices[j + 2])
+            pts.append((ex, ey, ez))
+        # Triangles facing away from us are culled
+        if nx * pts[0][0] + ny * pts[0][1] + nz * pts[0][2] >= 0:
+            continue
+        # We don't clip, drop anything crossing the near plane
+        if pts[0][2] > -near or pts[1][2] > -near or pts[2][2] > -near:
+            continue
+        # Directional light along the view axis
+        light = _AMBIENT + max(0.0, nz)
+        if light > 1.0:
+            light = 1.0
+        # Project into screen space
+        sx = []
+        sy = []
+        iz = []
+        for ex, ey, ez in pts:
+            w = 1.0 / -ez
+            sx.append(hw + ex * w * fx)
+            sy.append(hh - ey * w * fy)
+            iz.append(w)
+        ci = t * 9
+        cols = [(colors[ci + k * 3] * light, colors[ci + k * 3 + 1] * light, colors[ci + k * 3 + 2] * light)
+                for k in xrange(3)]
+        if uvs is not None:
+            ui = t * 6
+            tex = [(uvs[ui + k * 2], uvs[ui + k * 2 + 1]) for k in xrange(3)]
+        else:
+            tex = None
+        _fill_triangle(pixels, depth, width, height, sx, sy, iz, cols, tex)
+
+
+def _fill_triangle(pixels, depth, width, height, sx, sy, iz, cols, tex):
+    x0, x1, x2 = sx
+    y0, y1, y2 = sy
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    if area == 0:
+        return
+    inv_area = 1.0 / area
+    miny = max(0, int(math.floor(min(sy))))
+    maxy = min(height - 1, int(math.ceil(max(sy))))
+    minx = max(0, int(math.floor(min(sx))))
+    maxx = min(width - 1, int(math.ceil(max(sx))))
+    if minx > maxx or miny > maxy:
+        return
+    # Edge functions w_i(x, y) = a_i * x + b_i * y + c_i, normalised by the
+    # area so they are the barycentric weights of the opposite vertex.
+    a0 = (y1 - y2) * inv_area
+    b0 = (x2 - x1) * inv_area
+    c0 = (x1 * y2 - x2 * y1) * inv_area
+    a1 = (y2 - y0) * inv_area
+    b1 = (x0 - x2) * inv_area
+    c1 = (x2 * y0 - x0 * y2) * inv_area
+    a2 = (y0 - y1) * inv_area
+    b2 = (x1 - x0) * inv_area
+    c2 = (x0 * y1 - x1 * y0) * inv_area
+    z0, z1, z2 = iz
+    (r0, g0, bb0), (r1, g1, bb1), (r2, g2, bb2) = cols
+    for y in xrange(miny, maxy + 1):
+        py = y + 0.5
+        # Work out the span of this row which is inside all three edges
+        lo = minx + 0.5
+        hi = maxx + 0.5
+        empty = False
+        for a, b, c in ((a0, b0, c0), (a1, b1, c1), (a2, b2, c2)):
+            k = b * py + c
+            if a > 0:
+                lo = max(lo, -k / a)
+            elif a < 0:
+                hi = min(hi, -k / a)
+            elif k < 0:
+                empty = True
+        if empty or lo > hi:
+            continue
+        start = max(minx, int(math.ceil(lo - 0.5)))
+        end = min(maxx, int(math.floor(hi - 0.5)))
+        row = y * width
+        for x in xrange(start, end + 1):
+            px = x + 0.5
+            w0 = a0 * px + b0 * py + c0
+            w1 = a1 * px + b1 * py + c1
+            w2 = 1.0 - w0 - w1
+            z = w0 * z0 + w1 * z1 + w2 * z2
+            i = row + x
+            if z <= depth[i]:
+                continue
+            depth[i] = z
+            shade = 1.0
+            if tex is not None:
+                # Affine texture coordinates are fine for our tiny faces
+                u = w0 * tex[0][0] + w1 * tex[1][0] + w2 * tex[2][0]
+                v = w0 * tex[0][1] + w1 * tex[1][1] + w2 * tex[2][1]
+                if u < _EDGE_WIDTH or u > 1 - _EDGE_WIDTH or v < _EDGE_WIDTH or v > 1 - _EDGE_WIDTH:
+                    shade = _EDGE_SHADE
+            o = i * 3
+            pixels[o] = min(255, int((w0 * r0 + w1 * r1 + w2 * r2) * shade))
+            pixels[o + 1] = min(255, int((w0 * g0 + w1 * g1 + w2 * g2) * shade))
+            pixels[o + 2] = min(255, int((w0 * bb0 + w1 * bb1 + w2 * bb2) * shade))
@@ -15,25 +15,178 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import sys
+import zlib
+import pickle
+import tempfile
+from collections import deque
+
+
+# Return a compact array for the given flat list of voxel coordinates
+def coordinate_array(coordinates):
+    if coordinates and max(coordinates) > 0xff:
+        return array.array("H", coordinates)
+    return array.array("B", coordinates)
+
+
+# Return the more compact of the given FILL item and an equivalent DELTA item
+# for a frame of the given size. A DELTA item stores the XOR of the old and
+# new colors of the changed voxels in flat index order, run length encoded as
+# (skip, count, value) triples: skip unchanged voxels, then XOR count voxels
+# with value. Applying it twice restores the original, so it serves both undo
+# and redo.
+def compact(item, width, height, depth):
+    if item.operation != Undo.FILL:
+        return item
+    c = item.coordinates
+    first = {}
+    last = {}
+    for i, (before, after) in enumerate(zip(item.old_colors, item.new_colors)):
+        index = (c[i * 3] * height + c[i * 3 + 1]) * depth + c[i * 3 + 2]
+        if index not in first:
+            first[index] = before
+        last[index] = after
+    runs = array.array("I")
+    pos = 0
+    for index in sorted(first):
+        value = first[index] ^ last[index]
+        if not value:
+            continue
+        if runs and index == pos and value == runs[-1]:
+            runs[-2] += 1
+        else:
+            runs.extend((index - pos, 1, value))
+        pos = index + 1
+    sparse = c.itemsize * len(c) + item.old_colors.itemsize * len(item.old_colors) * 2
+    if runs.itemsize * len(runs) < sparse:
+        return UndoItem(Undo.DELTA, (width, height, depth), runs)
+    return item
+
+
+# Estimated bytes used by a frame of the given size
+def _frame_nbytes(width, height, depth):
+    return width * (sys.getsizeof([None] * height) + height * sys.getsizeof([0] * depth))
+
+
+# Estimated bytes of the frames of one model, as returned by
+# VoxelData._save_model(), which the other doesn't share
+def _unshared_nbytes(model, other):
+    frames, width, height, depth = model[:4]
+    shared = set(id(frame) for frame in other[0])
+    return sum(1 for frame in frames if id(frame) not in shared) * _frame_nbytes(width, height, depth)
+
 
 class UndoItem(object):
 
+    __slots__ = ("_operation", "_coordinates", "_olddata", "_newdata", "_nbytes", "_held")
+
     @property
     def operation(self):
         return self._operation
 
+    # Flat array of x, y, z voxel coordinates of SET_VOXEL and FILL items
     @property
-    def olddata(self):
+    def coordinates(self):
+        return self._coordinates
+
+    # Arrays of the colors before and after a SET_VOXEL or FILL operation,
+    # one per coordinate triple
+    @property
+    def old_colors(self):
         return self._olddata
 
     @property
-    def newdata(self):
+    def new_colors(self):
         return self._newdata
 
+    # An (x, y, z, color) tuple for SET_VOXEL, a list of them for FILL and
+    # the list of grouped items for GROUP. DELTA items hold the frame size and
+    # the runs described in compact(). SNAPSHOT items hold a (data,
+    # history) pair for the state before the operation and, once undone, the
+    # state to return to on redo.
+    @property
+    def olddata(self):
+        return self._expand(self._olddata)
+
+    @property
+    def newdata(self):
+        return self._expand(self._newdata)
+
+    @newdata.setter
+    def newdata(self, value):
+        self._newdata = value
+        self._nbytes = None
+
+    # Bytes of model data held only by a SNAPSHOT item
+    @property
+    def held(self):
+        return self._held
+
+    @held.setter
+    def held(self, value):
+        self._held = value
+        self._nbytes = None
+
+    # Memory used by this item in bytes. The history a SNAPSHOT item saves
+    # is counted by its own items.
+    @property
+    def nbytes(self):
+        if self._nbytes is None:
+            size = sys.getsizeof(self)
+            if self._operation == Undo.SNAPSHOT:
+                self._nbytes = size + self._held
+                return self._nbytes
+            for value in (self._coordinates, self._olddata, self._newdata):
+                if value is None:
+                    continue
+                size += sys.getsizeof(value)
+                if isinstance(value, (tuple, list)):
+                    size += sum(v.nbytes if isinstance(v, UndoItem) else sys.getsizeof(v) for v in value)
+            self._nbytes = size
+        return self._nbytes
+
+    # Voxel operations take a list of (x, y, z, color) tuples (or a single one
+    # for SET_VOXEL) which we store as packed arrays.
     def __init__(self, operation, olddata, newdata):
         self._operation = operation
-        self._olddata = olddata
-        self._newdata = newdata
+        self._nbytes = None
+        self._held = 0
+        if operation in (Undo.SET_VOXEL, Undo.FILL):
+            if operation == Undo.SET_VOXEL:
+                olddata = (olddata,)
+                newdata = (newdata,)
+            coordinates = []
+            for x, y, z, _ in olddata:
+                coordinates += (x, y, z)
+            self._coordinates = coordinate_array(coordinates)
+            self._olddata = array.array("I", [d[3] for d in olddata])
+            self._newdata = array.array("I", [d[3] for d in newdata])
+        else:
+            self._coordinates = None
+            self._olddata = olddata
+            self._newdata = newdata
+
+    # Create a voxel operation item directly from coordinate and color arrays
+    @classmethod
+    def from_arrays(cls, operation, coordinates, old_colors, new_colors):
+        item = cls.__new__(cls)
+        item._operation = operation
+        item._coordinates = coordinates
+        item._olddata = old_colors
+        item._newdata = new_colors
+        item._nbytes = None
+        item._held = 0
+        return item
+
+    def _expand(self, colors):
+        if self._coordinates is None:
+            return colors
+        c = self._coordinates
+        data = [(c[i * 3], c[i * 3 + 1], c[i * 3 + 2], color) for i, color in enumerate(colors)]
+        if self._operation == Undo.SET_VOXEL:
+            return data[0]
+        return data
 
 
 class Undo(object):
@@ -42,6 +195,9 @@ class Undo(object):
     SET_VOXEL = 1
     TRANSLATE = 2
     FILL = 3
+    GROUP = 4
+    SNAPSHOT = 5
+    DELTA = 6
 
     @property
     def enabled(self):
@@ -59,37 +215,352 @@ class Undo(object):
     def frame(self, value):
         self._frame = value
 
+    # Maximum memory used by the undo history of all frames in bytes, or None
+    @property
+    def budget(self):
+        return self._budget
+
+    @budget.setter
+    def budget(self, value):
+        self._budget = value
+        self._enforce_limits()
+
+    # Maximum number of undo steps kept for all frames, or None
+    @property
+    def max_depth(self):
+        return self._max_depth
+
+    @max_depth.setter
+    def max_depth(self, value):
+        self._max_depth = value
+        self._enforce_limits()
+
+    # If set, history evicted to meet our limits is written compressed to a
+    # temporary file, from where undo brings it back when needed.
+    @property
+    def spill(self):
+        return self._spill
+
+    @spill.setter
+    def spill(self, value):
+        self._spill = value
+
+    # Memory used by the undo history in bytes
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    # Journal recording our changes to disk, or None
+    @property
+    def journal(self):
+        return self._journal
+
+    @journal.setter
+    def journal(self, value):
+        self._journal = value
+
     def __init__(self):
         self._enabled = True
+        self._journal = None
+        self._budget = None
+        self._max_depth = None
+        self._spill = False
+        self._spill_file = None
+        # Nesting depth and collected items of an open group
+        self._group_depth = 0
+        self._group = []
         self.clear()
 
     def add_frame(self, pos):
         self._buffer.insert(pos, [])
         self._ptr.insert(pos, -1)
+        self._spilled.insert(pos, [])
 
     def delete_frame(self, pos):
+        items = self._buffer[pos]
         del self._buffer[pos]
         del self._ptr[pos]
+        del self._spilled[pos]
+        # While enabled the items stay in the history the snapshot of the
+        # operation saves
+        if not self._enabled:
+            self._forget(items)
 
     def add(self, item):
         if not self._enabled:
             return
+        if self._group_depth:
+            self._group.append(item)
+            return
         # Clear future if we're somewhere in the middle of the undo history
-        if self._ptr[self._frame] < len(self._buffer[self._frame]) - 1:
-            self._buffer[self._frame] = self._buffer[self._frame][:self._ptr[self._frame] + 1]
+        self._clear_future(self._frame)
+        # An undone snapshot can't be redone once anything else changed
+        for frame in xrange(len(self._buffer)):
+            ptr = self._ptr[frame]
+            if ptr < len(self._buffer[frame]) - 1 and self._buffer[frame][ptr + 1].operation == self.SNAPSHOT:
+                self._clear_future(frame)
         self._buffer[self._frame].append(item)
         self._ptr[self._frame] = len(self._buffer[self._frame]) - 1
+        self._order.append(item)
+        self._nbytes += item.nbytes
+        self._enforce_limits()
+        if self._journal is not None:
+            self._journal.add(self._frame, item)
+
+    def _clear_future(self, frame):
+        ptr = self._ptr[frame]
+        if ptr < len(self._buffer[frame]) - 1:
+            future = self._buffer[frame][ptr + 1:]
+            self._buffer[frame] = self._buffer[frame][:ptr + 1]
+            self._forget(future)
+
+    # Return a copy of the complete history
+    def save_state(self):
+        return [[list(buf) for buf in self._buffer], list(self._ptr), [list(s) for s in self._spilled],
+                deque(self._order), self._nbytes]
+
+    # Replace the complete history with one returned by save_state()
+    def restore_state(self, state):
+        buffers, ptr, spilled, order, nbytes = state
+        self._buffer = [list(buf) for buf in buffers]
+        self._ptr = list(ptr)
+        self._spilled = [list(s) for s in spilled]
+        self._order = deque(order)
+        self._nbytes = nbytes
+        self._frame = min(self._frame, len(self._buffer) - 1)
+
+    # Add a SNAPSHOT item for a structural operation, whose olddata holds
+    # the model and history up to now. model is the model after the
+    # operation. The item becomes the only step of every frame, while the
+    # items of the saved history remain ours to evict.
+    def add_snapshot(self, item, model):
+        if not self._enabled:
+            return
+        # Whether applied or undone, the item holds the frames the operation
+        # replaced, or those it added
+        before = item.olddata[0]
+        item.held = max(_unshared_nbytes(before, model), _unshared_nbytes(model, before))
+        frames = len(model[0])
+        self._buffer = [[item] for _ in xrange(frames)]
+        self._ptr = [0] * frames
+        self._spilled = [[] for _ in xrange(frames)]
+        self._order.append(item)
+        self._nbytes += item.nbytes
+        self._frame = min(self._frame, frames - 1)
+        self._enforce_limits()
+
+    # Called when a SNAPSHOT item was undone. data describes the model to
+    # return to on redo. Restores the history from before the operation and
+    # returns the model data saved with it.
+    def undo_snapshot(self, item, data):
+        state = self.save_state()
+        # The item counts as applied in the state we return to on redo
+        state[1][self._frame] += 1
+        item.newdata = (data, state)
+        before, history = item.olddata
+        self.restore_state(history)
+        return before
+
+    # Offer an undone SNAPSHOT item for redo in the current frame
+    def add_redo(self, item):
+        self._clear_future(self._frame)
+        self._buffer[self._frame].append(item)
+        self._order.append(item)
+        self._nbytes += item.nbytes
+
+    # Called when a SNAPSHOT item is redone. Restores the history from when it
+    # was undone and returns the model data saved with it.
+    def redo_snapshot(self, item):
+        data, history = item.newdata
+        item.newdata = None
+        self.restore_state(history)
+        return data
+
+    # Start collecting items into one undo step
+    def begin_group(self):
+        if not self._group_depth:
+            self._group = []
+            self._group_frame = self._frame
+        self._group_depth += 1
+
+    # Finish a group started with begin_group(), adding its items as one step.
+    # If the frame dimensions are given, voxel edits are stored as compact()
+    # as possible.
+    def end_group(self, dimensions=None):
+        if not self._group_depth:
+            return
+        self._group_depth -= 1
+        if self._group_depth:
+            return
+        items = self._coalesce(self._group)
+        self._group = []
+        if not items:
+            return
+        if dimensions is not None:
+            items = [compact(item, *dimensions) for item in items]
+        frame = self._frame
+        self._frame = min(self._group_frame, len(self._buffer) - 1)
+        if len(items) == 1:
+            self.add(items[0])
+        else:
+            self.add(UndoItem(self.GROUP, items, None))
+        self._frame = frame
+
+    # Merge runs of consecutive voxel edits into one FILL item, keeping the
+    # first old and the last new color of each voxel. Voxels which end up
+    # unchanged are dropped.
+    def _coalesce(self, items):
+        result = []
+        run = []
+        for item in items + [None]:
+            if item is not None and item.operation in (self.SET_VOXEL, self.FILL):
+                run.append(item)
+                continue
+            if run:
+                merged = self._merge_voxel_items(run)
+                if merged:
+                    result.append(merged)
+                run = []
+            if item is not None:
+                result.append(item)
+        return result
+
+    def _merge_voxel_items(self, items):
+        if len(items) == 1:
+            return items[0]
+        index = {}
+        coordinates = []
+        old = array.array("I")
+        new = array.array("I")
+        for item in items:
+            c = item.coordinates
+            for i, (before, after) in enumerate(zip(item.old_colors, item.new_colors)):
+                key = (c[i * 3], c[i * 3 + 1], c[i * 3 + 2])
+                j = index.get(key)
+                if j is None:
+                    index[key] = len(old)
+                    coordinates += key
+                    old.append(before)
+                    new.append(after)
+                else:
+                    new[j] = after
+        keep = [i for i in xrange(len(old)) if old[i] != new[i]]
+        if not keep:
+            return None
+        if len(keep) < len(old):
+            coordinates = [coordinates[i * 3 + k] for i in keep for k in xrange(3)]
+            old = array.array("I", [old[i] for i in keep])
+            new = array.array("I", [new[i] for i in keep])
+        return UndoItem.from_arrays(self.FILL, coordinate_array(coordinates), old, new)
+
+    # Drop items which are no longer part of the history from our accounting
+    def _forget(self, items):
+        if not items:
+            return
+        # Snapshot items are shared by all frames, they may still be in use
+        live = set(id(item) for buf in self._buffer for item in buf if item.operation == self.SNAPSHOT)
+        dropped = set(id(item) for item in items if id(item) not in live)
+        order = deque()
+        for item in self._order:
+            if id(item) in dropped:
+                self._nbytes -= item.nbytes
+            else:
+                order.append(item)
+        self._order = order
+
+    # Evict the oldest items of all frames until we are within our limits.
+    # We always keep the most recent item.
+    def _enforce_limits(self):
+        states = None
+        while len(self._order) > 1 and ((self._budget is not None and self._nbytes > self._budget) or
+                                        (self._max_depth is not None and len(self._order) > self._max_depth)):
+            item = self._order.popleft()
+            self._nbytes -= item.nbytes
+            spilled = []
+            self._forget(self._evict(self._buffer, self._ptr, self._spilled, item, spilled))
+            # The item may also be part of the histories saved by snapshots
+            if states is None:
+                states = self._saved_states()
+            for state in states:
+                if item in state[3]:
+                    dropped = self._evict(state[0], state[1], state[2], item, spilled)
+                    for old in [item] + dropped:
+                        state[3].remove(old)
+                        state[4] -= old.nbytes
+                    self._forget(dropped)
+
+    # Remove the oldest item from a history, moving it to the spill file if
+    # we spill. spilled holds the offset and length of the item once spilled.
+    # Returns the items dropped as they can no longer be redone.
+    def _evict(self, buffers, ptr, spilled_items, item, spilled):
+        dropped = []
+        # The oldest item overall is the oldest item of its frame(s)
+        for frame, buf in enumerate(buffers):
+            if buf and buf[0] is item:
+                del buf[0]
+                if ptr[frame] < 0:
+                    # Everything left in this frame was undone, the redo
+                    # history is useless without its first step
+                    dropped += buf
+                    del buf[:]
+                else:
+                    ptr[frame] -= 1
+                    if self._spill and item.operation != self.SNAPSHOT:
+                        if not spilled:
+                            spilled.append(self._spill_item(item))
+                        spilled_items[frame].append(spilled[0])
+        return dropped
+
+    # Return the histories saved by the SNAPSHOT items reachable from the
+    # current history
+    def _saved_states(self):
+        states = []
+        seen = set()
+        pending = [self._buffer]
+        while pending:
+            for buf in pending.pop():
+                for item in buf:
+                    if item.operation == self.SNAPSHOT and id(item) not in seen:
+                        seen.add(id(item))
+                        for data in (item.olddata, item.newdata):
+                            if data is not None:
+                                states.append(data[1])
+                                pending.append(data[1][0])
+        return states
+
+    # Write an item to the spill file, returns its offset and length
+    def _spill_item(self, item):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix="zoxel-undo-")
+        data = zlib.compress(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        self._spill_file.seek(0, 2)
+        offset = self._spill_file.tell()
+        self._spill_file.write(data)
+        return offset, len(data)
+
+    # Bring back the most recently spilled item of the current frame
+    def _restore_item(self):
+        offset, length = self._spilled[self._frame].pop()
+        self._spill_file.seek(offset)
+        item = pickle.loads(zlib.decompress(self._spill_file.read(length)))
+        self._buffer[self._frame].insert(0, item)
+        self._ptr[self._frame] += 1
+        # It is the oldest item of its frame again
+        self._order.appendleft(item)
+        self._nbytes += item.nbytes
 
     def _valid_buffer(self):
         return len(self._buffer[self._frame]) > 0
 
     def undo(self):
-        if not self._valid_buffer():
+        if self._ptr[self._frame] < 0 and self._spilled[self._frame]:
+            self._restore_item()
+        if not self._valid_buffer() or self._ptr[self._frame] < 0:
             return
         item = self._buffer[self._frame][self._ptr[self._frame]]
         self._ptr[self._frame] -= 1
-        if self._ptr[self._frame] < -1:
-            self._ptr[self._frame] = -1
+        if self._journal is not None:
+            self._journal.undo(self._frame, item)
         return item
 
     def redo(self):
@@ -101,9 +572,19 @@ class Undo(object):
             self._ptr[self._frame] = len(self._buffer[self._frame]) - 1
         else:
             item = self._buffer[self._frame][self._ptr[self._frame]]
+            if self._journal is not None:
+                self._journal.redo(self._frame, item)
         return item
 
-    def clear(self):
-        self._buffer = [[]]
-        self._ptr = [-1]
+    def clear(self, frames=1):
+        self._buffer = [[] for _ in xrange(frames)]
+        self._ptr = [-1] * frames
         self._frame = 0
+        # All items in the order they were added, for eviction
+        self._order = deque()
+        self._nbytes = 0
+        # Offset and length of spilled items per frame, oldest first
+        self._spilled = [[] for _ in xrange(frames)]
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
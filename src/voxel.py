@@ -26,7 +26,9 @@
 
 import math
 import copy
-from undo import Undo, UndoItem
+import array
+from collections import OrderedDict
+from undo import Undo, UndoItem, coordinate_array, compact
 
 # Default world dimensions (in voxels)
 # We are an editor for "small" voxel models. So this needs to be small.
@@ -43,6 +45,38 @@ FULL = 1
 # Occlusion factor
 OCCLUSION = 0.7
 
+# The faces of a voxel indexed by face ID (as used for picking). For each face
+# we store the offset to the neighbour which hides it and the two tangent
+# directions along which its corners are laid out. Corner 0 is at (-u, -v),
+# corner 1 at (-u, +v), corner 2 at (+u, -v) and corner 3 at (+u, +v).
+_FACES = (
+    ((0, 0, -1), (1, 0, 0), (0, 1, 0)),    # 0 - front
+    ((0, 1, 0), (1, 0, 0), (0, 0, 1)),     # 1 - top
+    ((-1, 0, 0), (0, 0, -1), (0, 1, 0)),   # 2 - left
+    ((1, 0, 0), (0, 0, 1), (0, 1, 0)),     # 3 - right
+    ((0, 0, 1), (-1, 0, 0), (0, 1, 0)),    # 4 - back
+    ((0, -1, 0), (1, 0, 0), (0, 0, -1)),   # 5 - bottom
+)
+
+
+# A frame which is only decoded when it is needed. load is called without
+# arguments and returns the frame data, indexed [x][y][z].
+class LazyFrame(object):
+
+    def __init__(self, load, packed=None):
+        self._load = load
+        self._packed = packed
+
+    # The frame still encoded as (block, typecode, palette), or None. block
+    # is a zlib compressed little endian array of the given typecode, holding
+    # the palette index of each voxel in x, y, z order.
+    @property
+    def packed(self):
+        return self._packed
+
+    def load(self):
+        return self._load()
+
 
 class VoxelData(object):
 
@@ -51,6 +85,9 @@ class VoxelData(object):
     Y_AXIS = 2
     Z_AXIS = 3
 
+    # Number of decoded lazy frames we keep
+    FRAME_CACHE_SIZE = 8
+
     # World dimension properties
     @property
     def width(self):
@@ -84,6 +121,16 @@ class VoxelData(object):
     @occlusion.setter
     def occlusion(self, value):
         self._occlusion = value
+        self._dirty = None
+
+    # Journal recording our changes to disk, or None
+    @property
+    def journal(self):
+        return self._undo.journal
+
+    @journal.setter
+    def journal(self, value):
+        self._undo.journal = value
 
     def __init__(self):
         # Default size
@@ -98,8 +145,10 @@ class VoxelData(object):
         self.notify_changed = None
         # Ambient occlusion type effect
         self._occlusion = True
-        self._undoFillNew = []
-        self._undoFillOld = []
+        # Pending fill undo record: coordinates, old and new colors
+        self._undoFillCoords = array.array("H")
+        self._undoFillOld = array.array("I")
+        self._undoFillNew = array.array("I")
 
     # Initialise our data
     def _initialise_data(self):
@@ -108,7 +157,11 @@ class VoxelData(object):
         # Create empty selection
         self._selection = set()
         # Our cache of non-empty voxels (coordinate groups)
-        self._cache = []
+        self._cache = set()
+        # Voxels whose appearance changed since take_dirty(), None for all
+        self._dirty = None
+        # Frames referenced by undo snapshots, copied before being modified
+        self._shared = set()
         # Flag indicating if our data has changed
         self._changed = False
         # Reset undo buffer
@@ -117,6 +170,10 @@ class VoxelData(object):
         self._frame_count = 1
         self._current_frame = 0
         self._frames = [self._data]
+        # Recently decoded lazy frames, oldest first
+        self._decoded = OrderedDict()
+        # The lazy frame the current frame was decoded from
+        self._lazy = None
 
     # Return an empty voxel space
     def blank_data(self):
@@ -134,17 +191,21 @@ class VoxelData(object):
         # Sanity
         if frame_number < 0 or frame_number >= self._frame_count:
             return
-        # Make sure we really have a pointer to the current data
-        self._frames[self._current_frame] = self._data
+        # Make sure we really have a pointer to the current data. If it was
+        # decoded from a lazy frame and is unchanged, it can be dropped again.
+        if self._lazy is not None and self._decoded.get(self._lazy) is self._data:
+            self._frames[self._current_frame] = self._lazy
+        else:
+            self._frames[self._current_frame] = self._data
         # Change to new frame
-        self._data = self._frames[frame_number]
-        self._current_frame = frame_number
+        self._load_frame(frame_number)
         self._undo.frame = self._current_frame
         self._cache_rebuild()
         self.changed = True
         self.clear_selection()
 
     def insert_frame(self, index, copy_current=True):
+        before = self._begin_snapshot()
         if copy_current:
             data = self.get_data()
         else:
@@ -157,9 +218,11 @@ class VoxelData(object):
         self._undo.add_frame(index)
         self._frame_count += 1
         self.select_frame(index)
+        self._end_snapshot(before, ("insert_frame", (index, copy_current)), False)
 
     # Add a new frame by copying the current one
     def add_frame(self, copy_current=True):
+        before = self._begin_snapshot()
         if copy_current:
             data = self.get_data()
         else:
@@ -169,16 +232,20 @@ class VoxelData(object):
         self._undo.add_frame(self._current_frame+1)
         self._frame_count += 1
         self.select_frame(self._current_frame+1)
+        self._end_snapshot(before, ("add_frame", (copy_current,)), False)
 
     def copy_to_current(self, index):
-        data = self._frames[index - 1]
+        data = self.get_frame(index - 1)
         self.set_data(data)
+        if self.journal is not None:
+            self.journal.action(self._current_frame, "copy_to_current", (index,))
 
     # Delete the current frame
     def delete_frame(self):
         # Sanity - we can't have no frames at all
         if self._frame_count <= 1:
             return
+        before = self._begin_snapshot()
         # Remember the frame we want to delete
         killframe = self._current_frame
         # Select a different frame
@@ -193,6 +260,8 @@ class VoxelData(object):
         # If we wrapped around, fix the frame pointer
         if self._current_frame > killframe:
             self._current_frame -= 1
+        self._undo.frame = self._current_frame
+        self._end_snapshot(before, ("delete_frame", ()), False)
 
     # Change to the next frame (with wrap)
     def select_next_frame(self):
@@ -231,41 +300,110 @@ class VoxelData(object):
         # Add to undo
         if undo:
             if fill > 0:
-                self._undoFillOld.append((x, y, z, self._data[x][y][z]))
-                self._undoFillNew.append((x, y, z, state))
+                self._undoFillCoords.extend((x, y, z))
+                self._undoFillOld.append(self._data[x][y][z])
+                self._undoFillNew.append(state)
                 if fill == 2:
                     self.completeUndoFill()
             else:
                 self._undo.add(UndoItem(Undo.SET_VOXEL, (x, y, z, self._data[x][y][z]), (x, y, z, state)))
         # Set the voxel
+        self._own_data()
         self._data[x][y][z] = state
         if state != EMPTY:
-            if (x, y, z) not in self._cache:
-                self._cache.append((x, y, z))
+            self._cache.add((x, y, z))
         else:
-            if (x, y, z) in self._cache:
-                self._cache.remove((x, y, z))
+            self._cache.discard((x, y, z))
+        if self._dirty is not None:
+            self._dirty.add((x, y, z))
         self.changed = True
         return True
 
     def completeUndoFill(self):
-        self._undo.add(UndoItem(Undo.FILL, self._undoFillOld, self._undoFillNew))
-        self._undoFillOld = []
-        self._undoFillNew = []
+        if self._undoFillOld:
+            item = UndoItem.from_arrays(Undo.FILL, coordinate_array(self._undoFillCoords),
+                                        self._undoFillOld, self._undoFillNew)
+            self._undo.add(compact(item, self._width, self._height, self._depth))
+        self._undoFillCoords = array.array("H")
+        self._undoFillOld = array.array("I")
+        self._undoFillNew = array.array("I")
+
+    # Set many voxels at once without recording undo information. coordinates
+    # is a flat sequence of x, y, z triples, colors holds one color per triple.
+    # With reverse the voxels are set last to first, as needed to revert a
+    # record which touched the same voxel more than once.
+    def _apply_voxels(self, coordinates, colors, reverse=False):
+        self._own_data()
+        data = self._data
+        order = xrange(len(colors))
+        if reverse:
+            order = reversed(order)
+        for i in order:
+            x = coordinates[i * 3]
+            y = coordinates[i * 3 + 1]
+            z = coordinates[i * 3 + 2]
+            data[x][y][z] = colors[i]
+        self._update_cache(set(zip(coordinates[0::3], coordinates[1::3], coordinates[2::3])))
+
+    # Apply the runs of a DELTA undo record, see undo.compact()
+    def _apply_delta(self, runs):
+        self._own_data()
+        data = self._data
+        height = self._height
+        depth = self._depth
+        touched = []
+        pos = 0
+        for i in xrange(0, len(runs), 3):
+            pos += runs[i]
+            value = runs[i + 2]
+            for index in xrange(pos, pos + runs[i + 1]):
+                xy, z = divmod(index, depth)
+                x, y = divmod(xy, height)
+                data[x][y][z] ^= value
+                touched.append((x, y, z))
+            pos += runs[i + 1]
+        self._update_cache(touched)
+
+    # Update our cache once for each of the given changed voxels
+    def _update_cache(self, touched):
+        data = self._data
+        cache = self._cache
+        for c in touched:
+            if data[c[0]][c[1]][c[2]] != EMPTY:
+                cache.add(c)
+            else:
+                cache.discard(c)
+        if self._dirty is not None:
+            self._dirty.update(touched)
+        self.changed = True
 
     def select(self, x, y, z):
         self._selection.add((x, y, z))
+        if self._dirty is not None:
+            self._dirty.add((x, y, z))
 
     def deselect(self, x, y, z):
         if (x, y, z) in self._selection:
             self._selection.remove((x, y, z))
+            if self._dirty is not None:
+                self._dirty.add((x, y, z))
 
     def is_selected(self, x, y, z):
         return (x, y, z) in self._selection
 
     def clear_selection(self):
+        if self._dirty is not None:
+            self._dirty |= self._selection
         self._selection.clear()
 
+    # Return the voxels whose appearance changed since the last call, or None
+    # if everything has to be rebuilt. Changes to a voxel also affect the
+    # faces and occlusion of its neighbours.
+    def take_dirty(self):
+        dirty = self._dirty
+        self._dirty = set()
+        return dirty
+
     # Get the state of the given voxel
     def get(self, x, y, z):
         if not self.is_valid_bounds(x, y, z):
@@ -282,6 +420,44 @@ class VoxelData(object):
         self._cache_rebuild()
         self.changed = True
 
+    # Return the data of the given frame, indexed [x][y][z]. It is not
+    # copied, so it must not be modified.
+    def get_frame(self, index):
+        if index == self._current_frame:
+            return self._data
+        frame = self._frames[index]
+        if isinstance(frame, LazyFrame):
+            return self._decode(frame)
+        return frame
+
+    # Return the data of a lazy frame, decoding it unless we did recently
+    def _decode(self, lazy):
+        data = self._decoded.pop(lazy, None)
+        if data is None:
+            data = lazy.load()
+        self._decoded[lazy] = data
+        while len(self._decoded) > self.FRAME_CACHE_SIZE:
+            self._decoded.popitem(False)
+        return data
+
+    # Make the given frame our current frame
+    def _load_frame(self, index):
+        frame = self._frames[index]
+        if isinstance(frame, LazyFrame):
+            self._lazy = frame
+            frame = self._decode(frame)
+        else:
+            self._lazy = None
+        self._data = frame
+        self._current_frame = index
+
+    # Replace the whole model with the given frames, each indexed [x][y][z]
+    # or a LazyFrame, and select the first. The undo history is cleared.
+    def set_frames(self, frames, width, height, depth):
+        self._undo.clear(len(frames))
+        self._shared = set()
+        self._restore_model((frames, width, height, depth, 0))
+
     # Clear our voxel data
     def clear(self):
         self._initialise_data()
@@ -309,10 +485,130 @@ class VoxelData(object):
             uvs += uv
         return (vertices, colors, normals, color_ids, uvs)
 
+    # Return vertex lists grouped by chunk and face direction. The result maps
+    # chunk coordinates (voxel coordinates // size) to a list indexed by face
+    # ID, each entry holding (vertices, colors, normals, color_ids, uvs) lists.
+    # If keys is given only those chunks are built.
+    def get_chunk_vertices(self, size, keys=None):
+        chunks = {}
+        if keys is None:
+            voxels = self._cache
+        else:
+            voxels = self._chunk_voxels(size, keys)
+        for x, y, z in voxels:
+            v, c, n, cid, uv = self._get_voxel_vertices(x, y, z)
+            if not v:
+                continue
+            if (x, y, z) in self._selection:
+                c = [255, 0, 255] * (len(c) // 3)
+            key = (x // size, y // size, z // size)
+            faces = chunks.get(key)
+            if faces is None:
+                faces = chunks[key] = [([], [], [], [], []) for _ in xrange(6)]
+            # Each face is 6 vertices, the face ID is in the low bits of the blue ID
+            for i in xrange(0, len(v), 18):
+                vertices, colors, normals, color_ids, uvs = faces[cid[i + 2] & 0x07]
+                vertices += v[i:i + 18]
+                colors += c[i:i + 18]
+                normals += n[i:i + 18]
+                color_ids += cid[i:i + 18]
+                uvs += uv[i * 2 // 3:i * 2 // 3 + 12]
+        return chunks
+
+    # Iterate the non-empty voxels in the given chunks
+    def _chunk_voxels(self, size, keys):
+        data = self._data
+        for cx, cy, cz in keys:
+            for x in xrange(max(cx * size, 0), min((cx + 1) * size, self.width)):
+                plane = data[x]
+                for y in xrange(max(cy * size, 0), min((cy + 1) * size, self.height)):
+                    column = plane[y]
+                    for z in xrange(max(cz * size, 0), min((cz + 1) * size, self.depth)):
+                        if column[z] != EMPTY:
+                            yield x, y, z
+
+    # Return a compact description of the current frame with one 16 byte
+    # record per voxel, used by the instanced renderer:
+    #   x, y, z, visible face mask, r, g, b, a, 6 occlusion bytes, 2 padding
+    # Bit n of the face mask is set if the face with ID n is visible. The
+    # occlusion byte of a face packs the 2 bit occlusion level of each of its
+    # four corners, corner 0 in the lowest bits.
+    def get_instances(self):
+        records = bytearray()
+        count = 0
+        get = self.get
+        for x, y, z in self._cache:
+            mask = 0
+            occlusion = [0, 0, 0, 0, 0, 0]
+            for face, ((nx, ny, nz), (ux, uy, uz), (vx, vy, vz)) in enumerate(_FACES):
+                ox = x + nx
+                oy = y + ny
+                oz = z + nz
+                if get(ox, oy, oz) != EMPTY:
+                    continue
+                mask |= 1 << face
+                if not self._occlusion:
+                    continue
+                # Neighbours in front of the face, along the edges and diagonals
+                su = get(ox - ux, oy - uy, oz - uz) != EMPTY
+                au = get(ox + ux, oy + uy, oz + uz) != EMPTY
+                sv = get(ox - vx, oy - vy, oz - vz) != EMPTY
+                av = get(ox + vx, oy + vy, oz + vz) != EMPTY
+                c0 = su + sv + (get(ox - ux - vx, oy - uy - vy, oz - uz - vz) != EMPTY)
+                c1 = su + av + (get(ox - ux + vx, oy - uy + vy, oz - uz + vz) != EMPTY)
+                c2 = au + sv + (get(ox + ux - vx, oy + uy - vy, oz + uz - vz) != EMPTY)
+                c3 = au + av + (get(ox + ux + vx, oy + uy + vy, oz + uz + vz) != EMPTY)
+                occlusion[face] = c0 | c1 << 2 | c2 << 4 | c3 << 6
+            if not mask:
+                continue
+            if (x, y, z) in self._selection:
+                color = (255, 0, 255)
+                occlusion = [0, 0, 0, 0, 0, 0]
+            else:
+                c = self._data[x][y][z]
+                color = ((c & 0xff000000) >> 24, (c & 0xff0000) >> 16, (c & 0xff00) >> 8)
+            records.extend((x, y, z, mask))
+            records.extend(color)
+            records.append(0xff)
+            records.extend(occlusion)
+            records.extend((0, 0))
+            count += 1
+        return records, count
+
     # Called to notify us that our data has been saved. i.e. we can set
     # our "changed" status back to False.
     def saved(self):
         self.changed = False
+        if self.journal is not None:
+            self.journal.saved()
+
+    # Return the complete model for a journal checkpoint. The frames are
+    # shared copy-on-write, as the journal encodes them on its own thread.
+    def get_checkpoint(self):
+        self._frames[self._current_frame] = self._data
+        self._shared.update(id(frame) for frame in self._frames)
+        return self._width, self._height, self._depth, self._current_frame, self._changed, list(self._frames)
+
+    # Replace the model with one from a journal checkpoint, without history
+    def restore_checkpoint(self, data):
+        width, height, depth, current, changed, frames = data
+        self._undo.clear(len(frames))
+        self._shared = set()
+        self._restore_model((frames, width, height, depth, current))
+        self.changed = changed
+
+    # Add an undo record taken from the journal and apply it
+    def replay_item(self, item):
+        self._undo.add(item)
+        self._reapply(item)
+
+    # Apply or revert an undo record taken from the journal which is not
+    # part of our history
+    def apply_item(self, item, revert=False):
+        if revert:
+            self._revert(item)
+        else:
+            self._reapply(item)
 
     # Count the number of non-empty voxels from the list of coordinates
     def _count_voxels(self, coordinates):
@@ -679,12 +975,14 @@ class VoxelData(object):
 
     # Rebuild our cache
     def _cache_rebuild(self):
-        self._cache = []
-        for x in range(self.width):
-            for z in range(self.depth):
-                for y in range(self.height):
-                    if self._data[x][y][z] != EMPTY:
-                        self._cache.append((x, y, z))
+        cache = set()
+        for x, plane in enumerate(self._data):
+            for y, column in enumerate(plane):
+                # Skip empty columns quickly
+                if column.count(EMPTY) != len(column):
+                    cache.update([(x, y, z) for z, v in enumerate(column) if v != EMPTY])
+        self._cache = cache
+        self._dirty = None
 
     # Calculate the actual bounding box of the model in voxel space
     # Consider all animation frames
@@ -695,7 +993,8 @@ class VoxelData(object):
         maxx = -999
         maxy = -999
         maxz = -999
-        for data in self._frames:
+        for i in xrange(self._frame_count):
+            data = self.get_frame(i)
             for x in range(self.width):
                 for z in range(self.depth):
                     for y in range(self.height):
@@ -721,13 +1020,13 @@ class VoxelData(object):
     # We offset all voxels on all axis by the given amount.
     # Resize all animation frames
     def resize(self, width=None, height=None, depth=None, shift=0):
-        # Reset undo buffer
-        self._undo.clear()
+        before = self._begin_snapshot()
         # No dimensions, use bounding box
         mx, my, mz, cwidth, cheight, cdepth = self.get_bounding_box()
         if not width:
             width, height, depth = cwidth, cheight, cdepth
-        for i, frame in enumerate(self._frames):
+        for i in xrange(self._frame_count):
+            frame = self.get_frame(i)
             # Create new data structure of the required size
             data = [[[0 for _ in xrange(depth)] for _ in xrange(height)] for _ in xrange(width)]
             # Adjust ranges
@@ -752,11 +1051,11 @@ class VoxelData(object):
         # Rebuild our cache
         self._cache_rebuild()
         self.changed = True
+        self._end_snapshot(before, ("resize", (width, height, depth, shift)))
 
     # Rotate voxels in voxel space 90 degrees
     def rotate_about_axis(self, axis):
-        # Reset undo buffer
-        self._undo.clear()
+        before = self._begin_snapshot()
 
         if axis == self.Y_AXIS:
             width = self.depth  # note swap
@@ -771,7 +1070,8 @@ class VoxelData(object):
             height = self.width
             depth = self.depth
 
-        for i, frame in enumerate(self._frames):
+        for i in xrange(self._frame_count):
+            frame = self.get_frame(i)
 
             # Create new temporary data structure
             data = [[[0 for _ in xrange(depth)] for _ in xrange(height)] for _ in xrange(width)]
@@ -803,13 +1103,14 @@ class VoxelData(object):
         # Rebuild our cache
         self._cache_rebuild()
         self.changed = True
+        self._end_snapshot(before, ("rotate_about_axis", (axis,)))
 
     # Mirror voxels in a axis
     def mirror_in_axis(self, axis):
-        # Reset undo buffer
-        self._undo.clear()
+        before = self._begin_snapshot()
 
-        for i, frame in enumerate(self._frames):
+        for i in xrange(self._frame_count):
+            frame = self.get_frame(i)
 
             # Create new temporary data structure
             data = [[[0 for _ in xrange(self.depth)] for _ in xrange(self.height)] for _ in xrange(self.width)]
@@ -837,6 +1138,7 @@ class VoxelData(object):
         # Rebuild our cache
         self._cache_rebuild()
         self.changed = True
+        self._end_snapshot(before, ("mirror_in_axis", (axis,)))
 
     # Translate the voxel data.
     def translate(self, x, y, z, undo=True):
@@ -848,54 +1150,148 @@ class VoxelData(object):
         if undo:
             self._undo.add(UndoItem(Undo.TRANSLATE, (-x, -y, -z), (x, y, z)))
 
-        # Create new temporary data structure
-        data = [[[0 for _ in xrange(self.depth)] for _ in xrange(self.height)] for _ in xrange(self.width)]
-        # Copy data over at new location
-        for tx in xrange(0, self.width):
-            for ty in xrange(0, self.height):
-                for tz in xrange(0, self.depth):
-                    dx = (tx + x) % self.width
-                    dy = (ty + y) % self.height
-                    dz = (tz + z) % self.depth
-                    data[dx][dy][dz] = self._data[tx][ty][tz]
+        # Rotate the lists of each axis, which creates new lists throughout
+        # so frames shared with undo snapshots are left alone
+        sx = -x % self.width
+        sy = -y % self.height
+        sz = -z % self.depth
+        data = []
+        for plane in self._data[sx:] + self._data[:sx]:
+            data.append([column[sz:] + column[:sz] for column in plane[sy:] + plane[:sy]])
         self._data = data
         self._frames[self._current_frame] = self._data
-        # Rebuild our cache
+        # Move our cache along
+        self._cache = set(((cx + x) % self.width, (cy + y) % self.height, (cz + z) % self.depth)
+                          for cx, cy, cz in self._cache)
+        self._dirty = None
+        self.changed = True
+
+    # Copy the current frame if an undo snapshot still refers to it
+    def _own_data(self):
+        # Once changed, the current frame no longer matches its lazy frame
+        if self._lazy is not None:
+            if self._decoded.get(self._lazy) is self._data:
+                del self._decoded[self._lazy]
+            self._lazy = None
+        if id(self._data) in self._shared:
+            self._data = [[list(column) for column in plane] for plane in self._data]
+            self._frames[self._current_frame] = self._data
+
+    def _save_model(self):
+        return list(self._frames), self._width, self._height, self._depth, self._current_frame
+
+    def _restore_model(self, data):
+        frames, self._width, self._height, self._depth, self._current_frame = data
+        self._frames = list(frames)
+        self._frame_count = len(self._frames)
+        self._load_frame(self._current_frame)
+        self._undo.frame = self._current_frame
+        self.clear_selection()
         self._cache_rebuild()
         self.changed = True
 
+    # Called before a structural operation (resize, rotate, frame changes).
+    # The frames are shared with the undo snapshot rather than copied.
+    def _begin_snapshot(self):
+        if not self._undo.enabled:
+            return self._current_frame, None
+        self._frames[self._current_frame] = self._data
+        data = self._save_model()
+        self._shared.update(id(frame) for frame in data[0])
+        return self._current_frame, (data, self._undo.save_state())
+
+    # Called after a structural operation to record it as a single undo step.
+    # If undo is disabled we can only forget the history, if clear is set.
+    # action is the (method name, arguments) of the operation for our journal.
+    def _end_snapshot(self, before, action, clear=True):
+        frame, before = before
+        if before is not None:
+            self._undo.add_snapshot(UndoItem(Undo.SNAPSHOT, before, None), self._save_model())
+        elif clear:
+            self._undo.clear(self._frame_count)
+            self._undo.frame = self._current_frame
+        if self.journal is not None:
+            self.journal.action(frame, *action)
+
     # Undo previous operation
     def undo(self):
         self.clear_selection()
         op = self._undo.undo()
-        # Voxel edit
-        if op and op.operation == Undo.SET_VOXEL:
-            data = op.olddata
-            self.set(data[0], data[1], data[2], data[3], False)
-        elif op and op.operation == Undo.FILL:
-            d = op.olddata
-            for data in d:
-                self.set(data[0], data[1], data[2], data[3], False)
-        # Translation
-        elif op and op.operation == Undo.TRANSLATE:
-            data = op.olddata
-            self.translate(data[0], data[1], data[2], False)
+        if op:
+            self._revert(op)
+            self._journal_snapshot()
 
     # Redo an undone operation
     def redo(self):
         op = self._undo.redo()
+        if op:
+            self._reapply(op)
+            self._journal_snapshot()
+
+    # Our journal can't record some operations on history older than its
+    # last snapshot, it needs a new snapshot instead
+    def _journal_snapshot(self):
+        if self.journal is not None and self.journal.stale:
+            self.journal.snapshot(self)
+
+    def _revert(self, op):
         # Voxel edit
-        if op and op.operation == Undo.SET_VOXEL:
-            data = op.newdata
-            self.set(data[0], data[1], data[2], data[3], False)
-        elif op and op.operation == Undo.FILL:
-            d = op.newdata
-            for data in d:
-                self.set(data[0], data[1], data[2], data[3], False)
+        if op.operation in (Undo.SET_VOXEL, Undo.FILL):
+            self._apply_voxels(op.coordinates, op.old_colors, True)
+        elif op.operation == Undo.DELTA:
+            self._apply_delta(op.newdata)
+        # Translation
+        elif op.operation == Undo.TRANSLATE:
+            data = op.olddata
+            self.translate(data[0], data[1], data[2], False)
+        # Several operations, revert last to first
+        elif op.operation == Undo.GROUP:
+            for item in reversed(op.olddata):
+                self._revert(item)
+        # Structural operation, go back to the model before it
+        elif op.operation == Undo.SNAPSHOT:
+            self._frames[self._current_frame] = self._data
+            before = self._undo.undo_snapshot(op, self._save_model())
+            self._restore_model(before)
+            self._undo.add_redo(op)
+
+    def _reapply(self, op):
+        # Voxel edit
+        if op.operation in (Undo.SET_VOXEL, Undo.FILL):
+            self._apply_voxels(op.coordinates, op.new_colors)
+        elif op.operation == Undo.DELTA:
+            self._apply_delta(op.newdata)
         # Translation
-        elif op and op.operation == Undo.TRANSLATE:
+        elif op.operation == Undo.TRANSLATE:
             data = op.newdata
             self.translate(data[0], data[1], data[2], False)
+        elif op.operation == Undo.GROUP:
+            for item in op.olddata:
+                self._reapply(item)
+        elif op.operation == Undo.SNAPSHOT:
+            self._restore_model(self._undo.redo_snapshot(op))
+
+    # Collect all undo records until the matching end_undo_group() call into
+    # a single undo step. Groups can be nested.
+    def begin_undo_group(self):
+        self._undo.begin_group()
+
+    def end_undo_group(self):
+        self._undo.end_group((self._width, self._height, self._depth))
+
+    # Limit the memory (in bytes) and number of steps the undo history of all
+    # frames may use. With spill the oldest history is moved to a compressed
+    # temporary file instead of being discarded.
+    def set_undo_limits(self, budget=None, depth=None, spill=False):
+        self._undo.spill = spill
+        self._undo.budget = budget
+        self._undo.max_depth = depth
+
+    # Forget the undo history of all frames, keeping the model
+    def clear_undo(self):
+        self._undo.clear(self._frame_count)
+        self._undo.frame = self._current_frame
+        self._shared = set()
 
     # Enable/Disable undo buffer
     def disable_undo(self):
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import array
+import struct
 from PySide import QtGui
 from OpenGL.GL import *
 # from OpenGL.GLU import gluUnProject, gluProject
@@ -46,6 +46,10 @@ class GridPlane(object):
         self._offset = 0
         self._visible = visible
         self._color = color
+        # Dimensions and offset our vertices were built for
+        self._key = None
+        # Incremented whenever our geometry or appearance changes
+        self._version = 0
         self._offset_plane_limit = {
             GridPlanes.X: lambda: self._voxels.width,
             GridPlanes.Y: lambda: self._voxels.height,
@@ -99,7 +103,9 @@ class GridPlane(object):
     @visible.setter
     def visible(self, value):
         assert isinstance(value, bool)
-        self._visible = value
+        if value != self._visible:
+            self._visible = value
+            self._version += 1
 
     @property
     def color(self):
@@ -108,16 +114,27 @@ class GridPlane(object):
     @color.setter
     def color(self, value):
         assert isinstance(value, QtGui.QColor)
-        self._color = value
+        if value != self._color:
+            self._color = value
+            self._version += 1
 
     @property
     def vertices(self):
         return self._vertices
 
+    @property
+    def version(self):
+        return self._version
+
+    # Rebuild our vertices, unless the dimensions and offset are unchanged
     def update_vertices(self):
+        key = (self._plane, self._offset, self._voxels.width, self._voxels.height, self._voxels.depth)
+        if key == self._key:
+            return
+        self._key = key
         self._vertices = self._methods_get_plane_vertices[self._plane]()
-        self._vertices_array = array.array("f", self._vertices).tostring()
         self._num_vertices = len(self._vertices) // 3
+        self._version += 1
 
     def _get_grid_vertices_x_plane(self):
         vertices = []
@@ -158,9 +175,16 @@ class GridPlane(object):
 
 class VoxelGrid(object):
 
+    # Layout of a vertex in our buffer, suitable for GL_C4UB_V3F
+    _VERTEX = struct.Struct("=4B3f")
+
     def __init__(self, widget):
         self._voxels = widget
         self._planes = {}
+        # All visible planes packed into one interleaved buffer
+        self._buffer = ""
+        self._num_vertices = 0
+        self._signature = None
 
     def add_grid_plane(self, plane, offset, visible, color=QtGui.QColor("white")):
         key = (plane, offset)
@@ -190,33 +214,44 @@ class VoxelGrid(object):
                 plane.offset = voxels.depth
             plane.update_vertices()
 
-    # Render the grids
-    def paint(self):
-        # Disable lighting
-        glDisable(GL_LIGHTING)
-        glDisable(GL_TEXTURE_2D)
-
+    # Pack the vertices of all visible planes into our buffer if any
+    # plane changed since we last did so
+    def _update_buffer(self):
+        signature = tuple((key, id(plane), plane.version) for key, plane in sorted(self._planes.iteritems()))
+        if signature == self._signature:
+            return
+        self._signature = signature
+        pack = self._VERTEX.pack
+        data = []
         for grid in self._planes.itervalues():
             if not grid.visible:
                 continue
+            red, green, blue, _ = grid.color.getRgb()
+            vertices = grid.vertices
+            for i in xrange(0, len(vertices), 3):
+                data.append(pack(red, green, blue, 0xff, vertices[i], vertices[i + 1], vertices[i + 2]))
+        self._buffer = "".join(data)
+        self._num_vertices = len(data)
 
-            red = grid.color.redF()
-            green = grid.color.greenF()
-            blue = grid.color.blueF()
-            # Grid color
-            glColor3f(red, green, blue)
+    # Render the grids
+    def paint(self):
+        self._update_buffer()
+        if not self._num_vertices:
+            return
 
-            # Enable vertex buffers
-            glEnableClientState(GL_VERTEX_ARRAY)
+        # Disable lighting
+        glDisable(GL_LIGHTING)
+        glDisable(GL_TEXTURE_2D)
 
-            # Describe our buffers
-            glVertexPointer(3, GL_FLOAT, 0, grid._vertices_array)
+        # Describe our buffer, this also enables the vertex and color arrays
+        glInterleavedArrays(GL_C4UB_V3F, 0, self._buffer)
 
-            # Render the buffers
-            glDrawArrays(GL_LINES, 0, grid._num_vertices)
+        # Render all planes at once
+        glDrawArrays(GL_LINES, 0, self._num_vertices)
 
-            # Disable vertex buffers
-            glDisableClientState(GL_VERTEX_ARRAY)
+        # Disable vertex buffers
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glDisableClientState(GL_COLOR_ARRAY)
 
         # Enable lighting
         glEnable(GL_LIGHTING)
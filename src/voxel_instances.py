@@ -0,0 +1,255 @@
+# voxel_instances.py
+# Instanced rendering of voxel models.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Instead of uploading six vertices per visible face we upload one 16 byte
+# record per voxel (see VoxelData.get_instances) and draw a unit cube once per
+# voxel. The vertex shader collapses hidden faces and applies the occlusion
+# shading, lighting and picking color encoding of the classic vertex array
+# path, so both paths render the same picture.
+#
+# Requires GL_ARB_instanced_arrays / GL_ARB_draw_instanced (or OpenGL 3.3)
+# and GLSL 1.20. initialise() returns False if those aren't available.
+
+import array
+import ctypes
+from OpenGL.GL import *
+from OpenGL.GL import shaders
+import voxel
+
+_VERTEX_SHADER = """
+#version 120
+attribute vec3 offset;
+attribute vec3 normal;
+attribute vec2 uv;
+attribute vec2 face_corner;
+attribute vec4 voxel;
+attribute vec4 color;
+attribute vec4 occlusion0;
+attribute vec2 occlusion1;
+uniform vec3 origin;
+uniform float occlusion_factor;
+uniform bool picking;
+varying vec4 frag_color;
+varying vec2 frag_uv;
+
+float bits(float value, float shift, float range) {
+    return mod(floor(value / exp2(shift) + 0.5 / exp2(shift)), range);
+}
+
+void main() {
+    float face = face_corner.x;
+    frag_uv = uv;
+    // Hidden faces collapse to a point outside of the clip volume
+    if (bits(voxel.w, face, 2.0) < 0.5) {
+        gl_Position = vec4(0.0, 0.0, 2.0, 1.0);
+        frag_color = vec4(0.0);
+        return;
+    }
+    vec3 position = origin + vec3(voxel.x, voxel.y, -voxel.z) + offset;
+    gl_Position = gl_ModelViewProjectionMatrix * vec4(position, 1.0);
+    if (picking) {
+        // Same encoding as VoxelData: 7 bits per coordinate and 3 bits for the face
+        frag_color = vec4(voxel.x * 2.0 + floor(voxel.y / 64.0),
+                          mod(voxel.y, 64.0) * 4.0 + floor(voxel.z / 32.0),
+                          mod(voxel.z, 32.0) * 8.0 + face, 255.0) / 255.0;
+        return;
+    }
+    float packed;
+    if (face < 0.5) {
+        packed = occlusion0.x;
+    } else if (face < 1.5) {
+        packed = occlusion0.y;
+    } else if (face < 2.5) {
+        packed = occlusion0.z;
+    } else if (face < 3.5) {
+        packed = occlusion0.w;
+    } else if (face < 4.5) {
+        packed = occlusion1.x;
+    } else {
+        packed = occlusion1.y;
+    }
+    float shade = pow(occlusion_factor, bits(packed, face_corner.y * 2.0, 4.0));
+    // Fixed function lighting: global ambient and a directional light along the view axis
+    vec3 n = normalize(gl_NormalMatrix * normal);
+    float light = min(1.0, 0.2 + max(0.0, n.z));
+    frag_color = vec4(color.rgb * shade * light, 1.0);
+}
+"""
+
+_FRAGMENT_SHADER = """
+#version 120
+uniform sampler2D edge_texture;
+uniform bool edges;
+varying vec4 frag_color;
+varying vec2 frag_uv;
+
+void main() {
+    if (edges) {
+        gl_FragColor = frag_color * texture2D(edge_texture, frag_uv);
+    } else {
+        gl_FragColor = frag_color;
+    }
+}
+"""
+
+# Vertices of each face (indexed by face ID) relative to the world space
+# corner of a voxel, in the order VoxelData emits them, and the face normal.
+_FACE_VERTICES = (
+    (((0, 0, 0), (0, 1, 0), (1, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 0)), (0, 0, 1)),
+    (((0, 1, 0), (0, 1, -1), (1, 1, 0), (1, 1, 0), (0, 1, -1), (1, 1, -1)), (0, 1, 0)),
+    (((0, 0, -1), (0, 1, -1), (0, 0, 0), (0, 0, 0), (0, 1, -1), (0, 1, 0)), (-1, 0, 0)),
+    (((1, 0, 0), (1, 1, 0), (1, 0, -1), (1, 0, -1), (1, 1, 0), (1, 1, -1)), (1, 0, 0)),
+    (((1, 0, -1), (1, 1, -1), (0, 0, -1), (0, 0, -1), (1, 1, -1), (0, 1, -1)), (0, 0, -1)),
+    (((0, 0, -1), (0, 0, 0), (1, 0, -1), (1, 0, -1), (0, 0, 0), (1, 0, 0)), (0, -1, 0)),
+)
+# Occlusion corner and texture coordinates of the six vertices of a face
+_CORNERS = (0, 1, 2, 2, 1, 3)
+_UVS = ((0, 0), (0, 1), (1, 0), (1, 0), (0, 1), (1, 1))
+
+# Number of visible faces for each face mask
+_FACE_COUNT = [bin(mask).count("1") for mask in xrange(64)]
+
+
+# Return the first of the given GL functions which is available
+def _entry_point(*functions):
+    for function in functions:
+        if function and bool(function):
+            return function
+    return None
+
+
+class VoxelInstances(object):
+
+    # Bytes per voxel record
+    RECORD_SIZE = 16
+
+    @property
+    def supported(self):
+        return self._program is not None
+
+    # Number of voxels we draw
+    @property
+    def count(self):
+        return self._count
+
+    # Number of visible faces we draw
+    @property
+    def faces(self):
+        return self._faces
+
+    def __init__(self):
+        self._program = None
+        self._records = ""
+        self._count = 0
+        self._faces = 0
+        self._dirty = False
+
+    # Compile our shaders and create our buffers. Must be called with a
+    # current GL context. Returns False if instancing isn't supported.
+    def initialise(self):
+        try:
+            from OpenGL.GL.ARB.instanced_arrays import glVertexAttribDivisorARB
+            from OpenGL.GL.ARB.draw_instanced import glDrawArraysInstancedARB
+        except ImportError:
+            glVertexAttribDivisorARB = glDrawArraysInstancedARB = None
+        try:
+            self._divisor = _entry_point(glVertexAttribDivisor, glVertexAttribDivisorARB)
+            self._draw_instanced = _entry_point(glDrawArraysInstanced, glDrawArraysInstancedARB)
+            if not self._divisor or not self._draw_instanced:
+                return False
+            program = shaders.compileProgram(shaders.compileShader(_VERTEX_SHADER, GL_VERTEX_SHADER),
+                                             shaders.compileShader(_FRAGMENT_SHADER, GL_FRAGMENT_SHADER))
+        except Exception:
+            return False
+        self._program = program
+        self._attributes = dict((name, glGetAttribLocation(program, name))
+                                for name in ("offset", "normal", "uv", "face_corner",
+                                             "voxel", "color", "occlusion0", "occlusion1"))
+        self._uniforms = dict((name, glGetUniformLocation(program, name))
+                              for name in ("origin", "occlusion_factor", "picking", "edge_texture", "edges"))
+        # The unit cube all instances share
+        cube = []
+        for face, (vertices, normal) in enumerate(_FACE_VERTICES):
+            for i, offset in enumerate(vertices):
+                cube += offset
+                cube += normal
+                cube += _UVS[i]
+                cube += (face, _CORNERS[i])
+        self._cube_vertices = len(cube) // 10
+        self._cube_buffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self._cube_buffer)
+        glBufferData(GL_ARRAY_BUFFER, array.array("f", cube).tostring(), GL_STATIC_DRAW)
+        self._instance_buffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self._dirty = True
+        return True
+
+    # Replace the voxel records we draw. The upload happens on the next paint
+    # so this can be called without a current GL context.
+    def update(self, records, count):
+        self._records = bytes(records)
+        self._count = count
+        self._faces = sum(_FACE_COUNT[mask & 0x3f] for mask in bytearray(self._records[3::self.RECORD_SIZE]))
+        self._dirty = True
+
+    def _attribute(self, name, size, gltype, normalized, stride, offset, divisor=0):
+        location = self._attributes[name]
+        if location < 0:
+            return
+        glEnableVertexAttribArray(location)
+        glVertexAttribPointer(location, size, gltype, normalized, stride, ctypes.c_void_p(offset))
+        self._divisor(location, divisor)
+
+    # Draw all instances. origin is the world space corner of voxel (0, 0, 0),
+    # texture the voxel edge texture (or None) and picking selects rendering
+    # of face ID colors instead of the shaded model.
+    def paint(self, origin, texture=None, picking=False):
+        if not self._program or not self._count:
+            return
+        glUseProgram(self._program)
+        glBindBuffer(GL_ARRAY_BUFFER, self._instance_buffer)
+        if self._dirty:
+            glBufferData(GL_ARRAY_BUFFER, self._records, GL_DYNAMIC_DRAW)
+            self._dirty = False
+        glUniform3f(self._uniforms["origin"], *origin)
+        glUniform1f(self._uniforms["occlusion_factor"], voxel.OCCLUSION)
+        glUniform1i(self._uniforms["picking"], picking)
+        glUniform1i(self._uniforms["edges"], texture is not None and not picking)
+        if texture is not None:
+            glActiveTexture(GL_TEXTURE0)
+            glBindTexture(GL_TEXTURE_2D, texture)
+            glUniform1i(self._uniforms["edge_texture"], 0)
+        # Per voxel attributes
+        size = self.RECORD_SIZE
+        self._attribute("voxel", 4, GL_UNSIGNED_BYTE, GL_FALSE, size, 0, 1)
+        self._attribute("color", 4, GL_UNSIGNED_BYTE, GL_TRUE, size, 4, 1)
+        self._attribute("occlusion0", 4, GL_UNSIGNED_BYTE, GL_FALSE, size, 8, 1)
+        self._attribute("occlusion1", 2, GL_UNSIGNED_BYTE, GL_FALSE, size, 12, 1)
+        # Per vertex attributes of the cube
+        glBindBuffer(GL_ARRAY_BUFFER, self._cube_buffer)
+        self._attribute("offset", 3, GL_FLOAT, GL_FALSE, 40, 0)
+        self._attribute("normal", 3, GL_FLOAT, GL_FALSE, 40, 12)
+        self._attribute("uv", 2, GL_FLOAT, GL_FALSE, 40, 24)
+        self._attribute("face_corner", 2, GL_FLOAT, GL_FALSE, 40, 32)
+
+        self._draw_instanced(GL_TRIANGLES, 0, self._cube_vertices, self._count)
+
+        for location in self._attributes.itervalues():
+            if location >= 0:
+                self._divisor(location, 0)
+                glDisableVertexAttribArray(location)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glUseProgram(0)
@@ -0,0 +1,271 @@
+# voxel_mesh.py
+# A chunked vertex array mesh of a voxel model.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The mesh is split into cubic chunks of voxels. The vertices of all chunks are
+# packed into one set of arrays, ordered by chunk and, within a chunk, by face
+# direction, so every chunk/direction group is a contiguous range we can draw
+# with a single glDrawArrays call. When painting we skip chunks outside of
+# the view frustum and face groups whose normal points away from the camera.
+#
+# We keep the packed data of every chunk, so after an edit only the chunks
+# around the changed voxels are rebuilt before the arrays are joined again.
+
+import array
+from OpenGL.GL import *
+
+# World space outward normal of each face ID
+_NORMALS = ((0, 0, 1), (0, 1, 0), (-1, 0, 0), (1, 0, 0), (0, 0, -1), (0, -1, 0))
+
+
+# Multiply two column major 4x4 matrices
+def _multiply(a, b):
+    return [sum(a[k * 4 + row] * b[col * 4 + k] for k in xrange(4))
+            for col in xrange(4) for row in xrange(4)]
+
+
+class VoxelMesh(object):
+
+    # Size of a chunk in voxels
+    CHUNK_SIZE = 16
+
+    # Number of vertices in the mesh
+    @property
+    def num_vertices(self):
+        return self._num_vertices
+
+    # Number of vertices drawn by the last paint
+    @property
+    def drawn_vertices(self):
+        return self._drawn_vertices
+
+    def __init__(self):
+        self.clear()
+
+    # Forget our mesh
+    def clear(self):
+        self._vertices = ""
+        self._colors = ""
+        self._normals = ""
+        self._color_ids = ""
+        self._uvs = ""
+        self._num_vertices = 0
+        self._drawn_vertices = 0
+        # List of (bounding box, [(first, count) for each face ID])
+        self._chunks = []
+        # Chunk coordinates to (bounding box, [packed arrays for each face
+        # ID]), None until we are built
+        self._chunk_data = None
+
+    # Build our mesh from the current frame of the given voxel data
+    def build(self, voxels):
+        voxels.take_dirty()
+        self._chunk_data = {}
+        self._build_chunks(voxels, voxels.get_chunk_vertices(self.CHUNK_SIZE))
+        self._pack()
+
+    # Bring our mesh up to date with the given voxel data, rebuilding only the
+    # chunks affected by the voxels changed since we were last built
+    def update(self, voxels):
+        dirty = voxels.take_dirty()
+        if dirty is None or self._chunk_data is None:
+            self.build(voxels)
+            return
+        if not dirty:
+            return
+        keys = self._affected_chunks(dirty)
+        for key in keys:
+            self._chunk_data.pop(key, None)
+        self._build_chunks(voxels, voxels.get_chunk_vertices(self.CHUNK_SIZE, keys))
+        self._pack()
+
+    # Return the chunks containing the given voxels or any of their neighbours
+    def _affected_chunks(self, voxels):
+        size = self.CHUNK_SIZE
+        last = size - 1
+        keys = set()
+        for x, y, z in voxels:
+            cx = x // size
+            cy = y // size
+            cz = z // size
+            mx = x % size
+            my = y % size
+            mz = z % size
+            if 0 < mx < last and 0 < my < last and 0 < mz < last:
+                keys.add((cx, cy, cz))
+                continue
+            # On the border of the chunk, the neighbouring chunks see it too
+            xs = (cx - 1, cx) if mx == 0 else (cx, cx + 1) if mx == last else (cx,)
+            ys = (cy - 1, cy) if my == 0 else (cy, cy + 1) if my == last else (cy,)
+            zs = (cz - 1, cz) if mz == 0 else (cz, cz + 1) if mz == last else (cz,)
+            for kx in xs:
+                for ky in ys:
+                    for kz in zs:
+                        keys.add((kx, ky, kz))
+        return keys
+
+    # Pack the vertex lists of the given chunks
+    def _build_chunks(self, voxels, chunks):
+        size = self.CHUNK_SIZE
+        for key, faces in chunks.iteritems():
+            packed = []
+            for v, c, n, cid, uv in faces:
+                packed.append((len(v) // 3, array.array("f", v).tostring(), array.array("B", c).tostring(),
+                               array.array("f", n).tostring(), array.array("B", cid).tostring(),
+                               array.array("f", uv).tostring()))
+            # World space bounding box of the chunk
+            cx, cy, cz = key
+            x1, y1, z1 = voxels.voxel_to_world(cx * size, cy * size, cz * size)
+            x2, y2, z2 = voxels.voxel_to_world(min((cx + 1) * size, voxels.width),
+                                               min((cy + 1) * size, voxels.height),
+                                               min((cz + 1) * size, voxels.depth))
+            bounds = (min(x1, x2), min(y1, y2), min(z1, z2), max(x1, x2), max(y1, y2), max(z1, z2))
+            self._chunk_data[key] = (bounds, packed)
+
+    # Join the packed data of all chunks into our arrays
+    def _pack(self):
+        vertices = []
+        colors = []
+        normals = []
+        color_ids = []
+        uvs = []
+        self._chunks = []
+        first = 0
+        for key in sorted(self._chunk_data):
+            bounds, packed = self._chunk_data[key]
+            ranges = []
+            for count, v, c, n, cid, uv in packed:
+                ranges.append((first, count))
+                first += count
+                vertices.append(v)
+                colors.append(c)
+                normals.append(n)
+                color_ids.append(cid)
+                uvs.append(uv)
+            self._chunks.append((bounds, ranges))
+        self._num_vertices = first
+        self._vertices = "".join(vertices)
+        self._colors = "".join(colors)
+        self._normals = "".join(normals)
+        self._color_ids = "".join(color_ids)
+        self._uvs = "".join(uvs)
+
+    # Return the (first, count) vertex ranges which can be seen with the
+    # current GL projection and modelview matrices. Adjacent ranges are merged.
+    def _visible_ranges(self):
+        projection = [float(v) for row in glGetDoublev(GL_PROJECTION_MATRIX) for v in row]
+        modelview = [float(v) for row in glGetDoublev(GL_MODELVIEW_MATRIX) for v in row]
+        clip = _multiply(projection, modelview)
+        # Frustum planes (a, b, c, d) from the rows of the clip matrix
+        rows = [clip[r::4] for r in xrange(4)]
+        planes = []
+        for r in xrange(3):
+            planes.append([rows[3][i] + rows[r][i] for i in xrange(4)])
+            planes.append([rows[3][i] - rows[r][i] for i in xrange(4)])
+        # Camera position in world space
+        t = modelview[12:15]
+        eye = [-(modelview[k * 4] * t[0] + modelview[k * 4 + 1] * t[1] + modelview[k * 4 + 2] * t[2])
+               for k in xrange(3)]
+
+        ranges = []
+        for (x1, y1, z1, x2, y2, z2), faces in self._chunks:
+            # Outside of the frustum if the box is fully behind any plane
+            outside = False
+            for a, b, c, d in planes:
+                if (a * (x2 if a > 0 else x1) + b * (y2 if b > 0 else y1) +
+                        c * (z2 if c > 0 else z1) + d) < 0:
+                    outside = True
+                    break
+            if outside:
+                continue
+            lower = (x1, y1, z1)
+            upper = (x2, y2, z2)
+            for face, (first, count) in enumerate(faces):
+                if not count:
+                    continue
+                # Faces pointing away from the camera can't be seen
+                axis, sign = [(i, n) for i, n in enumerate(_NORMALS[face]) if n][0]
+                if sign > 0 and eye[axis] <= lower[axis]:
+                    continue
+                if sign < 0 and eye[axis] >= upper[axis]:
+                    continue
+                if ranges and ranges[-1][0] + ranges[-1][1] == first:
+                    ranges[-1] = (ranges[-1][0], ranges[-1][1] + count)
+                else:
+                    ranges.append((first, count))
+        return ranges
+
+    # Draw the visible parts of the mesh, return the number of vertices drawn
+    def _draw(self):
+        drawn = 0
+        for first, count in self._visible_ranges():
+            glDrawArrays(GL_TRIANGLES, first, count)
+            drawn += count
+        return drawn
+
+    # Render the mesh, optionally textured with the voxel edge texture
+    def paint(self, texture, edges=True):
+        if not self._num_vertices:
+            self._drawn_vertices = 0
+            return
+        # Enable vertex buffers
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+
+        # Bind our texture
+        glBindTexture(GL_TEXTURE_2D, texture)
+
+        # Describe our buffers
+        glVertexPointer(3, GL_FLOAT, 0, self._vertices)
+        if edges:
+            glTexCoordPointer(2, GL_FLOAT, 0, self._uvs)
+        else:
+            glDisable(GL_TEXTURE_2D)
+        glColorPointer(3, GL_UNSIGNED_BYTE, 0, self._colors)
+        glNormalPointer(GL_FLOAT, 0, self._normals)
+
+        # Render the visible parts of the buffers
+        self._drawn_vertices = self._draw()
+
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_NORMAL_ARRAY)
+
+        if not edges:
+            glEnable(GL_TEXTURE_2D)
+
+    # Render the mesh using color IDs
+    def paint_ids(self):
+        if not self._num_vertices:
+            return
+        # Enable vertex buffers
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+
+        # Describe our buffers
+        glVertexPointer(3, GL_FLOAT, 0, self._vertices)
+        glColorPointer(3, GL_UNSIGNED_BYTE, 0, self._color_ids)
+        glNormalPointer(GL_FLOAT, 0, self._normals)
+
+        # Render the visible parts of the buffers
+        self._draw()
+
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_NORMAL_ARRAY)
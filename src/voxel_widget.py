@@ -16,7 +16,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import math
-import array
 import sys
 from PySide import QtCore, QtGui, QtOpenGL
 from OpenGL.GL import *
@@ -26,6 +25,9 @@ from euclid import LineSegment3, Plane, Point3, Vector3
 from tool import EventData, MouseButtons, KeyModifiers
 from voxel_grid import GridPlanes
 from voxel_grid import VoxelGrid
+from voxel_instances import VoxelInstances
+from voxel_mesh import VoxelMesh
+from profiler import Profiler
 import time
 
 
@@ -41,6 +43,10 @@ class GLWidget(QtOpenGL.QGLWidget):
     DRAG_END = 2
     DRAG = 3
 
+    # Render modes
+    RENDER_ARRAYS = 1
+    RENDER_INSTANCED = 2
+
     @property
     def axis_grids(self):
         return self._display_axis_grids
@@ -89,6 +95,29 @@ class GLWidget(QtOpenGL.QGLWidget):
     def grids(self):
         return self._grids
 
+    @property
+    def statistics(self):
+        return self.stats.enabled
+
+    @statistics.setter
+    def statistics(self, value):
+        self.stats.enabled = value
+        self.updateGL()
+
+    # The render mode in use. Falls back to vertex arrays if instancing
+    # was requested but isn't supported by the driver.
+    @property
+    def render_mode(self):
+        if self._render_mode == self.RENDER_INSTANCED and self._instancing_checked \
+                and not self._instances.supported:
+            return self.RENDER_ARRAYS
+        return self._render_mode
+
+    @render_mode.setter
+    def render_mode(self, value):
+        self._render_mode = value
+        self.refresh()
+
     # Our signals
     mouse_click_event = QtCore.Signal()
     start_drag_event = QtCore.Signal()
@@ -110,6 +139,14 @@ class GLWidget(QtOpenGL.QGLWidget):
         self._display_wireframe = False
         self._voxel_color = QtGui.QColor.fromHsvF(0, 1.0, 1.0)
         self._voxeledges = True
+        # Chunked vertex array mesh
+        self._mesh = VoxelMesh()
+        # Instanced rendering
+        self._render_mode = self.RENDER_ARRAYS
+        self._instances = VoxelInstances()
+        self._instancing_checked = False
+        # Render statistics
+        self.stats = Profiler()
         # Mouse position
         self._mouse = QtCore.QPoint()
         self._mouse_absolute = QtCore.QPoint()
@@ -186,6 +223,9 @@ class GLWidget(QtOpenGL.QGLWidget):
         # Load our texture
         pixmap = QtGui.QPixmap(":/images/gfx/texture.png")
         self._texture = self.bindTexture(pixmap)
+        # Check for instancing support
+        self._instances.initialise()
+        self._instancing_checked = True
         self.build_mesh()
         # Setup our lighting
         self.setup_lights()
@@ -194,6 +234,14 @@ class GLWidget(QtOpenGL.QGLWidget):
     def paintGL(self):
         if not self.ready:
             return
+        with self.stats.timer("paint"):
+            self._paint_scene()
+        # Statistics overlay
+        if self.stats.enabled:
+            self.stats.frame()
+            self.paint_statistics()
+
+    def _paint_scene(self):
         self.qglClearColor(self._background_color)
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         glLoadIdentity()
@@ -202,38 +250,16 @@ class GLWidget(QtOpenGL.QGLWidget):
         glRotated(self._rotate_y, 0.0, 1.0, 0.0)
         glRotated(self._rotate_z, 0.0, 0.0, 1.0)
 
-        # Enable vertex buffers
-        glEnableClientState(GL_VERTEX_ARRAY)
-        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-        glEnableClientState(GL_COLOR_ARRAY)
-        glEnableClientState(GL_NORMAL_ARRAY)
-
         # Wireframe?
         if self.wireframe:
             glPolygonMode(GL_FRONT, GL_LINE)
 
-        # Bind our texture
-        glBindTexture(GL_TEXTURE_2D, self._texture)
-
-        # Describe our buffers
-        glVertexPointer(3, GL_FLOAT, 0, self._vertices)
-        if self._voxeledges:
-            glTexCoordPointer(2, GL_FLOAT, 0, self._uvs)
+        if self.render_mode == self.RENDER_INSTANCED:
+            self._instances.paint(self.voxels.voxel_to_world(0, 0, 0),
+                                  self._texture if self._voxeledges else None)
         else:
-            glDisable(GL_TEXTURE_2D)
-        glColorPointer(3, GL_UNSIGNED_BYTE, 0, self._colors)
-        glNormalPointer(GL_FLOAT, 0, self._normals)
-
-        # Render the buffers
-        glDrawArrays(GL_TRIANGLES, 0, self._num_vertices)
-
-        glDisableClientState(GL_VERTEX_ARRAY)
-        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
-        glDisableClientState(GL_COLOR_ARRAY)
-        glDisableClientState(GL_NORMAL_ARRAY)
-
-        if not self._voxeledges:
-            glEnable(GL_TEXTURE_2D)
+            self._mesh.paint(self._texture, self._voxeledges)
+            self.stats.count("drawn", self._mesh.drawn_vertices)
 
         # draw the grids
         if self._display_axis_grids:
@@ -242,6 +268,24 @@ class GLWidget(QtOpenGL.QGLWidget):
         # Default back to filled rendering
         glPolygonMode(GL_FRONT, GL_FILL)
 
+        # Wait for the frame to finish so our timings include the GPU work
+        if self.stats.enabled:
+            glFinish()
+
+    # Render the statistics overlay on top of the scene
+    def paint_statistics(self):
+        glDisable(GL_LIGHTING)
+        glDisable(GL_TEXTURE_2D)
+        # Pick a text color which is readable on our background
+        if self._background_color.lightnessF() > 0.5:
+            self.qglColor(QtGui.QColor("black"))
+        else:
+            self.qglColor(QtGui.QColor("white"))
+        for i, line in enumerate(self.stats.summary()):
+            self.renderText(10, 20 + i * 15, line)
+        glEnable(GL_LIGHTING)
+        glEnable(GL_TEXTURE_2D)
+
     # Window is resizing
     def resizeGL(self, width, height):
         self._width = width
@@ -271,22 +315,10 @@ class GLWidget(QtOpenGL.QGLWidget):
         glRotated(self._rotate_y, 0.0, 1.0, 0.0)
         glRotated(self._rotate_z, 0.0, 0.0, 1.0)
 
-        # Enable vertex buffers
-        glEnableClientState(GL_VERTEX_ARRAY)
-        glEnableClientState(GL_COLOR_ARRAY)
-        glEnableClientState(GL_NORMAL_ARRAY)
-
-        # Describe our buffers
-        glVertexPointer(3, GL_FLOAT, 0, self._vertices)
-        glColorPointer(3, GL_UNSIGNED_BYTE, 0, self._color_ids)
-        glNormalPointer(GL_FLOAT, 0, self._normals)
-
-        # Render the buffers
-        glDrawArrays(GL_TRIANGLES, 0, self._num_vertices)
-
-        glDisableClientState(GL_VERTEX_ARRAY)
-        glDisableClientState(GL_COLOR_ARRAY)
-        glDisableClientState(GL_NORMAL_ARRAY)
+        if self.render_mode == self.RENDER_INSTANCED:
+            self._instances.paint(self.voxels.voxel_to_world(0, 0, 0), picking=True)
+        else:
+            self._mesh.paint_ids()
 
         # Set background color back to original
         self.qglClearColor(self._background_color)
@@ -307,14 +339,22 @@ class GLWidget(QtOpenGL.QGLWidget):
 
     # Build a mesh from our current voxel data
     def build_mesh(self):
-        # Grab the voxel vertices
-        self._vertices, self._colors, self._normals, self._color_ids, self._uvs = self.voxels.get_vertices()
-        self._num_vertices = len(self._vertices) // 3
-        self._vertices = array.array("f", self._vertices).tostring()
-        self._colors = array.array("B", self._colors).tostring()
-        self._color_ids = array.array("B", self._color_ids).tostring()
-        self._normals = array.array("f", self._normals).tostring()
-        self._uvs = array.array("f", self._uvs).tostring()
+        if self.render_mode == self.RENDER_INSTANCED:
+            with self.stats.timer("mesh"):
+                records, count = self.voxels.get_instances()
+                self._instances.update(records, count)
+                # Release the vertex arrays we no longer draw
+                self._mesh.clear()
+                self.voxels.take_dirty()
+            self.stats.count("instances", count)
+            self.stats.count("vertices", self._instances.faces * 6)
+            self.stats.count("drawn", None)
+            return
+        with self.stats.timer("mesh"):
+            self._mesh.update(self.voxels)
+        self._instances.update("", 0)
+        self.stats.count("instances", None)
+        self.stats.count("vertices", self._mesh.num_vertices)
 
     # Build axis grids
     def build_grids(self):
@@ -451,6 +491,10 @@ class GLWidget(QtOpenGL.QGLWidget):
     # If the background was clicked on rather than a voxel, calculate and return
     # the location on the floor grid.
     def window_to_voxel(self, x, y):
+        with self.stats.timer("pick"):
+            return self._window_to_voxel(x, y)
+
+    def _window_to_voxel(self, x, y):
         # We must invert y coordinates
         y = self._height - y
         # Render our scene (to the back buffer) using color IDs
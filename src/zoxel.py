@@ -16,9 +16,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import logging
 import traceback
 from PySide import QtGui
-from mainwindow import MainWindow
 
 
 def exception_handler(type, value, tb):
@@ -35,7 +35,17 @@ sys.excepthook = exception_handler
 
 
 def main():
+    # log to stderr
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+
+    # Convert files without GUI
+    if len(sys.argv) > 1 and sys.argv[1] == "convert":
+        sys.excepthook = sys.__excepthook__
+        import convert
+        sys.exit(convert.main(sys.argv[2:]))
+
     # create application
+    from mainwindow import MainWindow
     app = QtGui.QApplication(sys.argv)
 
     # create mainWindow
@@ -48,6 +58,9 @@ def main():
     # Load system plugins
     mainwindow.load_plugins()
 
+    # Recover changes lost in a crash
+    mainwindow.recover()
+
     # run main loop
     sys.exit(app.exec_())
 